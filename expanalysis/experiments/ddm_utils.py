@@ -1,14 +1,26 @@
+from collections import OrderedDict
 from glob import glob
+import hashlib
 import hddm
-import itertools
 from joblib import Parallel, delayed
 import kabuki
-from math import ceil
 import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
 import numpy
 import os
 import pandas
 import pickle
+import re
+import time
+import warnings
+from patsy import dmatrix
+
+from expanalysis.experiments.optimize_utils import batch_fmin
+from expanalysis.experiments.trace_utils import TraceStore
+
+# series terms of the small and large time Wiener densities
+SMALL_TIME_TERMS = 5
+LARGE_TIME_TERMS = 10
 
 def not_regex(txt):
     return '^((?!%s).)*$' % txt
@@ -17,61 +29,797 @@ def unique(lst):
     return list(numpy.unique(lst))
 
 
-def EZ_diffusion(df, condition = None):
-    assert 'correct' in df.columns, 'Could not calculate EZ DDM'
-    df = df.copy()
+def EZ(pc, vrt, mrt, s = 1):
+    """ Vectorized closed form EZ-diffusion equations (Wagenmakers et al., 2007).
+    Equivalent to hddm.utils.EZ, but applied elementwise to arrays of statistics
+    
+    Args:
+        pc: proportion correct
+        vrt: variance of correct response times (in seconds)
+        mrt: mean of correct response times (in seconds)
+        s: scaling parameter
+    
+    Returns:
+        (drift, thresh, non_decision): arrays of EZ parameters. Cells where pc is 0, 
+        .5 or 1 are undefined and returned as NaN
+    """
+    pc = numpy.asarray(pc, dtype = float)
+    vrt = numpy.asarray(vrt, dtype = float)
+    mrt = numpy.asarray(mrt, dtype = float)
+    undefined = (pc == 0) | (pc == .5) | (pc == 1)
+    with numpy.errstate(all = 'ignore'):
+        s2 = s**2
+        logit_p = numpy.log(pc/(1-pc))
+        # Eq. 7
+        x = (logit_p*(pc**2 * logit_p - pc*logit_p + pc - .5))/vrt
+        drift = numpy.sign(pc-.5)*s*x**.25
+        # Eq 5
+        thresh = (s2 * logit_p)/drift
+        y = (-drift*thresh)/s2
+        # Eq 9
+        mdt = (thresh/(2*drift))*((1-numpy.exp(y))/(1+numpy.exp(y)))
+        # Eq 8
+        non_decision = mrt-mdt
+    drift, thresh, non_decision = [numpy.where(undefined, numpy.nan, param)[()]
+                                   for param in (drift, thresh, non_decision)]
+    return drift, thresh, non_decision
+
+def group_EZ_diffusion(group_df, condition = None, workers = None):
+    """ Calculate EZ diffusion parameters for every worker (and condition) of an 
+    experiment at once. Proportion correct and the mean and variance of correct RTs are 
+    calculated with one grouped aggregation and the EZ equations are applied elementwise
+    
+    Args:
+        group_df: trials for all workers of one experiment
+        condition: optional column name. If provided, parameters are calculated for 
+            each level of condition
+        workers: workers returned when no condition is provided, including workers
+            without valid trials. Defaults to the workers in group_df
+    
+    Returns:
+        group_dvs: dictionary of EZ DVs for each worker
+    """
+    assert 'correct' in group_df.columns, 'Could not calculate EZ DDM'
+    if workers is None:
+        workers = pandas.unique(group_df['worker_id'])
     # convert reaction time to seconds to match with HDDM
-    df['rt'] = df['rt']/1000
+    df = pandas.DataFrame({'worker_id': group_df['worker_id'],
+                           'rt': group_df['rt']/1000,
+                           'correct': group_df['correct'].astype(float)})
+    keys = ['worker_id']
+    if condition:
+        df[condition] = group_df[condition]
+        keys.append(condition)
     # ensure there are no missed responses or extremely short responses (to fit with EZ)
     df = df.query('rt > .05')
-    # convert any perfect accuracies to .95
+    grouped = df.groupby(keys, sort = False)
+    correct_rt = df.query('correct == True').groupby(keys, sort = False).rt
+    stats = pandas.DataFrame({'pc': grouped.correct.mean(), 
+                              'N': grouped.size(),
+                              'vrt': correct_rt.var(ddof = 0),
+                              'mrt': correct_rt.mean()})
+    if not condition:
+        # workers without any valid trials get undefined parameters
+        stats = stats.reindex(workers)
+    # edge case correction using the fourth suggestion from 
+    # Stanislaw, H., & Todorov, N. (1999). Calculation of signal detection theory measures.
+    perfect = stats.pc == 1
+    stats.loc[perfect, 'pc'] = 1-(.5/stats.loc[perfect, 'N'])
+    stats = stats[~stats.pc.isin([0, .5])]
+    drift, thresh, non_dec = EZ(stats.pc, stats.vrt, stats.mrt)
+    group_dvs = {}
+    for i, key in enumerate(stats.index):
+        if condition:
+            worker, suffix = key[0], '_%s' % key[1]
+        else:
+            worker, suffix = key, ''
+        EZ_dvs = group_dvs.setdefault(worker, {})
+        EZ_dvs['EZ_drift' + suffix] = {'value': drift[i], 'valence': 'Pos'}
+        EZ_dvs['EZ_thresh' + suffix] = {'value': thresh[i], 'valence': 'Pos'}
+        EZ_dvs['EZ_non_decision' + suffix] = {'value': non_dec[i], 'valence': 'Neg'}
+    return group_dvs
+
+def EZ_diffusion(df, condition = None):
+    """ Calculate EZ diffusion parameters for one worker. See group_EZ_diffusion """
+    assert 'correct' in df.columns, 'Could not calculate EZ DDM'
+    df = df.assign(worker_id = 0)
+    return group_EZ_diffusion(df, condition, workers = [0]).get(0, {})
+
+class PreparedDDMData():
+    """ Trial data of a DDM fit stored as arrays
     
-    EZ_dvs = {}
-    # calculate EZ params for each condition
-    if condition:
-        conditions = df[condition].unique()
-        conditions = conditions[~pandas.isnull(conditions)]
-        for c in conditions:
-            subset = df[df[condition] == c]
-            pc = subset['correct'].mean()
-            # edge case correction using the fourth suggestion from 
-            # Stanislaw, H., & Todorov, N. (1999). Calculation of signal detection theory measures.
-            if pc == 1:
-                pc = 1-(.5/len(subset))
-            vrt = numpy.var(subset.query('correct == True')['rt'])
-            mrt = numpy.mean(subset.query('correct == True')['rt'])
-            try:
-                drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
-                EZ_dvs['EZ_drift_' + c] = {'value': drift, 'valence': 'Pos'}
-                EZ_dvs['EZ_thresh_' + c] = {'value': thresh, 'valence': 'Pos'}
-                EZ_dvs['EZ_non_decision_' + c] = {'value': non_dec, 'valence': 'Neg'}
-            except ValueError:
-                continue
-    else:
-        # calculate EZ params
+    Subjects are factorized into integer codes (in order of appearance, which
+    is the subj_idx order of the fit) and categorical regressors into codes 
+    with sorted levels, so the data is compact and the last level is the one 
+    dropped by Sum coding. Patsy design matrices are built once per formula. 
+    share() puts the arrays in shared memory for chain processes:
+    
+        prepared = PreparedDDMData(df, 'correct', ['condition'])
+        data = prepared.to_frame()
+        handle = prepared.share()
+    """
+    def __init__(self, df, response_col = 'correct', categorical_cols = [], parametric_cols = []):
+        """
+        Args:
+            df: trials with worker_id, rt (in ms), response_col and regressor columns
+            response_col: the column of correct/incorrect values
+            categorical_cols: categorical regressor columns
+            parametric_cols: parametric regressor columns
+        """
+        # remove missed responses and extremely short responses
+        rt = df['rt'].values/1000
+        keep = rt > .05
+        subj_idx, self.subj_ids = pandas.factorize(df['worker_id'].values[keep])
+        self.columns = OrderedDict([('subj_idx', subj_idx)])
+        self.categories = {}
+        for col in reversed(unique(parametric_cols + categorical_cols)):
+            values = df[col].values[keep]
+            if col in categorical_cols:
+                codes, levels = pandas.factorize(values, sort = True)
+                # signed codes, so missing values stay -1 (NaN in the Categorical)
+                self.columns[col] = codes.astype(numpy.min_scalar_type(-max(len(levels), 1)))
+                self.categories[col] = list(levels)
+            else:
+                self.columns[col] = values.astype(float)
+        self.columns['response'] = df[response_col].values[keep].astype(float)
+        self.columns['rt'] = rt[keep].astype(float)
+        self.designs = {}
+    
+    def to_frame(self):
+        """ The data as a dataframe, with categorical regressors as pandas 
+        Categoricals """
+        data = OrderedDict()
+        for col, values in self.columns.items():
+            if col in self.categories:
+                values = pandas.Categorical.from_codes(values, self.categories[col])
+            data[col] = values
+        return pandas.DataFrame(data)
+    
+    def get_design(self, formula):
+        """ Patsy design matrix of formula (i.e. 'v ~ C(condition, Sum)' or 
+        only its right hand side), built once """
+        rhs = formula.split('~', 1)[-1]
+        if rhs not in self.designs:
+            self.designs[rhs] = dmatrix(rhs, self.to_frame(), return_type = 'dataframe')
+        return self.designs[rhs]
+    
+    def share(self):
+        """ Copy the data to one shared memory block, returning a picklable 
+        SharedDDMData handle. Call its unlink method when done """
+        arrays = list(self.columns.values())
+        offsets = numpy.cumsum([0] + [array.nbytes for array in arrays])
+        block = SharedMemory(create = True, size = max(int(offsets[-1]), 1))
+        layout = []
+        for (col, array), offset in zip(self.columns.items(), offsets):
+            shared = numpy.ndarray(array.shape, array.dtype, buffer = block.buf, offset = offset)
+            shared[:] = array
+            layout.append((col, array.dtype.str, len(array), int(offset)))
+        return SharedDDMData(block, layout, self.categories)
+
+class SharedDDMData():
+    """ Handle of PreparedDDMData in shared memory. Pickling it only sends the
+    block name and layout, and to_frame reads the arrays from the block """
+    def __init__(self, block, layout, categories):
+        self.block = block
+        self.name = block.name
+        self.layout = layout
+        self.categories = categories
+    
+    def __getstate__(self):
+        return {'name': self.name, 'layout': self.layout, 'categories': self.categories}
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.block = None
+    
+    def to_frame(self):
+        """ Copy the data out of shared memory into a dataframe, like 
+        PreparedDDMData.to_frame """
+        block = self.block or SharedMemory(name = self.name)
         try:
-            pc = df['correct'].mean()
-            # edge case correct
-            if pc == 1:
-                pc = 1-(1.0/(2*len(df)))
-            vrt = numpy.var(df.query('correct == True')['rt'])
-            mrt = numpy.mean(df.query('correct == True')['rt'])
-            drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
-            EZ_dvs['EZ_drift'] = {'value': drift, 'valence': 'Pos'}
-            EZ_dvs['EZ_thresh'] = {'value': thresh, 'valence': 'Pos'}
-            EZ_dvs['EZ_non_decision'] = {'value': non_dec, 'valence': 'Neg'}
-        except ValueError:
-            return {}
-    return EZ_dvs
-
-def parallel_sample(db_name, hddm_fun, hddm_args, samples, burn, thin):
-        """ feed function into parallel to parallelize HDDM fits """
+            data = OrderedDict()
+            for col, dtype, length, offset in self.layout:
+                values = numpy.ndarray(length, dtype, buffer = block.buf, offset = offset).copy()
+                if col in self.categories:
+                    values = pandas.Categorical.from_codes(values, self.categories[col])
+                data[col] = values
+        finally:
+            if block is not self.block:
+                block.close()
+        return pandas.DataFrame(data)
+    
+    def unlink(self):
+        """ Free the shared memory. Only call from the process that created it """
+        self.block.close()
+        self.block.unlink()
+
+def wiener_log_density(rt, response, v, a, t, z = .5):
+    """ Vectorized log density of the Wiener first passage time distribution,
+    using the small or large time series of Navarro & Fuss (2009), whichever
+    converges faster, as HDDM does
+    
+    Args:
+        rt: response times (in seconds)
+        response: 1 for responses at the upper boundary (correct responses in
+            fit_HDDM's accuracy coding), 0 for the lower boundary
+        v: drift rate
+        a: threshold
+        t: non-decision time
+        z: relative starting point
+        
+    Returns:
+        log_density: array of log densities, -inf where rt <= t
+    """
+    rt, response, v, a, t, z = numpy.broadcast_arrays(*[numpy.asarray(x, dtype = float) 
+                                                         for x in (rt, response, v, a, t, z)])
+    # the density at the upper boundary is the density at the lower boundary
+    # with the drift and starting point reflected
+    upper = response == 1
+    v = numpy.where(upper, -v, v)
+    w = numpy.where(upper, 1-z, z)
+    with numpy.errstate(all = 'ignore'):
+        # normalized decision time
+        u = (rt - t)/a**2
+        valid = (u > 0) & (a > 0)
+        u = numpy.where(valid, u, 1)
+        # terms needed by each series for an error of 1e-7
+        small_terms = 2 + numpy.sqrt(-2*u*numpy.log(2*numpy.sqrt(2*numpy.pi*u)*1e-7))
+        large_terms = numpy.sqrt(-2*numpy.log(numpy.pi*u*1e-7)/(numpy.pi**2*u))
+        use_small = ~(large_terms < small_terms)
+        # evaluate each series only where it is used
+        series = numpy.empty(u.shape)
+        us, ws = u[use_small][:, None], w[use_small][:, None]
+        wk = ws + 2*numpy.arange(-SMALL_TIME_TERMS, SMALL_TIME_TERMS + 1)
+        series[use_small] = (wk*numpy.exp(-wk**2/(2*us))).sum(1)/numpy.sqrt(2*numpy.pi*us[:, 0]**3)
+        ul, wl = u[~use_small][:, None], w[~use_small][:, None]
+        k = numpy.arange(1, LARGE_TIME_TERMS + 1)
+        series[~use_small] = numpy.pi*(k*numpy.exp(-k**2*numpy.pi**2*ul/2)*numpy.sin(k*numpy.pi*wl)).sum(1)
+        log_density = numpy.log(numpy.maximum(series, 1e-300)) - v*a*w - v**2*(rt - t)/2 - 2*numpy.log(a)
+    return numpy.where(valid, log_density, -numpy.inf)
+
+def get_DDM_designs(data, formulas = None):
+    """ Design matrix of each DDM parameter
+    
+    Args:
+        data: PreparedDDMData, or a dataframe of trials
+        formulas: optional formula or list of formulas (i.e. 'v ~ C(condition, Sum)')
+        
+    Returns:
+        designs: dictionary of design dataframes for a, v and t. Columns are 
+            named like HDDM nodes without the subject suffix (i.e. v_Intercept,
+            or a for parameters without a formula, which have a column of ones).
+            Every trial has a row, which is NaN for trials patsy dropped for a
+            missing regressor
+    """
+    if isinstance(formulas, str):
+        formulas = [formulas]
+    formulas = {f.split('~')[0].strip(): f.split('~', 1)[1] for f in (formulas or [])}
+    if isinstance(data, PreparedDDMData):
+        get_design = data.get_design
+        n_trials = len(data.columns['rt'])
+        index = pandas.RangeIndex(n_trials)
+    else:
+        get_design = lambda formula: dmatrix(formula, data, return_type = 'dataframe')
+        n_trials = len(data)
+        index = data.index
+    designs = {}
+    for param in ['a', 'v', 't']:
+        if param in formulas:
+            design = get_design(formulas[param]).reindex(index)
+            designs[param] = pandas.DataFrame(design.values, columns = ['%s_%s' % (param, col) 
+                                                                        for col in design.columns])
+        else:
+            designs[param] = pandas.DataFrame({param: numpy.ones(n_trials)})
+    return designs
+
+def fit_ML_DDM(data, formulas = None, maxiter = None):
+    """ Fast per subject maximum likelihood DDM, an alternative to HDDM when
+    posteriors are not needed
+    
+    Each DDM parameter (a, v, t) is a linear function of the regressors of its
+    formula (using the same formulas and patsy coding as HDDMRegressor), and
+    the Wiener likelihood of every subject is maximized at once with
+    batch_fmin. Starting values are each subject's EZ diffusion estimates
+    
+    Args:
+        data: PreparedDDMData, or a dataframe with subj_idx (0 to number of 
+            subjects - 1), response, rt (in seconds) and regressor columns
+        formulas: optional formula or list of formulas (i.e. 'v ~ C(condition, Sum)').
+            Parameters without a formula are constant within subjects
+        maxiter: maximum number of simplex iterations, defaults to 200*params
+        
+    Returns:
+        estimates: dataframe indexed like HDDM subject nodes (i.e. 
+            v_Intercept_subj.0) with the estimate of each node in column mean
+            and the subject's negative log likelihood in column neg_ll, so it 
+            can be passed to get_HDDM_group_dvs in place of nodes_db
+    """
+    designs = get_DDM_designs(data, formulas)
+    if isinstance(data, PreparedDDMData):
+        data = pandas.DataFrame(data.columns, columns = ['subj_idx', 'response', 'rt'])
+    names = [name for param in ['a', 'v', 't'] for name in designs[param].columns]
+    intercepts = [[col.endswith('Intercept') or col == param for col in designs[param].columns]
+                  for param in ['a', 'v', 't']]
+    designs = [designs[param].values for param in ['a', 'v', 't']]
+    n_params = [design.shape[1] for design in designs]
+    # trials with a missing regressor are left out of the likelihood
+    complete = numpy.all([numpy.isfinite(design).all(1) for design in designs], 0)
+    # pad trials into (subjects, trials) arrays
+    subj = data.subj_idx.values.astype(int)
+    n_subjects = subj.max() + 1
+    counts = numpy.bincount(subj, minlength = n_subjects)
+    # position of each trial within its subject
+    order = numpy.argsort(subj, kind = 'stable')
+    position = numpy.empty(len(subj), dtype = int)
+    position[order] = numpy.arange(len(subj)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    mask = numpy.zeros((n_subjects, counts.max()), dtype = bool)
+    mask[subj, position] = complete
+    def pad(values, fill):
+        padded = numpy.full(mask.shape + values.shape[1:], fill, dtype = float)
+        padded[subj, position] = values
+        return padded
+    rt = pad(data.rt.values, 1)
+    response = pad(data.response.values, 1)
+    designs = [pad(numpy.nan_to_num(design), 0) for design in designs]
+    splits = numpy.cumsum(n_params)[:-1]
+    
+    def neg_ll(x):
+        a, v, t = [numpy.einsum('stp,sp->st', design, coefs)
+                   for design, coefs in zip(designs, numpy.split(x, splits, 1))]
+        log_density = wiener_log_density(rt, response, v, a, t)
+        total = numpy.where(mask, log_density, 0).sum(1)
+        return numpy.where(numpy.isfinite(total), -total, 1e10)
+    
+    # start at each subject's EZ estimates
+    stats = data.groupby('subj_idx').apply(lambda x: pandas.Series(
+        {'pc': x.response.mean(), 
+         'vrt': x.rt[x.response == 1].var(ddof = 0),
+         'mrt': x.rt[x.response == 1].mean(),
+         'min_rt': x.rt.min()})).reindex(range(n_subjects))
+    drift, thresh, non_dec = EZ(stats.pc.clip(upper = 1 - .5/counts), stats.vrt, stats.mrt)
+    drift = numpy.where(numpy.isfinite(drift), drift, 1)
+    thresh = numpy.where(numpy.isfinite(thresh) & (thresh > 0), thresh, 1.5)
+    non_dec = numpy.clip(numpy.nan_to_num(non_dec, nan = .2), .05, .9*stats.min_rt.values)
+    # the start value goes to the intercept, or every column of cell means designs
+    x0 = numpy.split(numpy.zeros((n_subjects, sum(n_params))), splits, 1)
+    for coefs, intercept, start in zip(x0, intercepts, [thresh, drift, non_dec]):
+        columns = intercept if any(intercept) else slice(None)
+        coefs[:, columns] = start[:, None]
+    x0 = numpy.concatenate(x0, 1)
+    xopt, fopt, converged = batch_fmin(neg_ll, x0, maxiter = maxiter, maxfun = maxiter)
+    if not converged.all():
+        print('ML DDM did not converge for %s of %s subjects' % ((~converged).sum(), n_subjects))
+    estimates = pandas.DataFrame({'mean': xopt.ravel(),
+                                  'neg_ll': numpy.repeat(fopt, len(names))},
+                                 index = ['%s_subj.%s' % (name, i) 
+                                          for i in range(n_subjects) for name in names])
+    return estimates
+
+def sample_wiener(v, a, t, model_index, rng = None, max_time = 5, step = .005):
+    """ Sample responses and response times of DDMs with an unbiased starting
+    point (as fit by fit_HDDM) by inverting their first passage time 
+    distributions, tabulated on a grid of decision times
+    
+    Args:
+        v, a, t: arrays of the drift, threshold and non-decision time of each model
+        model_index: integer array giving the model of each sample
+        rng: optional numpy random Generator
+        max_time: decision times are tabulated up to max_time seconds, and the
+            probability of longer decisions ignored
+        step: grid resolution (in seconds). Samples are uniform within a step
+        
+    Returns:
+        (rt, response): arrays shaped like model_index, with response 1 for the
+        upper boundary. Samples of models without a valid density are NaN
+    """
+    if rng is None:
+        rng = numpy.random.default_rng()
+    v, a, t = [numpy.asarray(x, dtype = float)[:, None] for x in (v, a, t)]
+    grid = numpy.arange(step/2, max_time, step)
+    # probability of each (boundary, decision time) bin, lower boundary first.
+    # With an unbiased starting point the upper boundary density is the lower 
+    # boundary density times exp(v*a)
+    log_lower = wiener_log_density(grid + t, 0, v, a, t)
+    pmf = numpy.exp(numpy.concatenate([log_lower, log_lower + v*a], 1))*step
+    cdf = numpy.cumsum(pmf, 1)
+    with numpy.errstate(invalid = 'ignore'):
+        cdf /= cdf[:, -1:]
+    # search every model's cdf at once, offsetting each model's cdf by its index
+    n_models, n_bins = cdf.shape
+    valid = numpy.isfinite(cdf[:, -1])
+    cdf = numpy.where(valid[:, None], cdf, 1)
+    model_index = numpy.asarray(model_index)
+    u = rng.random(model_index.shape)
+    bins = numpy.searchsorted((cdf + numpy.arange(n_models)[:, None]).ravel(), 
+                              (u + model_index).ravel()).reshape(model_index.shape)
+    bins = numpy.minimum(bins - model_index*n_bins, n_bins - 1)
+    response = (bins >= len(grid)).astype(float)
+    decision_time = (bins % len(grid) + rng.random(model_index.shape))*step
+    rt = t[model_index, 0] + decision_time
+    invalid = ~valid[model_index]
+    rt[invalid] = numpy.nan
+    response[invalid] = numpy.nan
+    return rt, response
+
+def get_predictive_stats(rt, response, quantiles):
+    """ Accuracy and correct response time quantiles of each column of
+    (trials, datasets) arrays of responses and response times """
+    correct_rt = numpy.where(response == 1, rt, numpy.nan)
+    with warnings.catch_warnings():
+        # datasets without correct responses have undefined quantiles
+        warnings.simplefilter('ignore', RuntimeWarning)
+        accuracy = numpy.nanmean(response, 0)
+        rt_quantiles = numpy.nanquantile(correct_rt, quantiles, 0)
+    return numpy.vstack([accuracy[None], rt_quantiles])
+
+def simulate_subject_stats(subjects, quantiles, seed, max_time, step):
+    """ Observed and posterior predictive statistics of a list of subjects, 
+    each a dictionary with the subject's trials (rt, response, group codes), 
+    parameter values of each trial and posterior draw (a, v, t arrays of shape
+    (trials, draws)) and group labels. Feed into Parallel """
+    rng = numpy.random.default_rng(seed)
+    stats = []
+    for subject in subjects:
+        # simulate each distinct parameter set once per draw
+        params = numpy.stack([subject['a'], subject['v'], subject['t']], 2)
+        n_trials, n_draws = params.shape[:2]
+        unique_params, inverse = numpy.unique(params.reshape(-1, 3), axis = 0, return_inverse = True)
+        a, v, t = unique_params.T
+        sim_rt, sim_response = sample_wiener(v, a, t, inverse.reshape(n_trials, n_draws), 
+                                             rng, max_time, step)
+        for code, label in enumerate(subject['labels']):
+            trials = subject['groups'] == code
+            observed = get_predictive_stats(subject['rt'][trials, None], 
+                                            subject['response'][trials, None], quantiles)[:, 0]
+            predicted = get_predictive_stats(sim_rt[trials], sim_response[trials], quantiles)
+            stats.append((subject['subj_id'], label, observed, predicted))
+    return stats
+
+def HDDM_posterior_predictive(df, traces, response_col = 'correct', 
+                              categorical_dict = {}, parametric_dict = {}, formulas = None,
+                              condition = None, draws = 100, quantiles = (.1, .3, .5, .7, .9),
+                              num_workers = 1, seed = None, max_time = 5, step = .005):
+    """ Posterior predictive check of a model fit by fit_HDDM
+    
+    For each posterior draw, a dataset with the design of the observed trials
+    is simulated (see sample_wiener) from the subject nodes in traces. The
+    accuracy and correct response time quantiles of each subject and condition
+    are compared to the posterior predictive distribution of these statistics.
+    Subjects are simulated in parallel
+    
+    Args:
+        df, response_col, categorical_dict, parametric_dict, formulas: as 
+            passed to fit_HDDM (or the task's HDDM function)
+        traces: traces of the fit, i.e. load_traces(outfile)
+        condition: optional list of columns defining conditions. Defaults to 
+            the categorical regressors
+        draws: number of posterior draws
+        quantiles: response time quantiles
+        num_workers: number of processes
+        seed: random seed
+        max_time, step: passed to sample_wiener
+        
+    Returns:
+        ppc: dataframe with a row per worker, condition and statistic (accuracy 
+            or rt_q plus the quantile) and columns observed, predicted (posterior
+            predictive mean), lower and upper (95% posterior predictive interval)
+            and outside (whether observed is outside the interval)
+    """
+    categorical_cols = unique(sum(categorical_dict.values(), []))
+    parametric_cols = unique(sum(parametric_dict.values(), []))
+    prepared = PreparedDDMData(df, response_col, categorical_cols, parametric_cols)
+    if formulas is None and len(categorical_cols + parametric_cols) > 0:
+        formulas = get_HDDM_formulas(categorical_dict, parametric_dict)
+    designs = get_DDM_designs(prepared, formulas)
+    data = prepared.to_frame()
+    if condition is None:
+        condition = categorical_cols
+    rng = numpy.random.default_rng(seed)
+    rows = rng.choice(len(traces), draws, replace = draws > len(traces))
+    # group codes and labels of the conditions
+    if len(condition) > 0:
+        groups, labels = pandas.MultiIndex.from_frame(data.loc[:, condition].astype(str)).factorize()
+        labels = [':'.join(label) for label in labels]
+    else:
+        groups, labels = numpy.zeros(len(data), dtype = int), ['all']
+    subjects = []
+    for i, subj_id in enumerate(prepared.subj_ids):
+        trials = numpy.flatnonzero(data.subj_idx.values == i)
+        subject = {'subj_id': subj_id,
+                   'rt': data.rt.values[trials],
+                   'response': data.response.values[trials]}
+        subj_groups = groups[trials]
+        present = numpy.unique(subj_groups)
+        subject['groups'] = numpy.searchsorted(present, subj_groups)
+        subject['labels'] = [labels[code] for code in present]
+        for param, design in designs.items():
+            nodes = ['%s_subj.%s' % (col, i) for col in design.columns]
+            coefs = traces.loc[:, nodes].values[rows]
+            subject[param] = design.values[trials].dot(coefs.T)
+        subjects.append(subject)
+    chunks = [subjects[i::num_workers] for i in range(num_workers)]
+    seeds = rng.integers(2**32, size = num_workers)
+    results = Parallel(n_jobs = num_workers)(delayed(simulate_subject_stats)(chunk, quantiles, chunk_seed, 
+                                                                             max_time, step)
+                                             for chunk, chunk_seed in zip(chunks, seeds))
+    stat_names = ['accuracy'] + ['rt_q%s' % q for q in quantiles]
+    ppc = []
+    for subj_id, label, observed, predicted in sum(results, []):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lower, upper = numpy.nanquantile(predicted, [.025, .975], 1)
+            mean = numpy.nanmean(predicted, 1)
+        for j, stat in enumerate(stat_names):
+            ppc.append({'worker_id': subj_id, 'condition': label, 'stat': stat, 
+                        'observed': observed[j], 'predicted': mean[j], 
+                        'lower': lower[j], 'upper': upper[j]})
+    ppc = pandas.DataFrame(ppc).set_index(['worker_id', 'condition', 'stat'])
+    ppc['outside'] = (ppc.observed < ppc.lower) | (ppc.observed > ppc.upper)
+    return ppc
+
+def gelman_rubin(chains):
+    """ Gelman-Rubin potential scale reduction factor (R-hat) of one node
+    
+    Args:
+        chains: (chains, samples) array of traces
+        
+    Returns:
+        rhat: ratio of the pooled to the within chain estimate of the posterior
+            standard deviation. Values near 1 indicate convergence
+    """
+    chains = numpy.asarray(chains, dtype=float)
+    n = chains.shape[1]
+    within = chains.var(1, ddof=1).mean()
+    between = chains.mean(1).var(ddof=1)
+    return numpy.sqrt(((n-1)/n*within + between)/within)
+
+def effective_sample_size(chains):
+    """ Effective sample size of one node across chains, using Geyer's initial
+    monotone sequence estimator of the autocorrelation time (as Stan does)
+    
+    Args:
+        chains: (chains, samples) array of traces
+        
+    Returns:
+        ess: number of independent samples with the same precision
+    """
+    chains = numpy.asarray(chains, dtype=float)
+    num_chains, n = chains.shape
+    centered = chains - chains.mean(1, keepdims=True)
+    # autocovariance of each chain, via FFT
+    size = 2**int(numpy.ceil(numpy.log2(2*n)))
+    transform = numpy.fft.rfft(centered, size, axis=1)
+    autocov = numpy.fft.irfft(transform*numpy.conj(transform), size, axis=1)[:, :n]/n
+    within = autocov[:, 0].mean()*n/(n-1)
+    between = chains.mean(1).var(ddof=1) if num_chains > 1 else 0
+    var_plus = (n-1)/n*within + between
+    rho = 1 - (within - autocov.mean(0))/var_plus
+    rho[0] = 1
+    # sums of consecutive pairs of autocorrelations, truncated at the first
+    # negative sum and made monotone
+    pairs = rho[:n - n%2:2] + rho[1::2]
+    negative = numpy.flatnonzero(pairs < 0)
+    if len(negative) > 0:
+        pairs = pairs[:negative[0]]
+    pairs = numpy.minimum.accumulate(pairs)
+    tau = -1 + 2*pairs.sum()
+    return num_chains*n/max(tau, 1/numpy.log10(num_chains*n))
+
+def get_db_traces(m, chain=-1):
+    """ Traces of every node tallied in the ram database of a sampled model
+
+    Args:
+        m: model sampled with db='ram'
+        chain: chain number, or None to concatenate all chains. Every call to
+            m.sample adds a chain to the database
+
+    Returns:
+        traces: dictionary of trace arrays by node name
+    """
+    return {name: trace.gettrace(chain=chain) for name, trace in m.mc.db._traces.items()}
+
+def set_single_chain(m, traces):
+    """ Replace the chains in the ram database of a sampled model with a single
+    chain, and recompute the posterior summary in its nodes_db from it
+
+    gen_stats summarizes every chain in the database, and get_traces reads
+    only the last one, so a model sampled in several calls to m.sample (or
+    with traces from other processes) is reset to one chain before either is used
+
+    Args:
+        m: model sampled with db='ram'
+        traces: dictionary of the full trace of every node in the database,
+            like get_db_traces
+    """
+    db = m.mc.db
+    for name, trace in db._traces.items():
+        trace._trace = {0: numpy.asarray(traces[name])}
+        trace._index = {0: len(trace._trace[0])}
+    db.trace_names = db.trace_names[:1]
+    db.chains = 1
+    m.gen_stats()
+
+def initialize_model(m, start_values=None, fix_group=False):
+    """ Set the starting point of a model before sampling
+    
+    Args:
+        m: model
+        start_values: optional posterior means of a previous fit by node name 
+            (i.e. the mean column of its nodes_db, or load_traces(outfile).mean()).
+            If given, group nodes start at these values and subject nodes at the
+            value of their group node, so the fit only needs a short burn in.
+            Otherwise starting values are found with find_starting_values
+        fix_group: if True (and start_values are given), group nodes are fixed
+            at their start values and only subject nodes are sampled
+    """
+    if start_values is None:
         # find a good starting point which helps with the convergence.
-        print('Running %s' % db_name)
-        m = hddm_fun(**hddm_args)
         m.find_starting_values()
-        m.sample(samples, burn=burn, thin=thin, dbname=db_name, db='pickle')
-        return m
+        return
+    start_values = dict(start_values)
+    stochastics = m.get_stochastics()
+    for name, node in stochastics.node.items():
+        # i.e. v_Intercept_subj.3 starts at v_Intercept, z_subj_trans.3 at z_trans
+        group_name = re.sub(r'_subj(.*)\.\d+$', r'\1', name)
+        if group_name in start_values:
+            node.value = start_values[group_name]
+    if fix_group:
+        # observed nodes are left out of the step methods and traces. They are
+        # also no longer stochastic in nodes_db, which get_traces and
+        # get_stochastics select on, as they have no trace
+        group_nodes = [name for name in stochastics.index
+                       if '_subj' not in name and name in start_values]
+        for name in group_nodes:
+            stochastics.node[name]._observed = True
+        m.nodes_db.loc[group_nodes, 'observed'] = True
+        m.nodes_db.loc[group_nodes, 'stochastic'] = False
+
+def run_chain(connection, hddm_fun, hddm_args, start_values=None, fix_group=False, seed=None):
+    """ Keep one chain of an HDDM model in this process, sampling on command. Run
+    as the target of a multiprocessing.Process, one per chain
+    
+    The model is created and initialized once (see initialize_model for 
+    start_values and fix_group) and the names of its stochastic nodes are sent 
+    back. Every (samples, burn, thin) command received on connection then 
+    continues the chain from its last state, and the traces of the new samples 
+    are sent back (see get_db_traces). A None command stops the chain
+    
+    Args:
+        connection: end of a multiprocessing.Pipe
+        hddm_fun: model class (i.e. hddm.HDDM)
+        hddm_args: arguments used to create the model. data may be a
+            SharedDDMData handle
+        seed: seed of numpy's random state, so chains differ when processes
+            are forked
+    """
+    numpy.random.seed(seed)
+    if isinstance(hddm_args['data'], SharedDDMData):
+        hddm_args = dict(hddm_args, data=hddm_args['data'].to_frame())
+    m = hddm_fun(**hddm_args)
+    initialize_model(m, start_values, fix_group)
+    connection.send(list(m.get_stochastics().index))
+    while True:
+        command = connection.recv()
+        if command is None:
+            break
+        samples, burn, thin = command
+        m.sample(samples, burn=burn, thin=thin, db='ram')
+        connection.send(get_db_traces(m))
+    connection.close()
+
+def sample_until_converged(hddm_fun, hddm_args, num_chains, burn, thin=1,
+                           max_samples=95000, check_interval=2000,
+                           rhat_threshold=1.01, min_ess=400, 
+                           start_values=None, fix_group=False):
+    """ Run chains of an HDDM model in parallel until they converge
+    
+    Every chain is kept in its own process (see run_chain). After burn in, every 
+    chain draws check_interval samples at a time. After each round, split-chain 
+    R-hat and effective sample size are computed for the group level nodes, and 
+    sampling stops once all R-hats are below rhat_threshold and all ESS are at 
+    least min_ess, or after max_samples
+    
+    Args:
+        hddm_fun: model class (i.e. hddm.HDDM)
+        hddm_args: arguments used to create the model. data may be a
+            SharedDDMData handle, which chains read from shared memory
+        num_chains: number of chains, each run in its own process
+        burn: burn in samples of each chain
+        thin: thin parameter passed to HDDM
+        max_samples: maximum number of samples of each chain, including burn in
+        check_interval: number of samples drawn by each chain between checks
+        rhat_threshold: convergence threshold of R-hat
+        min_ess: minimum effective sample size
+        start_values: optional start values of every chain (see initialize_model)
+        fix_group: whether to fix group nodes at start_values
+        
+    Returns:
+        (m, chain_traces, report): model with the traces of all chains pooled
+        in a single chain, list of dataframes with the traces of the
+        stochastic nodes of each chain, and a dictionary with the wall time, 
+        samples per chain, R-hat and ESS of each group node and whether the 
+        thresholds were met
+    """
+    tic = time.time()
+    seeds = numpy.random.randint(2**31, size=num_chains)
+    connections = []
+    processes = []
+    for seed in seeds:
+        connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_chain, 
+                                          args=(child_connection, hddm_fun, hddm_args,
+                                                start_values, fix_group, seed))
+        process.start()
+        child_connection.close()
+        connections.append(connection)
+        processes.append(process)
+
+    def receive(i):
+        try:
+            return connections[i].recv()
+        except EOFError:
+            raise RuntimeError('HDDM chain %s stopped unexpectedly' % i)
+
+    traces = [[] for _ in range(num_chains)]
+    samples_run = 0
+    try:
+        nodes = [receive(i) for i in range(num_chains)][0]
+        group_nodes = [node for node in nodes if '_subj' not in node]
+        # with fixed group nodes, diagnose the subject nodes
+        group_nodes = group_nodes or nodes
+        while True:
+            chain_burn = burn if samples_run == 0 else 0
+            n = min(check_interval, max_samples - burn - samples_run)
+            for connection in connections:
+                connection.send((n + chain_burn, chain_burn, thin))
+            for i, chain_traces in enumerate(traces):
+                chain_traces.append(receive(i))
+            samples_run += n
+            # diagnose group nodes, splitting every chain in half
+            stacked = numpy.stack([numpy.stack([numpy.concatenate([t[node] for t in chain_traces])
+                                                for node in group_nodes], 1)
+                                   for chain_traces in traces])
+            half = stacked.shape[1]//2
+            split = numpy.concatenate([stacked[:, :half], stacked[:, half:2*half]])
+            rhat = {node: gelman_rubin(split[:, :, i]) for i, node in enumerate(group_nodes)}
+            ess = {node: effective_sample_size(split[:, :, i]) for i, node in enumerate(group_nodes)}
+            converged = max(rhat.values()) < rhat_threshold and min(ess.values()) >= min_ess
+            print('%s samples per chain: max R-hat %.3f, min ESS %.0f' 
+                  % (samples_run, max(rhat.values()), min(ess.values())))
+            if converged or samples_run + burn >= max_samples:
+                break
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    else:
+        for connection in connections:
+            connection.send(None)
+    finally:
+        for process in processes:
+            process.join()
+    # concatenate the rounds of each chain
+    traces = [{name: numpy.concatenate([t[name] for t in chain_traces]) for name in chain_traces[0]}
+              for chain_traces in traces]
+    chain_traces = [pandas.DataFrame(OrderedDict((node, t[node]) for node in nodes)) for t in traces]
+    # pool the chains in one model, whose nodes_db summarizes the posterior.
+    # A single draw creates its database, which is then replaced
+    if isinstance(hddm_args['data'], SharedDDMData):
+        hddm_args = dict(hddm_args, data=hddm_args['data'].to_frame())
+    m = hddm_fun(**hddm_args)
+    if start_values is not None:
+        initialize_model(m, start_values, fix_group)
+    m.sample(1, db='ram')
+    set_single_chain(m, {name: numpy.concatenate([t[name] for t in traces]) for name in traces[0]})
+    report = {'wall_time': time.time() - tic,
+              'chains': num_chains,
+              'samples_per_chain': samples_run + burn,
+              'rhat': rhat,
+              'ess': ess,
+              'converged': converged}
+    print('Chains %s after %s samples per chain, %.1f s' 
+          % ('converged' if converged else 'did not converge', samples_run + burn, report['wall_time']))
+    return m, chain_traces, report
 
 def load_concat_models(models):
     """Concatenate traces of multiple identical models into a new
@@ -104,6 +852,237 @@ def load_model(empty_model, dbfile):
         m.load_db(loadfile[0], db='pickle')
         return m
 
+def load_traces(outfile, nodes=None, chains=None):
+    """ Load traces saved by fit_HDDM
+    
+    Args:
+        outfile: the outfile passed to fit_HDDM
+        nodes: optional list of node names (i.e. ['a', 'v_Intercept']). Only 
+            these nodes are read from disk
+        chains: optional list of chain numbers, defaults to all chains
+        
+    Returns:
+        traces: dataframe with a column per node, like get_traces
+    """
+    return TraceStore(outfile + '_traces').load(nodes, chains)
+
+def get_HDDM_cache_key(data, subj_ids, formulas, **sampler_args):
+    """ Content hash identifying an HDDM fit
+    
+    Args:
+        data: dataframe passed to hddm (after the subj_idx remap)
+        subj_ids: original subject ids, in subj_idx order
+        formulas: list of regression formulas, or None for a plain HDDM
+        sampler_args: sampler settings (samples, burn, thin...)
+        
+    Returns:
+        key: hex digest that changes whenever any of the arguments change
+    """
+    hasher = hashlib.sha256()
+    hasher.update(pandas.util.hash_pandas_object(data, index=True).values.tobytes())
+    spec = (list(data.columns), [str(t) for t in data.dtypes], [str(i) for i in subj_ids],
+            formulas, sorted(sampler_args.items()), hddm.__version__)
+    hasher.update(repr(spec).encode())
+    return hasher.hexdigest()
+
+def load_HDDM_cache(cache_dir, key):
+    """ Load the group_dvs of a cached HDDM fit, or None if there is no fit
+    stored under key """
+    path = os.path.join(cache_dir, key, 'group_dvs.pkl')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def save_HDDM_cache(cache_dir, key, nodes_db, chain_traces, group_dvs):
+    """ Store the posterior summary (nodes_db), traces (a list of dataframes, one 
+    per chain, stored in a TraceStore) and group_dvs of an HDDM fit under key. 
+    group_dvs is written last, so a fit is only found by load_HDDM_cache 
+    once all of it is stored
+    """
+    fit_dir = os.path.join(cache_dir, key)
+    os.makedirs(fit_dir, exist_ok=True)
+    nodes_db.to_pickle(os.path.join(fit_dir, 'nodes_db.pkl'))
+    store = TraceStore(os.path.join(fit_dir, 'traces'), overwrite=True)
+    for traces in chain_traces:
+        store.append_chain(traces)
+    tmp_path = os.path.join(fit_dir, 'group_dvs.pkl.tmp')
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(group_dvs, f)
+    os.replace(tmp_path, os.path.join(fit_dir, 'group_dvs.pkl'))
+
+def sample_with_checkpoints(m, samples, burn, thin, checkpoint_path, checkpoint_interval=5000,
+                            start_values=None, fix_group=False):
+    """ Sample an HDDM model in chunks, writing a checkpoint after each one, and 
+    resume from the checkpoint at checkpoint_path if there is one
+    
+    The traces of each chunk are appended to a TraceStore at checkpoint_path
+    + '_traces', and the checkpoint itself only stores the current value of 
+    every stochastic node, the number of samples and chunks run and numpy's 
+    random state. It is written through a temporary file, so an interrupted 
+    write leaves the last checkpoint intact
+    
+    Args:
+        m: model, as created
+        samples: total number of samples, including burn in
+        burn: burn in samples, dropped from the traces
+        thin: thin parameter passed to HDDM
+        checkpoint_path: checkpoint file
+        checkpoint_interval: number of samples between checkpoints
+        start_values: optional start values (see initialize_model)
+        fix_group: whether to fix group nodes at start_values
+        
+    Returns:
+        m: the model, with the traces of all chunks in a single chain
+    """
+    checkpoint = None
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'rb') as f:
+            checkpoint = pickle.load(f)
+    if checkpoint is None:
+        initialize_model(m, start_values, fix_group)
+        checkpoint = {'samples_run': 0, 'chunks': 0}
+        store = TraceStore(checkpoint_path + '_traces', overwrite=True)
+    else:
+        if start_values is not None:
+            # the checkpoint holds the state to resume from, so starting values
+            # are not searched for. Given start values still fix group nodes
+            initialize_model(m, start_values, fix_group)
+        # drop chunks stored after the last checkpoint was written
+        store = TraceStore(checkpoint_path + '_traces')
+        store.truncate(checkpoint['chunks'])
+    stochastics = list(m.get_stochastics().node)
+    if checkpoint['samples_run'] > 0:
+        for node in stochastics:
+            node.value = checkpoint['values'][node.__name__]
+        numpy.random.set_state(checkpoint['random_state'])
+        print('Resuming from checkpoint after %s samples' % checkpoint['samples_run'])
+    while checkpoint['samples_run'] < samples:
+        chunk_burn = burn if checkpoint['samples_run'] == 0 else 0
+        n = min(checkpoint_interval + chunk_burn, samples - checkpoint['samples_run'])
+        m.sample(n, burn=chunk_burn, thin=thin, db='ram')
+        # each call to sample adds a chain to the database
+        store.append_chain(pandas.DataFrame(get_db_traces(m)))
+        checkpoint['chunks'] += 1
+        checkpoint['samples_run'] += n
+        checkpoint['values'] = {node.__name__: node.value for node in stochastics}
+        checkpoint['random_state'] = numpy.random.get_state()
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(checkpoint, f)
+        os.replace(tmp_path, checkpoint_path)
+    # put the traces of all chunks into a single chain
+    set_single_chain(m, store.load())
+    return m
+
+def parse_HDDM_nodes(nodes_db):
+    """ Parse the names of the subject nodes of an HDDM model into a table
+    
+    Subject nodes are named param[_term]_subj.N, where a regression term is
+    Intercept, a parametric regressor (i.e. load), a categorical level (i.e.
+    C(condition, Sum)[S.congruent]) or an interaction of these joined by ':'
+    
+    Args:
+        nodes_db: the model's nodes_db
+        
+    Returns:
+        nodes: dataframe with a row per subject node and columns param, term 
+            ('Intercept' for the base parameter), columns (tuple of the 
+            regressor columns of the term), levels (tuple of the term's levels,
+            the column for parametric regressors), subj (subject index) and mean
+    """
+    names = nodes_db.index.to_series()
+    nodes = names.str.extract(r'^([avtz])(?:_(.+))?_subj\.(\d+)$')
+    nodes.columns = ['param', 'term', 'subj']
+    nodes = nodes.dropna(subset=['param'])
+    nodes['term'] = nodes.term.fillna('Intercept')
+    nodes['subj'] = nodes.subj.astype(int)
+    nodes['mean'] = nodes_db.loc[nodes.index, 'mean'].astype(float)
+    # parse each distinct term once
+    categorical = re.compile(r'^C\((\w+),\s*Sum\)\[(?:S\.)?(.+)\]$')
+    parsed_terms = {'Intercept': ((), ())}
+    for term in set(nodes.term) - {'Intercept'}:
+        parts = [categorical.match(part) for part in term.split(':')]
+        columns = tuple(part.group(1) if part else name 
+                        for part, name in zip(parts, term.split(':')))
+        levels = tuple(part.group(2) if part else name 
+                       for part, name in zip(parts, term.split(':')))
+        parsed_terms[term] = (columns, levels)
+    nodes['columns'] = [parsed_terms[term][0] for term in nodes.term]
+    nodes['levels'] = [parsed_terms[term][1] for term in nodes.term]
+    return nodes
+
+def get_HDDM_group_dvs(nodes_db, subj_ids, categorical_cols, dropped_vals):
+    """ Extract the subject DVs of a fit HDDM model
+    
+    DVs are the posterior means of the base threshold, drift and non-decision
+    time (or their intercepts), of every main effect, and of every interaction.
+    With Sum coding the level dropped from each categorical regressor is minus
+    the sum of the others
+    
+    Args:
+        nodes_db: the model's nodes_db
+        subj_ids: original subject ids, in subj_idx order
+        categorical_cols: categorical regressor columns
+        dropped_vals: level dropped from each categorical column
+        
+    Returns:
+        group_dvs: dictionary of DVs per subject
+    """
+    variable_conversion = {'a': ('thresh', 'Pos'), 'v': ('drift', 'Pos'), 't': ('non_decision', 'NA')}
+    nodes = parse_HDDM_nodes(nodes_db)
+    nodes = nodes[nodes.param.isin(list(variable_conversion.keys()))]
+    n_effects = nodes['columns'].map(len)
+    nodes['name'] = nodes.levels.map(':'.join)
+    # levels dropped by Sum coding
+    dropped_dict = dict(zip(categorical_cols, [str(v) for v in dropped_vals]))
+    main = nodes[n_effects == 1]
+    main_col = main['columns'].map(lambda c: c[0])
+    sum_coded = main[main_col.isin(dropped_dict.keys())]
+    dropped = -sum_coded.groupby(['param', main_col[sum_coded.index], 'subj'])['mean'].sum()
+    dropped = dropped.reset_index()
+    dropped.columns = ['param', 'column', 'subj', 'mean']
+    dropped['name'] = dropped.column.map(dropped_dict)
+    dv_nodes = pandas.concat([nodes[n_effects == 0].assign(name=''),
+                              main,
+                              dropped,
+                              nodes[n_effects > 1]])
+    # one column per DV, one row per subject
+    dv_nodes['dv'] = [('hddm_' + variable_conversion[param][0] + ('_' + name if name else ''), param)
+                      for param, name in zip(dv_nodes.param, dv_nodes.name)]
+    dv_order = {'a': 0, 'v': 1, 't': 2}
+    dv_nodes['order'] = dv_nodes.param.map(dv_order)
+    dv_nodes = dv_nodes.sort_values('order', kind='stable')
+    values = dv_nodes.pivot_table(index='subj', columns='dv', values='mean', sort=False)
+    values = values.reindex(range(len(subj_ids)))
+    group_dvs = {}
+    for subj, row in zip(subj_ids, values.itertuples(index=False)):
+        group_dvs[subj] = {dv: {'value': value, 'valence': variable_conversion[param][1]}
+                           for (dv, param), value in zip(values.columns, row)}
+    return group_dvs
+
+def get_HDDM_formulas(categorical_dict={}, parametric_dict={}):
+    """ Regression formulas of fit_HDDM's categorical and parametric regressors,
+    i.e. {'v': ['condition']} gives ['v ~ C(condition, Sum)'] """
+    formulas = []
+    # iterate through formula cols
+    for ddm_var in ['a','t','v','z']:
+        formula = ''
+        cat_cols = categorical_dict.get(ddm_var, [])
+        if len(cat_cols) > 0:
+            regressor = 'C(' + ', Sum)+C('.join(cat_cols) + ', Sum)'
+            formula = '%s ~ %s' % (ddm_var, regressor)
+        par_cols = parametric_dict.get(ddm_var, [])
+        if len(par_cols) > 0:
+            regressor = ' + '.join(par_cols)
+            if formula == '':
+                formula = '%s ~ %s' % (ddm_var, regressor)
+            else:
+                formula += ' + ' + regressor
+        if formula != '':
+            formulas.append(formula)
+    return formulas
+
 def fit_HDDM(df, 
              response_col = 'correct', 
              categorical_dict = {}, 
@@ -114,7 +1093,17 @@ def fit_HDDM(df,
              burn=15000,
              thin=1, 
              parallel=False,
-             num_cores=None):
+             num_cores=None,
+             check_interval=2000,
+             rhat_threshold=1.01,
+             min_ess=400,
+             cache_dir=None,
+             checkpoint_dir=None,
+             checkpoint_interval=5000,
+             method='hddm',
+             start_values=None,
+             fix_group=False,
+             warm_burn=2000):
     """ wrapper to run hddm analysis
     
     Args:
@@ -127,7 +1116,8 @@ def fit_HDDM(df,
             if categorical_dict = [{'v': ['condition1']}] then a regression will be 
             run of the form: "v ~ C(condition1, Sum)"
         formulas: (optional) if given overrides automatic formulas
-        outfile: if given, models will be saved to this location
+        outfile: if given, the empty model will be saved to outfile_empty.model
+            and the traces to a TraceStore at outfile_traces (see load_traces)
         db_loc: optional. If running locally, this option is unnecessary. If
             running in a container, however, the database location for each model
             needs to be changed to the local save location of the models. Thus
@@ -135,40 +1125,82 @@ def fit_HDDM(df,
         samples: number of samples to run HDDM
         burn: burn in time for HDDM
         thin: thin parameter passed to HDDM
-        parallel: whether to run HDDM in parallel. If run in parallel, the final
-            model will still have at least the original final number of samples: 
-                (samples-burn)/thin
+        parallel: whether to run HDDM in parallel. If run in parallel, one chain
+            is run on each core until the chains converge (see 
+            sample_until_converged), with at most samples per chain
         num_cores: the number of cores to use for parallelization. If not set will
             use all cores
+        check_interval: when run in parallel, number of samples each chain draws
+            between convergence checks
+        rhat_threshold: when run in parallel, R-hat every group node must be
+            below to stop sampling
+        min_ess: when run in parallel, effective sample size every group node
+            must reach to stop sampling
+        cache_dir: optional directory of fit results. Fits are keyed by the
+            data, formulas and sampler settings, and if the same fit was run
+            before its group_dvs are returned without sampling
+        checkpoint_dir: optional directory of sampling checkpoints. If given 
+            (and not run in parallel), a checkpoint is written every 
+            checkpoint_interval samples and an interrupted fit resumes from it
+            (see sample_with_checkpoints)
+        checkpoint_interval: number of samples between checkpoints
+        method: 'hddm' to fit the hierarchical model, or 'ml' for the fast per
+            subject maximum likelihood fit of the same design (see fit_ML_DDM),
+            which returns DVs with the same names. Sampling arguments are
+            ignored by the ml method
+        start_values: optional posterior means of a previous fit of the task by
+            node name (i.e. load_traces(outfile).mean()). If given, the fit is
+            warm started from them (see initialize_model) with a burn in of 
+            warm_burn, i.e. to add new subjects to a fit
+        fix_group: if True (and start_values are given), group nodes are fixed
+            at start_values and only subject nodes are sampled, keeping new
+            estimates on the scale of the previous fit
+        warm_burn: burn in used instead of burn when start_values are given
     """  
-    variable_conversion = {'a': ('thresh', 'Pos'), 'v': ('drift', 'Pos'), 't': ('non_decision', 'NA')}
-    db = None
-    extra_cols = []
     categorical_cols = []
     parametric_cols = []
-    # set up data
-    data = (df.loc[:,'rt']/1000).astype(float).to_frame()
-    data.insert(0, 'response', df[response_col].astype(float))
     for var in ['a','t','v','z']:
         parametric_cols += parametric_dict.get(var, [])
         categorical_cols += categorical_dict.get(var, [])
     categorical_cols = unique(categorical_cols)
     parametric_cols = unique(parametric_cols)
-    extra_cols = parametric_cols + categorical_cols
-    extra_cols = unique(extra_cols)
-    for col in extra_cols:
-        data.insert(0, col, df[col])
+    extra_cols = unique(parametric_cols + categorical_cols)
+    # set up data, with subject and categorical codes
+    prepared = PreparedDDMData(df, response_col, categorical_cols, parametric_cols)
+    data = prepared.to_frame()
+    subj_ids = prepared.subj_ids
     # state cols dropped when using deviance coding
-    dropped_vals = [sorted(data[col].unique())[-1] for col in categorical_cols]
-    # add subject ids 
-    data.insert(0,'subj_idx', df['worker_id'])
-    # remove missed responses and extremely short response
-    data = data.query('rt > .05')
-    subj_ids = data.subj_idx.unique()
-    ids = {subj_ids[i]:int(i) for i in range(len(subj_ids))}
-    data.replace(subj_ids, [ids[i] for i in subj_ids],inplace = True)
-    if outfile:
-        db = outfile + '_traces.db'
+    dropped_vals = [prepared.categories[col][-1] for col in categorical_cols]
+    if parallel and num_cores is None:
+        num_cores = multiprocessing.cpu_count()
+    if len(extra_cols) == 0:
+        formulas = None
+    # if no explicit formulas have been set, create them
+    elif formulas is None:
+        formulas = get_HDDM_formulas(categorical_dict, parametric_dict)
+    if method == 'ml':
+        estimates = fit_ML_DDM(prepared, formulas)
+        return get_HDDM_group_dvs(estimates, subj_ids, categorical_cols, dropped_vals)
+    if start_values is not None:
+        start_values = start_values['mean'] if isinstance(start_values, pandas.DataFrame) else start_values
+        start_values = dict(start_values)
+        burn = warm_burn
+    # the key identifies this fit for the cache and checkpoints
+    if cache_dir or checkpoint_dir:
+        convergence_args = {'num_cores': num_cores, 'check_interval': check_interval,
+                            'rhat_threshold': rhat_threshold, 'min_ess': min_ess} if parallel else {}
+        if start_values is not None:
+            convergence_args.update({'start_values': sorted(start_values.items()), 
+                                     'fix_group': fix_group})
+        cache_key = get_HDDM_cache_key(data, subj_ids, formulas, samples=samples, 
+                                       burn=burn, thin=thin, parallel=parallel,
+                                       **convergence_args)
+    # return cached results if this fit has been run before
+    if cache_dir:
+        group_dvs = load_HDDM_cache(cache_dir, cache_key)
+        if group_dvs is not None:
+            print('Loaded cached HDDM fit %s' % cache_key)
+            return group_dvs
     # run if estimating variables for the whole task
     if len(extra_cols) == 0:
         if parallel:
@@ -176,27 +1208,6 @@ def fit_HDDM(df,
             hddm_args = {'data': data}
         m = hddm.HDDM(data)
     else:
-        # if no explicit formulas have been set, create them
-        if formulas is None:
-            formulas = []
-            # iterate through formula cols
-            for ddm_var in ['a','t','v','z']:
-                formula = ''
-                cat_cols = categorical_dict.get(ddm_var, [])
-                if len(cat_cols) > 0:
-                    regressor = 'C(' + ', Sum)+C('.join(cat_cols) + ', Sum)'
-                    formula = '%s ~ %s' % (ddm_var, regressor)
-                par_cols = parametric_dict.get(ddm_var, [])
-                if len(par_cols) > 0:
-                    regressor = ' + '.join(par_cols)
-                    if formula == '':
-                        formula = '%s ~ %s' % (ddm_var, regressor)
-                    else:
-                        formula += ' + ' + regressor
-                if formula != '':
-                    formulas.append(formula)
-
-                
         if parallel == True:
             hddm_fun = hddm.models.HDDMRegressor
             hddm_args = {'data': data,
@@ -211,120 +1222,43 @@ def fit_HDDM(df,
         m.save(empty_path)
     # run model
     if parallel==True:
-        if num_cores is None:
-            num_cores = multiprocessing.cpu_count()
         assert outfile is not None, "Outfile must be specified to parallelize"
-        # create folder for parallel traces
-        parallel_dir = outfile + '_parallel_output'
-        num_parallel_dirs = len(glob(parallel_dir+'*'))
-        if num_parallel_dirs > 0:
-            parallel_dir += '_%s' % str(num_parallel_dirs+1)
-        os.makedirs(parallel_dir, exist_ok=True)
-        # set db names
-        dbs = [db[:-3]+'%s.db' % i for i in range(1,num_cores+1)]
-        dbs = [os.path.join(parallel_dir, os.path.basename(i)) for i in dbs]
-        # set sample number for parallel run
-        parallel_samples = ceil((samples-burn)/num_cores)+burn
-        print('Parallelizing using %s cores. %s samples each' % (str(num_cores), str(parallel_samples)))
-        # run models
-        results = Parallel(n_jobs=num_cores)(delayed(parallel_sample)(i, hddm_fun, hddm_args, parallel_samples, burn, thin) for i in dbs)
-        print('Separate Models Run, Concatenating...')
-        m = kabuki.utils.concat_models(results)   
-        print('Finished Concatenating')      
+        print('Parallelizing using %s chains, up to %s samples each' % (str(num_cores), str(samples)))
+        # run chains until convergence, sharing the data with the chains
+        hddm_args['data'] = prepared.share()
+        try:
+            m, chain_traces, report = sample_until_converged(hddm_fun, hddm_args, num_cores, burn, thin,
+                                                        max_samples=samples, 
+                                                        check_interval=check_interval,
+                                                        rhat_threshold=rhat_threshold,
+                                                        min_ess=min_ess,
+                                                        start_values=start_values,
+                                                        fix_group=fix_group)
+        finally:
+            hddm_args['data'].unlink()
+        pickle.dump(report, open(outfile + '_convergence_report.pkl', 'wb'))
+    elif checkpoint_dir:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        checkpoint_path = os.path.join(checkpoint_dir, cache_key + '.checkpoint')
+        m = sample_with_checkpoints(m, samples, burn, thin, checkpoint_path, 
+                                    checkpoint_interval, start_values, fix_group)
+        chain_traces = [m.get_traces()]
     else:
-        # find a good starting point which helps with the convergence.
-        m.find_starting_values()
-        m.sample(samples, burn=burn, thin=thin, dbname=db, db='pickle')
+        initialize_model(m, start_values, fix_group)
+        m.sample(samples, burn=burn, thin=thin, db='ram')
+        chain_traces = [m.get_traces()]
     if outfile:
+        # store traces, one chain per parallel process
         try:
-            if parallel==True:
-                for i, sub_m in enumerate(results):
-                    base = os.path.basename(outfile) + '_%s.model' % str(i+1)
-                    save_loc = os.path.join(parallel_dir, base)
-                    pickle.dump(sub_m, open(save_loc, 'wb'))
-            else:
-                pickle.dump(m, open(outfile + '.model', 'wb'))
+            store = TraceStore(outfile + '_traces', overwrite=True)
+            for traces in chain_traces:
+                store.append_chain(traces)
         except Exception:
-            print('Saving model failed')
-            
-    # get average ddm params
-    # regex match to find the correct rows
-    dvs = {}
-    for var in ['a','v','t']:
-        match = '^'+var+'(_subj|_Intercept_subj)'
-        dvs[var] = m.nodes_db.filter(regex=match, axis=0)['mean']
-    
-    # output of regression (no interactions)
-    condition_dvs = {}
-    for ddm_var in ['a','v','t']:
-        var_dvs = {}
-        # add categorical ddm vars
-        for col, dropped in zip(categorical_cols, dropped_vals):
-            col_dvs = {}
-            included_vals = [i for i in data[col].unique() if i != dropped]
-            for val in included_vals:
-                # regex match to find correct rows
-                match='^'+ddm_var+'.*S.'+str(val)+']_subj' 
-                # get the individual diff values and convert to list
-                ddm_vals = m.nodes_db.filter(regex=match, axis=0).filter(regex=not_regex(':'), axis=0)['mean'].tolist()
-                if len(ddm_vals) > 0:
-                    col_dvs[val] = ddm_vals
-            if len(col_dvs.keys()) > 0:
-                # construct dropped dvs
-                dropped_dvs = []
-                for vs in zip(*col_dvs.values()):
-                    dropped_dvs.append(-1*sum(vs))
-                col_dvs[dropped] = dropped_dvs
-            var_dvs.update(col_dvs)
-        # add parametric ddm vars
-        for col in parametric_cols:
-            col_dvs = {}
-            # regex match to find correct rows
-            match='^'+ddm_var+'_'+col+'_subj' 
-            # get the individual diff values and convert to list
-            ddm_vals = m.nodes_db.filter(regex=match, axis=0).filter(regex=not_regex(':'), axis=0)['mean'].tolist()
-            if len(ddm_vals) > 0:
-                col_dvs[col] = ddm_vals
-            var_dvs.update(col_dvs)
-        if len(var_dvs)>0:
-            condition_dvs[ddm_var] = var_dvs
-            
-    # interaction
-    interaction_dvs = {}
-    all_levels = []
-    for col in extra_cols:
-        all_levels += list(data.loc[:,col].unique())
-    for ddm_var in ['a','v','t']:
-        var_dvs = {}
-        for x, y in itertools.permutations(all_levels,2):
-            # regex match to find correct rows
-            match='^'+ddm_var+'.*'+str(x)+'].*:.*'+str(y)+']_subj'
-            # get the individual diff values and convert to list
-            ddm_vals = m.nodes_db.filter(regex=match, axis=0)['mean'].tolist()
-            if len(ddm_vals) > 0:
-                var_dvs['%s:%s' % (str(x), str(y))] = ddm_vals
-        if len(var_dvs) > 0:
-            interaction_dvs[ddm_var] = var_dvs
-    
-    group_dvs = {}
-    # create output ddm dict
-    for i,subj in enumerate(subj_ids):
-        group_dvs[subj] = {}
-        hddm_vals = {}
-        for var in ['a','v','t']:
-            var_name, var_valence = variable_conversion[var]
-            if var in list(dvs.keys()):
-                hddm_vals.update({'hddm_' + var_name: {'value': dvs[var][i], 'valence': var_valence}})
-            if var in condition_dvs.keys():
-                for k,v in condition_dvs[var].items():
-                    tmp = {'value': v[i], 'valence': var_valence}
-                    hddm_vals.update({'hddm_'+var_name+'_'+str(k): tmp})
-            if var in interaction_dvs.keys():
-                for k,v in interaction_dvs[var].items():
-                    tmp = {'value': v[i], 'valence': var_valence}
-                    hddm_vals.update({'hddm_'+var_name+'_'+k: tmp})
-        group_dvs[subj].update(hddm_vals)
+            print('Saving traces failed')
             
+    group_dvs = get_HDDM_group_dvs(m.nodes_db, subj_ids, categorical_cols, dropped_vals)
+    if cache_dir:
+        save_HDDM_cache(cache_dir, cache_key, m.nodes_db, chain_traces, group_dvs)
     return group_dvs
 
 def ANT_HDDM(df,  **kwargs):
@@ -357,41 +1291,77 @@ def DPX_HDDM(df,  **kwargs):
                           **kwargs)
     return group_dvs
 
+def timed_fit_HDDM(df, **kwargs):
+    """ fit_HDDM returning (group_dvs, wall time in seconds). Feed into Parallel """
+    tic = time.time()
+    group_dvs = fit_HDDM(df, **kwargs)
+    return group_dvs, time.time() - tic
+
+def fit_HDDM_models(models, num_workers=None, **kwargs):
+    """ Fit several HDDM models concurrently, each in its own process
+    
+    Args:
+        models: ordered dictionary of (df, fit_HDDM arguments) tuples by model 
+            name, i.e. {'proactive': (df, {'categorical_dict': {'v': ['critical_key']}})}
+        num_workers: number of models fit at once, defaults to one per model
+        kwargs: fit_HDDM arguments shared by all models. outfile, if given, is
+            suffixed with each model's name so models do not overwrite each other
+            
+    Returns:
+        (results, times): dictionaries of the group_dvs and the wall time (in 
+        seconds) of each model
+    """
+    if num_workers is None:
+        num_workers = len(models)
+    jobs = []
+    for name, (df, model_kwargs) in models.items():
+        fit_kwargs = dict(kwargs, **model_kwargs)
+        if fit_kwargs.get('outfile'):
+            fit_kwargs['outfile'] = '%s_%s' % (fit_kwargs['outfile'], name)
+        jobs.append(delayed(timed_fit_HDDM)(df, **fit_kwargs))
+    fits = Parallel(n_jobs=num_workers)(jobs)
+    results = {name: fit[0] for name, fit in zip(models, fits)}
+    times = {name: fit[1] for name, fit in zip(models, fits)}
+    for name, seconds in times.items():
+        print('Fit %s HDDM in %.1f s' % (name, seconds))
+    return results, times
+
 def motor_SS_HDDM(df, mode='proactive', **kwargs):
-    df = df.copy()
+    """ HDDM of the motor selective stop signal task
+    
+    Args:
+        df: task dataframe
+        mode: 'proactive' (drift by critical key on go trials), 'reactive' 
+            (drift by condition on non-critical, non-stop trials), or 'both'
+            (or a list of modes). Several modes are fit concurrently with 
+            fit_HDDM_models, and their DVs merged, with the proactive model's
+            base threshold, drift and non-decision time
+        kwargs: passed to fit_HDDM
+    """
+    modes = ['proactive', 'reactive'] if mode == 'both' else mode
+    if isinstance(modes, str):
+        modes = [modes]
+    # prepare the frame shared by all modes once
     critical_key = (df.correct_response == df.stop_response).map({True: 'critical', False: 'non-critical'})
-    df.insert(0, 'critical_key', critical_key)
-    if mode == 'proactive':
+    df = df.assign(critical_key=critical_key).query('exp_stage not in ["practice","NoSS_practice"]')
+    mode_models = {
         # proactive control
-        df = df.query('SS_trial_type == "go" and \
-                     exp_stage not in ["practice","NoSS_practice"]')
-        group_dvs = fit_HDDM(df, 
-                             categorical_dict = {'v': ['critical_key']},
-                             **kwargs)
-    elif mode == 'reactive':
+        'proactive': lambda: (df.query('SS_trial_type == "go"'),
+                              {'categorical_dict': {'v': ['critical_key']}}),
         # reactive control
-        df = df.query('condition != "stop" and critical_key == "non-critical" and \
-                        exp_stage not in ["practice","NoSS_practice"]')
-        group_dvs = fit_HDDM(df, 
-                             categorical_dict = {'v': ['condition']},
-                             **kwargs)
-    elif mode == 'both':
-        pdf = df.query('SS_trial_type == "go" and \
-                 exp_stage not in ["practice","NoSS_practice"]')
-        pgroup_dvs = fit_HDDM(pdf, 
-                         categorical_dict = {'v': ['critical_key']},
-                         **kwargs)
-        # reactive control
-        rdf = df.query('condition != "stop" and critical_key == "non-critical" and \
-                        exp_stage not in ["practice","NoSS_practice"]')
-        rgroup_dvs = fit_HDDM(rdf, 
-                             categorical_dict = {'v': ['condition']},
-                             **kwargs)
-        # this ends up using the pgroup_dvs for the base threshold, drift and non-decision time
-        group_dvs = rgroup_dvs
-        for key, value in group_dvs.items():
-            value.update(pgroup_dvs[key])
-
+        'reactive': lambda: (df.query('condition != "stop" and critical_key == "non-critical"'),
+                             {'categorical_dict': {'v': ['condition']}})
+        }
+    models = OrderedDict((m, mode_models[m]()) for m in modes)
+    if len(models) == 1:
+        model_df, model_kwargs = models[modes[0]]
+        return fit_HDDM(model_df, **dict(kwargs, **model_kwargs))
+    results, times = fit_HDDM_models(models, **kwargs)
+    # this ends up using the proactive dvs for the base threshold, drift and non-decision time
+    group_dvs = {}
+    for m in sorted(modes, key=lambda m: m == 'proactive'):
+        for subj, dvs in results[m].items():
+            group_dvs.setdefault(subj, {}).update(dvs)
     return group_dvs
 
 
@@ -466,12 +1436,15 @@ def twobytwo_HDDM(df, **kwargs):
 
 
 def get_HDDM_fun(task=None, kwargs=None):
-    if kwargs is None:
-        kwargs = {}
+    # copy kwargs, which may be shared with other tasks' group functions
+    kwargs = dict(kwargs or {})
     if 'outfile' not in kwargs:
         kwargs['outfile']=task
     # remove unique kwargs
     mode = kwargs.pop('mode', 'proactive')
+    # remove kwargs of other group functions (i.e. get_twostage_glm)
+    for key in ['backend', 'glmer_pool']:
+        kwargs.pop(key, None)
     hddm_fun_dict = \
     {
         'adaptive_n_back': lambda df: fit_HDDM(df.query('exp_stage == "adaptive"'), 
@@ -505,4 +1478,112 @@ def get_HDDM_fun(task=None, kwargs=None):
     if task is None:
         return hddm_fun_dict
     else:
-        return hddm_fun_dict[task]
\ No newline at end of file
+        return hddm_fun_dict[task]
+
+def run_HDDM_job(queue_dir, name):
+    """ Run one job of an HDDMJobQueue, storing its group_dvs in the queue's
+    results. Feed into Parallel to run jobs concurrently
+    
+    Returns:
+        error: None if the job finished, otherwise the exception it raised
+    """
+    with open(os.path.join(queue_dir, 'jobs', name + '.pkl'), 'rb') as f:
+        job = pickle.load(f)
+    kwargs = dict(job['kwargs'])
+    kwargs.setdefault('checkpoint_dir', os.path.join(queue_dir, 'checkpoints'))
+    kwargs.setdefault('outfile', os.path.join(queue_dir, 'models', name))
+    os.makedirs(os.path.join(queue_dir, 'models'), exist_ok=True)
+    tic = time.time()
+    try:
+        group_dvs = get_HDDM_fun(job['task'], kwargs)(job['df'])
+    except Exception as e:
+        return repr(e)
+    result_path = os.path.join(queue_dir, 'results', name + '.pkl')
+    with open(result_path + '.tmp', 'wb') as f:
+        pickle.dump(group_dvs, f)
+    os.replace(result_path + '.tmp', result_path)
+    print('Finished HDDM job %s in %.1f s' % (name, time.time() - tic))
+    return None
+
+class HDDMJobQueue():
+    """ Persistent queue of HDDM fits, one job per task
+    
+    Jobs (the task's dataframe and the kwargs of get_HDDM_fun) are written to
+    queue_dir when added, and each job's group_dvs are written there when it 
+    finishes. Jobs sample with checkpoints (see sample_with_checkpoints), so 
+    after a crash or preemption, creating the queue on the same directory and 
+    calling run again skips finished jobs and resumes the others from their 
+    last checkpoint:
+    
+        queue = HDDMJobQueue('hddm_jobs')
+        queue.add('stroop', stroop_df, samples=95000)
+        queue.add('motor_selective_stop_signal', motor_df, mode='both')
+        group_dvs = queue.run(num_workers=4)
+    """
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        for folder in ['jobs', 'results', 'checkpoints']:
+            os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+    
+    def get_path(self, folder, name):
+        return os.path.join(self.queue_dir, folder, name + '.pkl')
+    
+    def add(self, task, df, name=None, **kwargs):
+        """ Add a job fitting task's HDDM to df. If a job with the same name is
+        already queued it is kept, so adding jobs again after a restart is safe
+        
+        Args:
+            task: task name, as used by get_HDDM_fun
+            df: the task's dataframe
+            name: job name, defaults to the task
+            kwargs: passed to get_HDDM_fun (i.e. mode, samples, burn)
+            
+        Returns:
+            name: the job name
+        """
+        name = name or task
+        job_path = self.get_path('jobs', name)
+        if not os.path.exists(job_path):
+            with open(job_path + '.tmp', 'wb') as f:
+                pickle.dump({'task': task, 'df': df, 'kwargs': kwargs}, f)
+            os.replace(job_path + '.tmp', job_path)
+        return name
+    
+    def jobs(self):
+        """ Names of all jobs in the queue """
+        return sorted(os.path.basename(path)[:-len('.pkl')] 
+                      for path in glob(self.get_path('jobs', '*')))
+    
+    def pending(self):
+        """ Names of the jobs without results, largest first """
+        pending = [name for name in self.jobs() 
+                   if not os.path.exists(self.get_path('results', name))]
+        return sorted(pending, key=lambda name: os.path.getsize(self.get_path('jobs', name)),
+                      reverse=True)
+    
+    def run(self, num_workers=None):
+        """ Run the pending jobs, num_workers at a time (defaults to all cores).
+        Jobs that raise are reported and left pending
+        
+        Returns:
+            results: dictionary of the group_dvs of every finished job
+        """
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        pending = self.pending()
+        print('Running %s HDDM jobs on %s workers' % (len(pending), num_workers))
+        errors = Parallel(n_jobs=num_workers)(delayed(run_HDDM_job)(self.queue_dir, name) 
+                                              for name in pending)
+        for name, error in zip(pending, errors):
+            if error is not None:
+                print('HDDM job %s failed: %s' % (name, error))
+        return self.results()
+    
+    def results(self):
+        """ Dictionary of the group_dvs of every finished job """
+        results = {}
+        for name in self.jobs():
+            if os.path.exists(self.get_path('results', name)):
+                with open(self.get_path('results', name), 'rb') as f:
+                    results[name] = pickle.load(f)
+        return results
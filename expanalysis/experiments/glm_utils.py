@@ -0,0 +1,380 @@
+import numpy
+import pandas
+from patsy import dmatrices, dmatrix
+import re
+from scipy.optimize import minimize
+from scipy.special import expit
+from scipy.stats import t as t_dist
+
+def stack_design(group_df, endog, exog, by = 'worker_id'):
+    """ Stack the design matrices of every group in group_df into padded arrays.
+    Rows with missing values in endog or exog are dropped (as patsy does), and
+    an intercept is added as the first column
+
+    Args:
+        group_df: dataframe with trials from all groups (i.e. workers)
+        endog: column of group_df used as the dependent variable
+        exog: list of columns of group_df used as independent variables
+        by: column identifying groups
+
+    Returns:
+        (groups, X, y, mask): groups is an index of group labels, X is a
+        (groups, max trials, 1 + len(exog)) array of designs, y is a
+        (groups, max trials) array of dependent variables, and mask labels which
+        trials exist for each group
+    """
+    data = group_df[[by, endog] + list(exog)].dropna()
+    codes, groups = pandas.factorize(data[by], sort = True)
+    position = data.groupby(codes).cumcount().values
+    n_obs = numpy.bincount(codes, minlength = len(groups))
+    shape = (len(groups), n_obs.max() if len(n_obs) else 0)
+    X = numpy.zeros(shape + (1 + len(exog),))
+    X[codes, position, 0] = 1
+    X[codes, position, 1:] = data[list(exog)].astype(float).values
+    y = numpy.zeros(shape)
+    y[codes, position] = data[endog].astype(float).values
+    mask = numpy.zeros(shape, dtype = bool)
+    mask[codes, position] = True
+    return groups, X, y, mask
+
+def fit_logit(X, y, mask = None, maxiter = 100, tol = 1e-8):
+    """ Fit a logistic regression (binomial GLM with logit link) for many subjects at
+    once with Newton-Raphson iterations. Each iteration solves the normal equations
+    of all subjects as one batched linear system
+
+    Args:
+        X: (subjects, trials, params) array of stacked design matrices
+        y: (subjects, trials) array of binary dependent variables
+        mask: optional (subjects, trials) boolean array labeling which trials
+            exist for each subject. Defaults to all trials
+        maxiter: maximum number of Newton iterations
+        tol: convergence tolerance on the largest parameter update
+
+    Returns:
+        (params, llf, converged): (subjects, params) array of coefficients, array
+        of log-likelihoods and boolean array of convergence flags. Subjects whose
+        fit did not converge (i.e. perfect separation or a singular design) should
+        not be trusted
+    """
+    X = numpy.asarray(X, dtype = float)
+    y = numpy.asarray(y, dtype = float)
+    if mask is None:
+        mask = numpy.ones(y.shape, dtype = bool)
+    X = numpy.where(mask[..., None], X, 0)
+    y = numpy.where(mask, y, 0)
+    n_subjects, _, n_params = X.shape
+    params = numpy.zeros((n_subjects, n_params))
+    converged = numpy.zeros(n_subjects, dtype = bool)
+    active = numpy.ones(n_subjects, dtype = bool)
+    eye = numpy.eye(n_params)
+    for _ in range(maxiter):
+        mu = expit(numpy.einsum('snk,sk->sn', X, params))
+        gradient = numpy.einsum('snk,sn->sk', X, (y - mu)*mask)
+        hessian = numpy.einsum('snk,sn,snj->skj', X, mu*(1 - mu)*mask, X)
+        # subjects with singular designs are dropped from further iterations
+        with numpy.errstate(all = 'ignore'):
+            singular = ~(numpy.linalg.cond(hessian) < 1/numpy.finfo(float).eps)
+        active &= ~singular
+        hessian[~active] = eye
+        step = numpy.linalg.solve(hessian, gradient[..., None])[..., 0]
+        step[~active] = 0
+        params += step
+        done = active & (numpy.abs(step).max(1) <= tol*(1 + numpy.abs(params).max(1)))
+        converged |= done
+        active &= ~done
+        if not active.any():
+            break
+    eta = numpy.einsum('snk,sk->sn', X, params)
+    llf = numpy.sum((y*eta - numpy.logaddexp(0, eta))*mask, 1)
+    converged &= numpy.isfinite(params).all(1) & numpy.isfinite(llf)
+    return params, llf, converged
+
+def group_logit(group_df, endog, exog, by = 'worker_id'):
+    """ Fit the logistic regression endog ~ exog separately for every group of
+    group_df in one batched pass. Equivalent to fitting
+    smf.glm('endog ~ exog', family = sm.families.Binomial()) to each group
+
+    Args:
+        group_df: dataframe with trials from all groups (i.e. workers)
+        endog: binary column of group_df used as the dependent variable
+        exog: list of columns of group_df used as independent variables
+        by: column identifying groups
+
+    Returns:
+        fits: dataframe indexed by group with one column for each parameter
+        ('Intercept' and exog), as well as 'llf', 'nobs' and 'converged'
+    """
+    groups, X, y, mask = stack_design(group_df, endog, exog, by)
+    params, llf, converged = fit_logit(X, y, mask)
+    fits = pandas.DataFrame(params, index = groups, columns = ['Intercept'] + list(exog))
+    fits['llf'] = llf
+    fits['nobs'] = mask.sum(1)
+    fits['converged'] = converged
+    return fits
+
+def logit(df, endog, exog):
+    """ Fit the logistic regression endog ~ exog to a single dataframe using
+    the batched engine, without the overhead of formula parsing
+
+    Args:
+        df: dataframe of trials
+        endog: binary column of df used as the dependent variable
+        exog: list of columns of df used as independent variables
+
+    Returns:
+        fit: series with one entry for each parameter ('Intercept' and exog), as
+        well as 'llf', 'nobs' and 'converged'. Parameters are NaN if there are no
+        complete trials
+    """
+    fits = group_logit(df.assign(_group = 0), endog, exog, by = '_group')
+    if len(fits) == 0:
+        fit = pandas.Series(numpy.nan, index = fits.columns, dtype = object)
+        fit['nobs'] = 0
+        fit['converged'] = False
+        return fit
+    return fits.iloc[0]
+
+def fit_ols(X, y, mask = None):
+    """ Fit ordinary least squares regressions for many subjects at once. Every
+    subject's regression is solved with a batched pseudoinverse of its design
+    matrix, as statsmodels OLS does
+
+    Args:
+        X: (subjects, trials, params) array of stacked design matrices
+        y: (subjects, trials) array of dependent variables
+        mask: optional (subjects, trials) boolean array labeling which trials
+            exist for each subject. Defaults to all trials
+
+    Returns:
+        (params, bse, pvalues, llf): (subjects, params) arrays of coefficients,
+        standard errors and two-sided t-test p-values, and an array of
+        log-likelihoods
+    """
+    X = numpy.asarray(X, dtype = float)
+    y = numpy.asarray(y, dtype = float)
+    if mask is None:
+        mask = numpy.ones(y.shape, dtype = bool)
+    # padded trials are rows of zeros, which do not change the solution
+    X = numpy.where(mask[..., None], X, 0)
+    y = numpy.where(mask, y, 0)
+    pinv_X = numpy.linalg.pinv(X)
+    params = numpy.einsum('skn,sn->sk', pinv_X, y)
+    resid = (y - numpy.einsum('snk,sk->sn', X, params))*mask
+    ssr = numpy.sum(resid**2, 1)
+    nobs = mask.sum(1)
+    df_resid = nobs - numpy.linalg.matrix_rank(X)
+    with numpy.errstate(all = 'ignore'):
+        scale = ssr/df_resid
+        normalized_cov = numpy.einsum('skn,sjn->skj', pinv_X, pinv_X)
+        bse = numpy.sqrt(scale[:, None]*numpy.diagonal(normalized_cov, axis1 = 1, axis2 = 2))
+        pvalues = 2*t_dist.sf(numpy.abs(params/bse), df_resid[:, None])
+        llf = -nobs/2.*(numpy.log(2*numpy.pi) + numpy.log(ssr/nobs) + 1)
+    return params, bse, pvalues, llf
+
+def group_ols(group_df, endog, exog, by = 'worker_id'):
+    """ Fit the linear regression endog ~ exog separately for every group of
+    group_df in one batched pass. Equivalent to fitting smf.ols('endog ~ exog')
+    to each group
+
+    Args:
+        group_df: dataframe with trials from all groups (i.e. workers)
+        endog: column of group_df used as the dependent variable
+        exog: list of columns of group_df used as independent variables
+        by: column identifying groups
+
+    Returns:
+        fits: dictionary with dataframes 'params', 'bse' and 'pvalues' indexed by
+        group with one column for each parameter ('Intercept' and exog), as well as
+        series 'llf' and 'nobs'
+    """
+    groups, X, y, mask = stack_design(group_df, endog, exog, by)
+    params, bse, pvalues, llf = fit_ols(X, y, mask)
+    columns = ['Intercept'] + list(exog)
+    return {'params': pandas.DataFrame(params, index = groups, columns = columns),
+            'bse': pandas.DataFrame(bse, index = groups, columns = columns),
+            'pvalues': pandas.DataFrame(pvalues, index = groups, columns = columns),
+            'llf': pandas.Series(llf, index = groups),
+            'nobs': pandas.Series(mask.sum(1), index = groups)}
+
+def get_relative_covariance_factor(theta, n_random):
+    """ Lower triangular factor of the random effects covariance, filled column
+    by column from theta (as lme4 does)
+
+    Args:
+        theta: array of n_random*(n_random+1)/2 covariance parameters
+        n_random: number of random effects per group
+
+    Returns:
+        Lambda: (n_random, n_random) lower triangular array
+    """
+    Lambda = numpy.zeros((n_random, n_random))
+    Lambda.T[numpy.triu_indices(n_random)] = theta
+    return Lambda
+
+def fit_conditional_modes(offset, ZL, y, mask, u = None, maxiter = 50, tol = 1e-10):
+    """ Find the conditional modes of the spherical random effects u of a mixed
+    effects logistic regression for all groups at once with penalized iteratively
+    reweighted least squares. The penalized deviance of each group,
+    -2*log-likelihood + u'u, is minimized with batched Newton steps, halving the
+    steps of any group whose penalized deviance does not decrease
+
+    Args:
+        offset: (groups, trials) array of fixed effects linear predictors
+        ZL: (groups, trials, random) array of random effects designs multiplied by
+            the relative covariance factor
+        y: (groups, trials) array of binary dependent variables
+        mask: (groups, trials) boolean array labeling which trials exist
+        u: optional (groups, random) array of starting values. Defaults to zeros
+        maxiter: maximum number of Newton iterations
+        tol: convergence tolerance on the largest change of u
+
+    Returns:
+        (u, llf, hessian): (groups, random) array of conditional modes, array of
+        conditional log-likelihoods and (groups, random, random) array of
+        Hessians of the penalized deviance (divided by 2) at the modes
+    """
+    n_groups, _, n_random = ZL.shape
+    if u is None:
+        u = numpy.zeros((n_groups, n_random))
+    eye = numpy.eye(n_random)
+
+    def penalized_deviance(u):
+        eta = offset + numpy.einsum('gnq,gq->gn', ZL, u)
+        llf = numpy.sum((y*eta - numpy.logaddexp(0, eta))*mask, 1)
+        return -2*llf + numpy.sum(u**2, 1), eta, llf
+
+    deviance, eta, llf = penalized_deviance(u)
+    for _ in range(maxiter):
+        mu = expit(eta)
+        gradient = numpy.einsum('gnq,gn->gq', ZL, (y - mu)*mask) - u
+        hessian = numpy.einsum('gnq,gn,gnr->gqr', ZL, mu*(1 - mu)*mask, ZL) + eye
+        step = numpy.linalg.solve(hessian, gradient[..., None])[..., 0]
+        # halve the steps of groups whose penalized deviance increases (beyond
+        # rounding error)
+        for _ in range(10):
+            new_deviance, new_eta, new_llf = penalized_deviance(u + step)
+            worse = new_deviance > deviance + 1e-10*(1 + numpy.abs(deviance))
+            if not worse.any():
+                break
+            step[worse] /= 2
+        better = ~worse
+        u[better] += step[better]
+        deviance[better] = new_deviance[better]
+        eta[better] = new_eta[better]
+        llf[better] = new_llf[better]
+        if numpy.abs(step).max() <= tol:
+            break
+    mu = expit(eta)
+    hessian = numpy.einsum('gnq,gn,gnr->gqr', ZL, mu*(1 - mu)*mask, ZL) + eye
+    return u, llf, hessian
+
+def fit_mixed_logit(X, Z, y, mask = None, beta0 = None, maxiter = 1000):
+    """ Fit a mixed effects logistic regression with correlated random effects for
+    each group by maximizing the Laplace approximation of the marginal likelihood,
+    as lme4's glmer does by default (nAGQ = 1). The fixed effects and covariance
+    parameters are optimized jointly with L-BFGS-B, and every evaluation of the
+    Laplace deviance solves the conditional modes of all groups in one batch
+
+    Args:
+        X: (groups, trials, fixed) array of stacked fixed effects designs
+        Z: (groups, trials, random) array of stacked random effects designs
+        y: (groups, trials) array of binary dependent variables
+        mask: optional (groups, trials) boolean array labeling which trials exist
+            for each group. Defaults to all trials
+        beta0: optional starting fixed effects. Defaults to the pooled logistic
+            regression
+        maxiter: maximum number of optimizer iterations
+
+    Returns:
+        fit: dictionary with 'fixed' (fixed,) array of fixed effects, 'random'
+        (groups, random) array of conditional modes of the random effects,
+        'cov' (random, random) random effects covariance, 'deviance' the Laplace
+        deviance and 'converged'
+    """
+    X = numpy.asarray(X, dtype = float)
+    Z = numpy.asarray(Z, dtype = float)
+    y = numpy.asarray(y, dtype = float)
+    if mask is None:
+        mask = numpy.ones(y.shape, dtype = bool)
+    X = numpy.where(mask[..., None], X, 0)
+    Z = numpy.where(mask[..., None], Z, 0)
+    y = numpy.where(mask, y, 0)
+    n_fixed = X.shape[2]
+    n_random = Z.shape[2]
+    n_theta = n_random*(n_random + 1)//2
+    if beta0 is None:
+        beta0 = fit_logit(X.reshape(1, -1, n_fixed), y.reshape(1, -1), mask.reshape(1, -1))[0][0]
+    # start from independent random effects with unit variance
+    theta0 = numpy.eye(n_random).T[numpy.triu_indices(n_random)]
+    state = {'u': numpy.zeros((X.shape[0], n_random))}
+
+    def laplace_deviance(params):
+        Lambda = get_relative_covariance_factor(params[:n_theta], n_random)
+        ZL = numpy.einsum('gnq,qr->gnr', Z, Lambda)
+        offset = numpy.einsum('gnk,k->gn', X, params[n_theta:])
+        u, llf, hessian = fit_conditional_modes(offset, ZL, y, mask, state['u'].copy())
+        state['u'] = u
+        logdet = numpy.linalg.slogdet(hessian)[1]
+        return numpy.sum(-2*llf + numpy.sum(u**2, 1) + logdet)
+
+    # the covariance does not change when a column of its factor changes sign, so
+    # the factor is left unconstrained (bounding the diagonal at 0, as lme4
+    # does, can trap the optimizer at the bound)
+    result = minimize(laplace_deviance, numpy.append(theta0, beta0), method = 'L-BFGS-B',
+                      options = {'maxiter': maxiter, 'ftol': 1e-12, 'gtol': 1e-6})
+    deviance = laplace_deviance(result.x)
+    Lambda = get_relative_covariance_factor(result.x[:n_theta], n_random)
+    return {'fixed': result.x[n_theta:],
+            'random': state['u'].dot(Lambda.T),
+            'cov': Lambda.dot(Lambda.T),
+            'deviance': deviance,
+            'converged': result.success}
+
+def get_effect_name(name):
+    """ Convert a patsy column name to the name R gives the same effect
+    (i.e. 'x[T.level]' to 'xlevel' and 'Intercept' to '(Intercept)')
+    """
+    if name == 'Intercept':
+        return '(Intercept)'
+    return re.sub(r'\[T\.([^\]]*)\]', r'\1', name)
+
+def glmer(data, formula, verbose = False):
+    """ Fit a mixed effects logistic regression with one random effects term, in
+    python. Takes and returns the same arguments as r_to_py_utils.glmer, i.e.
+    glmer(data, 'y ~ x + (x|group)'), without needing R and lme4
+
+    Args:
+        data: dataframe of trials
+        formula: lme4 formula with one random effects term (terms|group)
+        verbose: if True, print a summary of the fit
+
+    Returns:
+        (fixed_effects, random_effects): dictionary of fixed effects and dataframe
+        of random effects indexed by group. Effects are named as in R
+    """
+    match = re.match(r'^(.*)\+\s*\(([^|]+)\|([^)]+)\)\s*$', formula)
+    if match is None:
+        raise ValueError('Formula must have one random effects term: %s' % formula)
+    fixed_formula, random_formula, by = [s.strip() for s in match.groups()]
+    y, X = dmatrices(fixed_formula, data, NA_action = 'raise', return_type = 'dataframe')
+    Z = dmatrix(random_formula, data, NA_action = 'raise', return_type = 'dataframe')
+    # stack the designs of each group
+    columns = ['_X%s' % i for i in range(X.shape[1])] + ['_Z%s' % i for i in range(Z.shape[1])]
+    design = pandas.DataFrame(numpy.hstack([X.values, Z.values]), columns = columns)
+    design[by] = data[by].values
+    design['_y'] = y.values[:, 0]
+    groups, stacked, y_stacked, mask = stack_design(design, '_y', columns, by)
+    # stack_design adds an intercept that the designs already include
+    stacked = stacked[:, :, 1:]
+    fit = fit_mixed_logit(stacked[:, :, :X.shape[1]], stacked[:, :, X.shape[1]:], y_stacked, mask)
+    fixed_names = [get_effect_name(name) for name in X.columns]
+    random_names = [get_effect_name(name) for name in Z.columns]
+    fixed_effects = dict(zip(fixed_names, fit['fixed']))
+    random_effects = pandas.DataFrame(fit['random'], index = groups, columns = random_names)
+    if verbose:
+        print('Laplace deviance: %s, converged: %s' % (fit['deviance'], fit['converged']))
+        print('Random effects covariance:')
+        print(pandas.DataFrame(fit['cov'], index = random_names, columns = random_names))
+        print('Fixed effects:')
+        print(pandas.Series(fixed_effects))
+    return fixed_effects, random_effects
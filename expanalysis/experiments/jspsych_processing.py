@@ -2,13 +2,14 @@
 analysis/experiments/jspsych_processing.py: part of expfactory package
 functions for automatically cleaning and manipulating jspsych experiments
 """
-from expanalysis.experiments.ddm_utils import EZ_diffusion, get_HDDM_fun
+from expanalysis.experiments.ddm_utils import (
+        EZ, EZ_diffusion, get_HDDM_fun, group_EZ_diffusion)
+from expanalysis.experiments.glm_utils import glmer, group_logit, group_ols, logit
+from expanalysis.experiments.optimize_utils import batch_fmin, batch_newton
 from expanalysis.experiments.psychological_models import (
         fRL_Model, Two_Stage_Model)
-from expanalysis.experiments.r_to_py_utils import glmer
-import hddm
 import json
-from math import ceil, factorial, floor
+from math import factorial
 import numpy
 import pandas
 import random
@@ -29,15 +30,20 @@ Generic Functions
 
 
 
-def group_decorate(group_fun_getter = None, group_fun_args = None):
+def group_decorate(group_fun_getter = None, group_fun_args = None, batch_funs = None):
     """ Group decorate is a wrapper for multi_worker_decorate to pass an optional group level
     DV function
     :group_fun_args: arguments passed to group_fun
     :group_fun: a function to apply to the entire group that returns a dictionary with DVs
     for each subject (i.e. fit_HDDM)
+    :batch_funs: list of functions to apply to the entire group that calculate DVs for
+    every subject in one vectorized pass (i.e. get_standard_DVs). Unlike group_fun these
+    are always applied, and their DVs are passed to the individual DV function
     """
     if group_fun_args is None:
         group_fun_args = {}
+    if batch_funs is None:
+        batch_funs = []
     def multi_worker_decorate(fun):
         """Decorator to ensure that dv functions (i.e. calc_stroop_DV) have only one worker
         :func: function to apply to each worker individuals
@@ -63,10 +69,16 @@ def group_decorate(group_fun_getter = None, group_fun_args = None):
                 group_fun_args['kwargs'] = kwargs
                 group_fun = group_fun_getter(**group_fun_args)
                 group_dvs = group_fun(group_df)
+            # apply vectorized functions across all workers
+            batch_dvs = {}
+            for batch_fun in batch_funs:
+                for worker, worker_dvs in batch_fun(group_df).items():
+                    batch_dvs.setdefault(worker, {}).update(worker_dvs)
             # apply function on individuals
             for worker in pandas.unique(group_df['worker_id']):
                 df = group_df.query('worker_id == "%s"' %worker)
                 dvs = group_dvs.get(worker, {})
+                dvs.update(batch_dvs.get(worker, {}))
                 try:
                     worker_dvs, description = fun(df, dvs)
                     group_dvs[worker] = worker_dvs
@@ -94,6 +106,276 @@ def get_post_error_slow(df):
     else:
         return numpy.nan
 
+def get_group_post_error_slow(group_df):
+    """Vectorized version of get_post_error_slow that calculates post-error slowing for
+    every worker in group_df at once. Correct-error-correct triplets are found using
+    trials shifted within each worker
+    :return post_error_slowing: pandas Series of post-error slowing indexed by worker
+    """
+    worker_ids = group_df['worker_id']
+    grouped = group_df.groupby('worker_id', sort = False)
+    position = grouped.cumcount()
+    size = grouped['rt'].transform('size')
+    pre_rt = grouped['rt'].shift(1)
+    post_rt = grouped['rt'].shift(-1)
+    # correct is evaluated on truthiness, as in get_post_error_slow
+    pre_correct = grouped['correct'].shift(1) != 0
+    post_correct = grouped['correct'].shift(-1) != 0
+    errors = (group_df['correct'] == False) & (group_df['rt'] != -1) \
+             & (position > 0) & (position < size-1)
+    triplets = errors & (pre_rt != -1) & (post_rt != -1) & pre_correct & post_correct
+    post_error_delta = (post_rt - pre_rt)[triplets]
+    delta_groups = post_error_delta.groupby(worker_ids[triplets])
+    post_error_slowing = delta_groups.mean()
+    # numpy.mean propagates missing values, groupby mean skips them
+    post_error_slowing[post_error_delta.isnull().groupby(worker_ids[triplets]).any()] = numpy.nan
+    post_error_slowing[delta_groups.size() < 4] = numpy.nan
+    return post_error_slowing.reindex(pandas.unique(worker_ids))
+
+def get_standard_DVs(group_df, query = None, correct_query = 'correct == True', error_rt = True,
+                     post_error_query = None):
+    """ Calculate the standard accuracy and RT DVs (acc, avg_rt_error, std_rt_error, avg_rt,
+    std_rt, missed_percent, post_error_slowing) for every worker of an experiment in one 
+    grouped pass
+    :group_df: trials for all workers of one experiment
+    :query: optional query selecting the trials the DVs are calculated on
+    :correct_query: query selecting the responded trials used for avg_rt and std_rt.
+    correct_shift (accuracy on the previous trial) is available. If None, all responded
+    trials are used
+    :error_rt: bool, if True calculate avg_rt_error and std_rt_error
+    :post_error_query: optional query selecting the trials used for post error slowing
+    :return group_dvs: dictionary of dependent variables for each worker
+    """
+    if query is not None:
+        group_df = group_df.query(query)
+    workers = pandas.unique(group_df['worker_id'])
+    if post_error_query is not None:
+        post_error_slowing = get_group_post_error_slow(group_df.query(post_error_query))
+    else:
+        post_error_slowing = get_group_post_error_slow(group_df)
+    if 'correct_shift' not in group_df.columns:
+        group_df = group_df.assign(correct_shift = group_df.groupby('worker_id').correct.shift(1))
+    missed_percent = (group_df['rt']==-1).groupby(group_df['worker_id']).mean()
+    responded = group_df.query('rt != -1')
+    responded = responded.assign(correct = responded.correct.astype(float))
+    if correct_query is not None:
+        correct = responded.query(correct_query)
+    else:
+        correct = responded
+    errors = responded.query('correct == False')
+    stats = pandas.DataFrame({
+        'acc': responded.groupby('worker_id').correct.mean(),
+        'avg_rt_error': errors.groupby('worker_id').rt.median(),
+        'std_rt_error': errors.groupby('worker_id').rt.std(),
+        'avg_rt': correct.groupby('worker_id').rt.median(),
+        'std_rt': correct.groupby('worker_id').rt.std(),
+        'missed_percent': missed_percent,
+        'post_error_slowing': post_error_slowing}).reindex(workers)
+    valences = {'acc': 'Pos', 'avg_rt_error': 'NA', 'std_rt_error': 'NA',
+                'avg_rt': 'Neg', 'std_rt': 'NA', 'missed_percent': 'Neg',
+                'post_error_slowing': 'Pos'}
+    if not error_rt:
+        stats = stats.drop(['avg_rt_error', 'std_rt_error'], axis = 1)
+    group_dvs = {}
+    for worker, values in stats.to_dict('index').items():
+        group_dvs[worker] = {dv: {'value': value, 'valence': valences[dv]} for dv, value in values.items()}
+    return group_dvs
+    
+def get_group_SSRT(group_df, trial_type_col = 'SS_trial_type', condition = None):
+    """ Calculate SSRT using the integration method for every worker (and condition) at
+    once. The probability of responding on stop trials is corrected by the go omission 
+    rate and used to select a quantile of each worker's sorted go RTs, from which the
+    mean stop signal delay is subtracted
+    :trial_type_col: column labeling "go" and "stop" trials
+    :condition: optional column. If provided, SSRT is calculated for each level
+    :return SSRT: pandas Series of SSRT indexed by worker (and condition). SSRT is NaN 
+    if the corrected quantile falls outside of the go RT distribution
+    """
+    keys = ['worker_id']
+    if condition is not None:
+        keys.append(condition)
+    # rows with a missing key are left out of every cell, as groupby would
+    group_df = group_df.dropna(subset = keys)
+    go_trials = group_df[group_df[trial_type_col] == 'go']
+    stop_trials = group_df[group_df[trial_type_col] == 'stop']
+    # sort go RTs so that each cell is a contiguous block ordered by rt
+    sorted_go = go_trials.query('rt != -1').sort_values(keys + ['rt'])
+    N = sorted_go.groupby(keys, sort = False).size()
+    stats = pandas.DataFrame({
+        'N': N,
+        'start': N.cumsum() - N,
+        'go_response': (go_trials.rt != -1).groupby([go_trials[k] for k in keys]).mean(),
+        'prob_stop_failure': 1-stop_trials.stopped.astype(float).groupby([stop_trials[k] for k in keys]).mean(),
+        'SS_delay': stop_trials.groupby(keys).SS_delay.mean()})
+    stats.N = stats.N.fillna(0)
+    corrected = stats.prob_stop_failure/stats.go_response
+    index = corrected*(stats.N-1)
+    valid = numpy.isfinite(index) & (index >= 0) & (index <= stats.N-1)
+    lower = numpy.floor(index[valid]) + stats.start[valid]
+    upper = numpy.ceil(index[valid]) + stats.start[valid]
+    rts = sorted_go.rt.values
+    quantile_rt = pandas.Series(numpy.nan, index = stats.index)
+    quantile_rt[valid] = (rts[lower.astype(int).values] + rts[upper.astype(int).values])/2
+    return quantile_rt - stats.SS_delay
+
+def get_SSRT_DVs(group_df, trial_type_col = 'SS_trial_type', condition = None, query = None):
+    """ Calculate SSRT DVs for every worker of a stop signal experiment using get_group_SSRT
+    :trial_type_col: column labeling "go" and "stop" trials
+    :condition: optional column. If provided (and in group_df) SSRT is calculated for each
+    level as SSRT_<level>, and the overall SSRT is their average
+    :query: optional query selecting the trials used to calculate SSRT
+    :return group_dvs: dictionary of dependent variables for each worker
+    """
+    if query is not None:
+        group_df = group_df.query(query)
+    if condition not in group_df.columns:
+        condition = None
+    SSRT = get_group_SSRT(group_df, trial_type_col, condition)
+    group_dvs = {}
+    for key, value in SSRT.items():
+        if condition is None:
+            group_dvs[key] = {'SSRT': {'value': value, 'valence': 'Neg'}}
+        else:
+            worker, c = key
+            group_dvs.setdefault(worker, {})['SSRT_%s' % c] = {'value': value, 'valence': 'Neg'}
+    if condition is not None:
+        #take average of all conditions SSRT
+        for dvs in group_dvs.values():
+            dvs['SSRT'] = {'value':  numpy.mean([dv['value'] for dv in dvs.values()]), 'valence': 'Neg'}
+    return group_dvs
+
+def get_logit_DVs(group_df, endog, exog, dv_names, query = None):
+    """ Fit the logistic regression endog ~ exog for every worker at once using group_logit
+    :endog: binary column used as the dependent variable
+    :exog: list of columns used as independent variables
+    :dv_names: dictionary mapping parameters ('Intercept', exog or 'llf') to (dv, valence)
+    :query: optional query selecting the trials used in the regression
+    :return group_dvs: dictionary of dependent variables for each worker. Workers whose fit
+    did not converge are left out, so the DV function can fall back on statsmodels
+    """
+    if query is not None:
+        group_df = group_df.query(query)
+    fits = group_logit(group_df, endog, exog)
+    group_dvs = {}
+    for worker, fit in fits[fits.converged.astype(bool)].iterrows():
+        group_dvs[worker] = {dv: {'value': fit[param], 'valence': valence}
+                             for param, (dv, valence) in dv_names.items()}
+    return group_dvs
+
+def get_ols_DVs(group_df, endog, exog, dv_names, query = None):
+    """ Fit the linear regression endog ~ exog for every worker at once using group_ols
+    :endog: column used as the dependent variable
+    :exog: list of columns used as independent variables
+    :dv_names: dictionary mapping parameters ('Intercept', exog or 'llf') to (dv, valence)
+    :query: optional query selecting the trials used in the regression
+    :return group_dvs: dictionary of dependent variables for each worker
+    """
+    if query is not None:
+        group_df = group_df.query(query)
+    fits = group_ols(group_df, endog, exog)
+    values = fits['params'].assign(llf = fits['llf'])
+    group_dvs = {}
+    for worker, fit in values.iterrows():
+        group_dvs[worker] = {dv: {'value': fit[param], 'valence': valence}
+                             for param, (dv, valence) in dv_names.items()}
+    return group_dvs
+
+def fit_hyp_discount_rate_nm(datasets, smaller_col, sooner_col, larger_col, later_col):
+    """ Fit a hyperbolic discounting choice model with nelder-mead to each dataframe in datasets
+    at once. Choices (patient1_impatient0) are modeled as a logistic function of beta times the
+    difference in discounted utility between the smaller sooner and larger later options
+    :datasets: list of dataframes, one per fit
+    :smaller_col, sooner_col, larger_col, later_col: columns with the amounts and delays of the options
+    :return fits: list of (beta, k) arrays and the minimized negative log likelihood of each fit
+    """
+    max_trials = max([data.shape[0] for data in datasets])
+    columns = [smaller_col, sooner_col, larger_col, later_col, 'patient1_impatient0']
+    arrays = numpy.zeros((len(columns), len(datasets), max_trials))
+    mask = numpy.zeros((len(datasets), max_trials), dtype = bool)
+    for i, data in enumerate(datasets):
+        arrays[:, i, :data.shape[0]] = data[columns].astype(float).values.T
+        mask[i, :data.shape[0]] = True
+    smaller_amount, sooner_days, larger_amount, later_days, patient1_impatient0 = arrays
+    
+    def calculate_hyp_discount_rate_nm(x0):
+        beta = x0[:, :1]
+        k = x0[:, 1:]
+        u_diff = smaller_amount/(1+k*sooner_days) - larger_amount/(1+k*later_days)
+        #logt: smaller beta (p[1]) larger error
+        prob = 1/(1+numpy.exp(beta*u_diff))
+        err = (patient1_impatient0 * numpy.log(prob)) + ((1 - patient1_impatient0)*numpy.log(1-prob))
+        #sum of negative log likelihood (to be minimized)
+        return -1*numpy.sum(numpy.where(mask, err, 0), 1)
+    
+    with numpy.errstate(all = 'ignore'):
+        xopt, fopt, _ = batch_fmin(calculate_hyp_discount_rate_nm, numpy.zeros((len(datasets), 2)), xtol=1e-6, ftol=1e-6)
+    return list(zip(xopt, fopt))
+
+def fit_hyp_discount_rate_rss(decayed_values, larger_amounts):
+    """ Fit the hyperbolic discount rate k that minimizes the RSS between decayed values
+    and larger_amount/(1+k*delay) for many problems at once. Newton's method is run on the
+    analytic derivatives of the RSS, and problems where it does not converge are fit with
+    nelder-mead
+    :decayed_values: list of dictionaries mapping delays to decayed values, one per problem
+    :larger_amounts: list of larger amounts, one per problem
+    :return fits: list of (k, rss) tuples
+    """
+    max_delays = max([len(values) for values in decayed_values])
+    later_time_days = numpy.zeros((len(decayed_values), max_delays))
+    decayed_vals = numpy.zeros((len(decayed_values), max_delays))
+    delay_mask = numpy.zeros((len(decayed_values), max_delays), dtype = bool)
+    for i, values in enumerate(decayed_values):
+        later_time_days[i, :len(values)] = list(values.keys())
+        decayed_vals[i, :len(values)] = list(values.values())
+        delay_mask[i, :len(values)] = True
+    larger_amounts = numpy.array(larger_amounts, dtype = float)[:, None]
+    
+    def rss_derivatives(k, rows = slice(None)):
+        k = k[:, None]
+        delays = later_time_days[rows]
+        pred_decayed_vals = larger_amounts[rows]/(1+(k*delays))
+        d_pred = -pred_decayed_vals*delays/(1+(k*delays))
+        d2_pred = -2*d_pred*delays/(1+(k*delays))
+        resid = numpy.where(delay_mask[rows], decayed_vals[rows] - pred_decayed_vals, 0)
+        rss = numpy.sum(resid**2, 1)
+        d_rss = -2*numpy.sum(resid*d_pred, 1)
+        d2_rss = 2*numpy.sum(numpy.where(delay_mask[rows], d_pred**2 - resid*d2_pred, 0), 1)
+        return rss, d_rss, d2_rss
+    
+    k, rss, converged = batch_newton(rss_derivatives, numpy.zeros(len(decayed_values)))
+    if not converged.all():
+        failed = numpy.where(~converged)[0]
+        with numpy.errstate(all = 'ignore'):
+            xopt, fopt, _ = batch_fmin(lambda x0: rss_derivatives(x0[:, 0], failed)[0], 
+                                       numpy.zeros((len(failed), 1)), xtol=1e-6, ftol=1e-6)
+        k[failed], rss[failed] = xopt[:, 0], fopt
+    return list(zip(k, rss))
+
+def get_CCT_hot_subset(df):
+    """ Select collected rounds without loss cards from the hot Columbia card task
+    """
+    df = df.query('mouse_click == "collectButton" and round_type == "rigged_win"').reset_index(drop = True)
+    return df[~df['clicked_on_loss_card'].astype(bool)]
+
+def get_CCT_DVs(group_df, endog):
+    """ Calculate the sensitivity of the number of cards chosen in the Columbia card task
+    to gain amount, loss amount and probability of loss for every worker at once
+    :endog: column with the number of cards chosen
+    :return group_dvs: dictionary of dependent variables for each worker
+    """
+    exog = ['gain_amount', 'loss_amount', 'num_loss_cards']
+    fits = group_ols(group_df, endog, exog)
+    information_use = (fits['pvalues'][exog] < .05).sum(1)
+    group_dvs = {}
+    for worker, params in fits['params'].iterrows():
+        group_dvs[worker] = {
+            'gain_sensitivity': {'value':  params['gain_amount'], 'valence': 'Pos'},
+            'loss_sensitivity': {'value':  params['loss_amount'], 'valence': 'Pos'},
+            'probability_sensitivity': {'value':  params['num_loss_cards'], 'valence': 'Pos'},
+            'information_use': {'value':  information_use[worker], 'valence': 'Pos'},
+            'log_ll': {'value':  fits['llf'][worker], 'valence': 'NA'}}
+    return group_dvs
+
 """
 Post Processing functions
 """
@@ -520,69 +802,91 @@ def TOL_post(df):
     
 
 def two_stage_decision_post(df):
-    group_df = pandas.DataFrame()
+    """ Combine the first stage, second stage and feedback rows of each trial into
+    one row per trial, and label workers who fail the win-stay manipulation check
+    :df: two stage decision dataframe of one or more workers
+    """
+    stages = ['practice', 'test']
     trials = df.groupby('exp_stage')['trial_num'].max()
-    for worker_i, worker in enumerate(numpy.unique(df['worker_id'])):
-        try:
-            rows = []
-            worker_df = df[df['worker_id'] == worker]
-            for stage in ['practice', 'test']:
-                stage_df = worker_df[worker_df['exp_stage'] == stage]
-                for i in range(int(trials[stage]+1)):
-                    trial = stage_df.loc[df['trial_num'] == i]
-                    #set row to first stage
-                    row = trial.iloc[0].to_dict()  
-                    ss,fb = {}, {}
-                    row['trial_id'] = 'incomplete_trial'
-                    if len(trial) >= 2:
-                        ss = trial.iloc[1]
-                        row['time_elapsed'] = ss['time_elapsed']
-                    if len(trial) == 3:
-                        fb = trial.iloc[2]
-                        row['time_elapsed'] = fb['time_elapsed']
-                    row['key_press_first'] = row.pop('key_press')
-                    row['key_press_second'] = ss.get('key_press',-1)
-                    row['rt_first'] = row.pop('rt')
-                    row['rt_second'] = ss.get('rt',-1)
-                    row['stage_second'] = ss.get('stage',-1)
-                    row['stim_order_first'] = row.pop('stim_order')
-                    row['stim_order_second'] = ss.get('stim_order_second',-1)
-                    row['stim_selected_first'] = row.pop('stim_selected')
-                    row['stim_selected_second'] = ss.get('stim_selected',-1)
-                    row['stage_transition'] = ss.get('stage_transition',numpy.nan)
-                    row['feedback'] = fb.get('feedback',numpy.nan)
-                    row['FB_probs'] = fb.get('FB_probs',numpy.nan)
-                    if row['rt_second'] != -1:
-                        row['trial_id'] = 'complete_trial'
-                    rows.append(row)
-            rows.append(worker_df.iloc[-1].to_dict())
-            worker_df = pandas.DataFrame(rows)
-            trial_index = ["%s_%s" % ('two_stage_decision',str(x).zfill(3)) for x in range(len(worker_df))]
-            worker_df.index = trial_index
-            #manipulation check
-            win_stay = 0.0
-            subset = worker_df[worker_df['exp_stage']=='test']
-            for stage in numpy.unique(subset['stage_second']):
-                stage_df=subset[(subset['stage_second']==stage) & (subset['trial_id'] == "complete_trial")][['feedback','stim_selected_second']]
-                stage_df.insert(0, 'next_choice', stage_df['stim_selected_second'].shift(-1))
-                stage_df.insert(0, 'stay', stage_df['stim_selected_second'] == stage_df['next_choice'])
-                win_stay+= stage_df[stage_df['feedback']==1]['stay'].sum()
-            win_stay_proportion = win_stay/subset['feedback'].sum()
-            if win_stay_proportion > .5:
-                worker_df.loc[:,'passed_check'] = True
-            else:
-                worker_df.loc[:,'passed_check'] = False
-                print('Two Stage Decision: Worker %s failed manipulation check. Win stay = %s' % (worker, win_stay_proportion))
-            group_df = pandas.concat([group_df,worker_df])
-        except:
+    workers = numpy.unique(df['worker_id'])
+    if not set(stages) <= set(trials.index):
+        for worker in workers:
             print('Could not process two_stage_decision dataframe with worker: %s' % worker)
-            df.loc[df.worker_id == worker,'passed_check'] = False
-    if (len(group_df)>0):
-        group_df.insert(0, 'switch', group_df['stim_selected_first'].diff()!=0)
-        group_df.insert(0, 'stage_transition_last', group_df['stage_transition'].shift(1))
-        group_df.insert(0, 'feedback_last', group_df['feedback'].shift(1))
-        df = group_df
-    return df
+        df.loc[:,'passed_check'] = False
+        return df
+    keys = ['worker_id', 'exp_stage', 'trial_num']
+    trial_df = df[df['exp_stage'].isin(stages)]
+    trial_df = trial_df[trial_df['trial_num'].isin(numpy.arange(trials.max()+1)) & 
+                        (trial_df['trial_num'] <= trial_df['exp_stage'].map(trials))]
+    # rank rows within each trial: first stage, second stage, feedback
+    grouped = trial_df.groupby(keys, sort = False)
+    position = grouped.cumcount()
+    size = grouped['trial_num'].transform('size')
+    first = trial_df[position == 0].set_index(keys, drop = False)
+    second = trial_df[position == 1].set_index(keys)
+    # feedback is only used for trials with exactly three rows
+    fb = trial_df[(position == 2) & (size == 3)].set_index(keys)
+    has_second = first.index.isin(second.index)
+    has_fb = first.index.isin(fb.index)
+    def get_value(rows, exists, col, default):
+        if col not in rows.columns:
+            return default
+        return rows[col].reindex(first.index).where(exists, default)
+    # workers missing any trial cannot be processed
+    n_trials = sum(int(trials[stage]+1) for stage in stages)
+    trial_counts = first.groupby(level = 'worker_id').size().reindex(workers, fill_value = 0)
+    for worker in trial_counts.index[trial_counts != n_trials]:
+        print('Could not process two_stage_decision dataframe with worker: %s' % worker)
+    workers = trial_counts.index[trial_counts == n_trials]
+    if len(workers) == 0:
+        df.loc[:,'passed_check'] = False
+        return df
+    # one wide row per trial, starting from the first stage row
+    popped = ['key_press', 'rt', 'stim_order', 'stim_selected']
+    rows = first.drop(columns = popped)
+    rows['trial_id'] = 'incomplete_trial'
+    rows['time_elapsed'] = get_value(second, has_second, 'time_elapsed', rows['time_elapsed'])
+    rows['time_elapsed'] = get_value(fb, has_fb, 'time_elapsed', rows['time_elapsed'])
+    rows['key_press_first'] = first['key_press']
+    rows['key_press_second'] = get_value(second, has_second, 'key_press', -1)
+    rows['rt_first'] = first['rt']
+    rows['rt_second'] = get_value(second, has_second, 'rt', -1)
+    rows['stage_second'] = get_value(second, has_second, 'stage', -1)
+    rows['stim_order_first'] = first['stim_order']
+    rows['stim_order_second'] = get_value(second, has_second, 'stim_order_second', -1)
+    rows['stim_selected_first'] = first['stim_selected']
+    rows['stim_selected_second'] = get_value(second, has_second, 'stim_selected', -1)
+    rows['stage_transition'] = get_value(second, has_second, 'stage_transition', numpy.nan)
+    rows['feedback'] = get_value(fb, has_fb, 'feedback', numpy.nan)
+    rows['FB_probs'] = get_value(fb, has_fb, 'FB_probs', numpy.nan)
+    rows.loc[rows['rt_second'] != -1, 'trial_id'] = 'complete_trial'
+    rows = rows.reset_index(drop = True)
+    # each worker's trials are followed by the worker's last row
+    last_rows = df.groupby('worker_id').tail(1)
+    rows['order'] = rows['exp_stage'].map({stage: i for i, stage in enumerate(stages)})
+    last_rows = last_rows.assign(order = len(stages))
+    group_df = pandas.concat([rows, last_rows], sort = False)
+    group_df = group_df[group_df['worker_id'].isin(workers)]
+    group_df = group_df.sort_values(['worker_id', 'order', 'trial_num'], kind = 'stable').drop(columns = 'order')
+    group_df.index = ['two_stage_decision_%s' % str(x).zfill(3) 
+                      for x in group_df.groupby('worker_id').cumcount()]
+    #manipulation check
+    subset = group_df[group_df['exp_stage'] == 'test']
+    complete = subset[subset['trial_id'] == 'complete_trial']
+    next_choice = complete.groupby(['worker_id', 'stage_second'])['stim_selected_second'].shift(-1)
+    stay = (complete['stim_selected_second'] == next_choice) & (complete['feedback'] == 1)
+    win_stay = stay.groupby(complete['worker_id']).sum().reindex(workers, fill_value = 0)
+    win_stay_proportion = win_stay/subset.groupby('worker_id')['feedback'].sum().reindex(workers, fill_value = 0)
+    passed_check = win_stay_proportion > .5
+    for worker in passed_check.index[~passed_check]:
+        print('Two Stage Decision: Worker %s failed manipulation check. Win stay = %s' % (worker, win_stay_proportion[worker]))
+    group_df.loc[:,'passed_check'] = group_df['worker_id'].map(passed_check)
+    # lagged columns within each worker
+    worker_group = group_df.groupby('worker_id', sort = False)
+    group_df.insert(0, 'switch', worker_group['stim_selected_first'].diff() != 0)
+    group_df.insert(0, 'stage_transition_last', worker_group['stage_transition'].shift(1))
+    group_df.insert(0, 'feedback_last', worker_group['feedback'].shift(1))
+    return group_df
 
 def WATT_post(df):
     # correct bug where exp stage is incorrectly labeled practice in some trials
@@ -599,7 +903,7 @@ def WATT_post(df):
 DV functions
 """
 
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'adaptive_n_back'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'adaptive_n_back'}, batch_funs = [lambda df: get_standard_DVs(df, query = 'exp_stage == "adaptive"')])
 def calc_adaptive_n_back_DV(df, dvs = {}):
     """ Calculate dv for adaptive_n_back task. Maximum load
     :return dv: dictionary of dependent variables
@@ -608,27 +912,12 @@ def calc_adaptive_n_back_DV(df, dvs = {}):
     control_df = df.query('exp_stage == "control"')
     df = df.query('exp_stage == "adaptive"')
     
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
-    df_correct = df.query('correct == True').reset_index(drop = True)
     
     # Get DDM parameters
     dvs.update(EZ_diffusion(df.query('load == 2')))  
     
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
-    
     dvs['mean_load'] = {'value':  df.groupby('block_num').load.mean().mean(), 'valence': 'Pos'}
     #dvs['proactive_interference'] = {'value':  rs.params['recency'], 'valence': 'Neg'}
     description =  """
@@ -636,7 +925,10 @@ def calc_adaptive_n_back_DV(df, dvs = {}):
     when load = 2"""
     return dvs, description
 
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'attention_network_task'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'attention_network_task'},
+                batch_funs = [lambda df: get_standard_DVs(df, post_error_query = 'exp_stage == "test"'),
+                              lambda df: group_EZ_diffusion(df, condition = 'flanker_type'),
+                              group_EZ_diffusion])
 def calc_ANT_DV(df, dvs = {}):
     """ Calculate dv for attention network task: Accuracy and average reaction time
     
@@ -651,29 +943,10 @@ def calc_ANT_DV(df, dvs = {}):
     df.insert(0,'flanker_shift', df.flanker_type.shift(1))
     df.insert(0, 'correct_shift', df.correct.shift(1))
     
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df.query('exp_stage == "test"'))
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True')
     
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df, condition = 'flanker_type'))
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     # Get three network effects
     cue_rt = df_correct.groupby('cue').rt.median()
     flanker_rt = df_correct.groupby('flanker_type').rt.median()
@@ -776,7 +1049,63 @@ def calc_ART_sunny_DV(df, dvs = {}):
                     and the percent of time the blue fish is caught"""  
     return dvs, description
 
-@group_decorate()
+def get_bickel_decayed_value(data_cut):
+    """ Calculate the decayed value of the larger reward at one delay of the bickel titrator
+    from the implied discount rates around the point where choices switch
+    :data_cut: one worker's trials with one larger amount and delay
+    """
+    implied_k_for_titrator = numpy.nan
+    data_cut = data_cut.sort_values(by = 'implied_k')
+    if(len(numpy.unique(numpy.diff(data_cut['patient1_impatient0']))) == 1):
+        if(set(data_cut['patient1_impatient0']) == {0.0}):
+            implied_k_for_titrator = max(data_cut['implied_k'])
+        elif(set(data_cut['patient1_impatient0']) == {1.0}):
+            implied_k_for_titrator = min(data_cut['implied_k'])
+    else:
+        switch_point = numpy.where(abs(numpy.diff(data_cut['patient1_impatient0'])) == 1)[0][0]
+        a = list(data_cut['implied_k'])[switch_point]
+        b = list( data_cut['implied_k'])[switch_point+1]
+        implied_k_for_titrator = mstats.gmean([a,b], axis=0)
+    decayed_value = float(list(set(data_cut['larger_amount']))[0])/(1+implied_k_for_titrator*float(list(set(data_cut['later_time_days']))[0]))
+    return decayed_value
+
+def get_bickel_DVs(group_df):
+    """ Fit the hyperbolic discount rate of each reward size of the bickel titrator for
+    every worker at once, by minimizing the RSS between decayed values and predicted
+    hyperbolic decayed values with fit_hyp_discount_rate_rss
+    :return group_dvs: dictionary of dependent variables for each worker. Workers whose
+    decayed values could not be calculated are left out
+    """
+    group_df = group_df.query('exp_stage == "test"')
+    reward_sizes = {10: 'small', 1000: 'medium', 1000000: 'large'}
+    decayed_values, cells = [], []
+    for worker, df in group_df.groupby('worker_id', sort = False):
+        try:
+            worker_values = []
+            for larger_amount, amount_data in df.groupby('larger_amount'):
+                values = {delay: get_bickel_decayed_value(data_cut) 
+                          for delay, data_cut in amount_data.groupby('later_time_days')}
+                worker_values.append((values, (worker, larger_amount, amount_data.shape[0])))
+        except:
+            continue
+        for values, cell in worker_values:
+            decayed_values.append(values)
+            cells.append(cell)
+    group_dvs = {}
+    if len(cells) == 0:
+        return group_dvs
+    fits = fit_hyp_discount_rate_rss(decayed_values, [larger_amount for _, larger_amount, _ in cells])
+    for (worker, larger_amount, num_trials), (k, rss) in zip(cells, fits):
+        if larger_amount not in reward_sizes:
+            continue
+        size = reward_sizes[larger_amount]
+        dvs = group_dvs.setdefault(worker, {})
+        dvs['hyp_discount_rate_' + size] = {'value': k, 'valence': 'Neg'}
+        dvs['min_rss_' + size] = {'value': rss, 'valence': 'Neg'}
+        dvs['num_trials_' + size] = {'value': num_trials, 'valence': 'Pos'}
+    return group_dvs
+
+@group_decorate(batch_funs = [get_bickel_DVs])
 def calc_bickel_DV(df, dvs = {}):
     """ Calculate dv for bickel task
     :return dv: dictionary of dependent variables
@@ -803,22 +1132,6 @@ def calc_bickel_DV(df, dvs = {}):
     def geo_mean(l):
         return mstats.gmean(l, axis=0)
 
-    def get_hyp_decayed_value(data_cut):
-        implied_k_for_titrator = numpy.nan
-        data_cut = data_cut.sort_values(by = 'implied_k')
-        if(len(numpy.unique(numpy.diff(data_cut['patient1_impatient0']))) == 1):
-            if(set(data_cut['patient1_impatient0']) == {0.0}):
-                implied_k_for_titrator = max(data_cut['implied_k'])
-            elif(set(data_cut['patient1_impatient0']) == {1.0}):
-                implied_k_for_titrator = min(data_cut['implied_k'])
-        else:
-            switch_point = numpy.where(abs(numpy.diff(data_cut['patient1_impatient0'])) == 1)[0][0]
-            a = list(data_cut['implied_k'])[switch_point]
-            b = list( data_cut['implied_k'])[switch_point+1]
-            implied_k_for_titrator = mstats.gmean([a,b], axis=0)
-        decayed_value = float(list(set(data_cut['larger_amount']))[0])/(1+implied_k_for_titrator*float(list(set(data_cut['later_time_days']))[0]))
-        return decayed_value
-        
     def get_raw_decayed_value(data_cut):
         if(len(numpy.unique(numpy.diff(data_cut['patient1_impatient0']))) == 1):
             if(set(data_cut['patient1_impatient0']) == {0.0}):
@@ -832,39 +1145,6 @@ def calc_bickel_DV(df, dvs = {}):
             decayed_value = (a+b)/2
         return decayed_value    
 
-    def minimize_rss(x0, decayed_values, larger_amount):
-        k = x0
-        decayed_values_df = pandas.DataFrame(list(decayed_values.items()), columns=['later_time_days', 'decayed_val'])
-        decayed_vals = decayed_values_df['decayed_val']
-        later_time_days = decayed_values_df['later_time_days']
-        larger_amount = numpy.repeat(larger_amount, len(decayed_vals))
-        pred_decayed_vals = [a/(1+(k*d)) for a,d in zip(larger_amount, later_time_days)]
-        rss = sum([(a - b)*(a-b) for a, b in zip(decayed_vals, pred_decayed_vals)])
-        return float(rss)
-            
-    def optim_hyp_discount_rate_nm(decayed_values, larger_amount):
-        hyp_discount_rate_nm = 0.0
-        try:
-            x0=0
-            xopt = optimize.fmin(minimize_rss,x0,args=(decayed_values,larger_amount),xtol=1e-6,ftol=1e-6, disp=False)
-            fopt = minimize_rss(xopt, decayed_values, larger_amount)
-            hyp_discount_rate_nm = xopt[0]
-        except:
-            warnings.append(sys.exc_info()[1])
-            hyp_discount_rate_nm = 'NA'
-            fopt = 'NA'
-        return {"hyp_discount_rate_nm":hyp_discount_rate_nm, "min_rss":fopt} 
-
-    def calculate_discount_rate(data):
-        decayed_values = {}
-        for given_delay in list(set(data['later_time_days'])):
-            data_cut = data[data.later_time_days.isin([given_delay])]
-            decayed_values[given_delay] = get_hyp_decayed_value(data_cut)
-        discount_rate = optim_hyp_discount_rate_nm(decayed_values, list(set(data['larger_amount'])))['hyp_discount_rate_nm']
-        min_rss = optim_hyp_discount_rate_nm(decayed_values, list(set(data['larger_amount'])))['min_rss']
-        num_trials = data.shape[0]
-        return {"discount_rate":discount_rate, "min_rss":min_rss, "num_trials":num_trials}
-        
     def calculate_auc(data):
         decayed_values = {}
         for given_delay in list(set(data['later_time_days'])):
@@ -895,17 +1175,12 @@ def calc_bickel_DV(df, dvs = {}):
         return float(auc)
         
 
-    discount_rates = df.groupby('larger_amount').apply(calculate_discount_rate)
-        
-    dvs['hyp_discount_rate_small'] = {'value': discount_rates[10]['discount_rate'], 'valence': 'Neg'}
-    dvs['hyp_discount_rate_medium'] = {'value': discount_rates[1000]['discount_rate'], 'valence': 'Neg'}
-    dvs['hyp_discount_rate_large'] = {'value': discount_rates[1000000]['discount_rate'], 'valence': 'Neg'}
-    dvs['min_rss_small'] = {'value': discount_rates[10]['min_rss'], 'valence': 'Neg'}
-    dvs['min_rss_medium'] = {'value': discount_rates[1000]['min_rss'], 'valence': 'Neg'}
-    dvs['min_rss_large'] = {'value': discount_rates[1000000]['min_rss'], 'valence': 'Neg'}
-    dvs['num_trials_small'] = {'value': discount_rates[10]['num_trials'], 'valence': 'Pos'}
-    dvs['num_trials_medium'] = {'value': discount_rates[1000]['num_trials'], 'valence': 'Pos'}
-    dvs['num_trials_large'] = {'value': discount_rates[1000000]['num_trials'], 'valence': 'Pos'}
+    # discount rates of each reward size are fit for all workers by get_bickel_DVs
+    for size in ['small', 'medium', 'large']:
+        if 'hyp_discount_rate_' + size not in dvs:
+            warnings.append('Could not fit %s condition for worker_id: %s' % (size, df['worker_id'].iloc[0]))
+            for dv, valence in [('hyp_discount_rate_', 'Neg'), ('min_rss_', 'Neg'), ('num_trials_', 'Pos')]:
+                dvs[dv + size] = {'value': 'NA', 'valence': valence}
     dvs['auc_small'] = {'value': calculate_auc(df_small), 'valence': 'Pos'}
     dvs['auc_medium'] = {'value': calculate_auc(df_medium), 'valence': 'Pos'}
     dvs['auc_large'] = {'value': calculate_auc(df_large), 'valence': 'Pos'}
@@ -916,19 +1191,14 @@ def calc_bickel_DV(df, dvs = {}):
     One for each reward size ($10, $1000, $1000000)"""
     return dvs, description
 
-@group_decorate()
+@group_decorate(batch_funs = [lambda df: get_CCT_DVs(df, 'num_cards_chosen')])
 def calc_CCT_cold_DV(df, dvs = {}):
     """ Calculate dv for ccolumbia card task, cold version
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    rs = smf.ols(formula = 'num_cards_chosen ~ gain_amount + loss_amount + num_loss_cards', data = df).fit()
+    # sensitivities are calculated for all workers by get_CCT_DVs
     dvs['avg_cards_chosen'] = {'value':  df['num_cards_chosen'].mean(), 'valence': 'NA'}
-    dvs['gain_sensitivity'] = {'value':  rs.params['gain_amount'], 'valence': 'Pos'}
-    dvs['loss_sensitivity'] = {'value':  rs.params['loss_amount'], 'valence': 'Pos'}
-    dvs['probability_sensitivity'] = {'value':  rs.params['num_loss_cards'], 'valence': 'Pos'}
-    dvs['information_use'] = {'value':  numpy.sum(rs.pvalues[1:]<.05), 'valence': 'Pos'}
-    dvs['log_ll'] = {'value':  rs.llf, 'valence': 'NA'}
     dvs['num_trials'] = {'value': df.shape[0], 'valence': 'Pos'}
     description = """
         Avg_cards_chosen is a measure of risk ttaking
@@ -943,21 +1213,15 @@ def calc_CCT_cold_DV(df, dvs = {}):
     return dvs, description
 
 
-@group_decorate()
+@group_decorate(batch_funs = [lambda df: get_CCT_DVs(get_CCT_hot_subset(df), 'total_cards')])
 def calc_CCT_hot_DV(df, dvs = {}):
     """ Calculate dv for ccolumbia card task, cold version
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    df = df.query('mouse_click == "collectButton" and round_type == "rigged_win"').reset_index(drop = True)
-    subset = df[~df['clicked_on_loss_card'].astype(bool)]
-    rs = smf.ols(formula = 'total_cards ~ gain_amount + loss_amount + num_loss_cards', data = subset).fit()
+    subset = get_CCT_hot_subset(df)
+    # sensitivities are calculated for all workers by get_CCT_DVs
     dvs['avg_cards_chosen'] = {'value':  subset['total_cards'].mean(), 'valence': 'NA'}
-    dvs['gain_sensitivity'] = {'value':  rs.params['gain_amount'], 'valence': 'Pos'}
-    dvs['loss_sensitivity'] = {'value':  rs.params['loss_amount'], 'valence': 'Pos'}
-    dvs['probability_sensitivity'] = {'value':  rs.params['num_loss_cards'], 'valence': 'Pos'}
-    dvs['information_use'] = {'value':  numpy.sum(rs.pvalues[1:]<.05), 'valence': 'Pos'}
-    dvs['log_ll'] = {'value':  rs.llf, 'valence': 'NA'}
     dvs['num_trials'] = {'value': subset.shape[0], 'valence': 'Pos'}
     description = """
         Avg_cards_chosen is a measure of risk ttaking
@@ -979,11 +1243,16 @@ def calc_CCT_fmri_DV(df, dvs = {}):
     """
     # relable action as categorical variable
     df.loc[:,'action'] = pandas.Categorical(df.action, categories = ['draw_card', 'end_round'])
-    rs = smf.glm(formula = 'action ~ risk + EV + num_click_in_round', 
-                 data = df, family = sm.families.Binomial()).fit()
-    dvs['Intercept'] = {'value':  rs.params['Intercept'], 'valence': 'Pos'}
-    dvs['EV_sensitivity'] = {'value':  rs.params['EV'], 'valence': 'Pos'}
-    dvs['risk_sensitivity'] = {'value':  rs.params['risk'], 'valence': 'NA'}
+    # the binomial glm models the probability of the first category (draw_card)
+    df.loc[:,'draw_card'] = (df.action == 'draw_card').astype(float).where(df.action.notnull())
+    params = logit(df, 'draw_card', ['risk', 'EV', 'num_click_in_round'])
+    if not params['converged']:
+        rs = smf.glm(formula = 'action ~ risk + EV + num_click_in_round', 
+                     data = df, family = sm.families.Binomial()).fit()
+        params = rs.params
+    dvs['Intercept'] = {'value':  params['Intercept'], 'valence': 'Pos'}
+    dvs['EV_sensitivity'] = {'value':  params['EV'], 'valence': 'Pos'}
+    dvs['risk_sensitivity'] = {'value':  params['risk'], 'valence': 'NA'}
     description = """
         Expected value and risk are calculated for each choice. These independent
         variables are then used as predictors of choice: either taking a card
@@ -991,31 +1260,16 @@ def calc_CCT_fmri_DV(df, dvs = {}):
     """
     return dvs, description
     
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'choice_reaction_time'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'choice_reaction_time'},
+                batch_funs = [lambda df: get_standard_DVs(df, post_error_query = 'exp_stage == "test"'),
+                              group_EZ_diffusion])
 def calc_choice_reaction_time_DV(df, dvs = {}):
     """ Calculate dv for choice reaction time
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df.query('exp_stage == "test"'))
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
-    df_correct = df.query('correct == True').reset_index(drop = True)
-    
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df))
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
     
     description = 'standard'  
     return dvs, description
@@ -1028,7 +1282,10 @@ def calc_cognitive_reflection_DV(df, dvs = {}):
     description = 'how many questions were answered correctly (acc) or were mislead by the obvious lure (intuitive proportion'
     return dvs,description
 
-@group_decorate()
+@group_decorate(batch_funs = [lambda df: get_ols_DVs(df, 'coded_response', ['health_diff', 'taste_diff'],
+                                                     {'health_diff': ('health_sensitivity', 'Pos'),
+                                                      'taste_diff': ('taste_sensitivity', 'Neg'),
+                                                      'llf': ('log_ll', 'NA')})])
 def calc_dietary_decision_DV(df, dvs = {}):
     """ Calculate dv for dietary decision task. Calculate the effect of taste and
     health rating on choice
@@ -1036,10 +1293,7 @@ def calc_dietary_decision_DV(df, dvs = {}):
     :return description: descriptor of DVs
     """
     df = df[~ pandas.isnull(df['taste_diff'])].reset_index(drop = True)
-    rs = smf.ols(formula = 'coded_response ~ health_diff + taste_diff', data = df).fit()
-    dvs['health_sensitivity'] = {'value':  rs.params['health_diff'], 'valence': 'Pos'} 
-    dvs['taste_sensitivity'] = {'value':  rs.params['taste_diff'], 'valence': 'Neg'} 
-    dvs['log_ll'] = {'value':  rs.llf, 'valence': 'NA'}
+    # sensitivities are calculated for all workers by get_ols_DVs
     dvs['num_trials'] = {'value': df.shape[0], 'valence': 'Pos'}
     df_cut = df.query('exp_stage == "decision"')
     num_healthy = len(df_cut.query('health_diff>0 & (mouse_click == "Yes" | mouse_click == "Strong_Yes")'))
@@ -1078,32 +1332,18 @@ def calc_digit_span_DV(df, dvs = {}):
     description = 'Mean span after dropping the first 4 trials'  
     return dvs, description
 
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'directed_forgetting'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'directed_forgetting'},
+                batch_funs = [get_standard_DVs,
+                              lambda df: group_EZ_diffusion(df, condition = 'probe_type'),
+                              group_EZ_diffusion])
 def calc_directed_forgetting_DV(df, dvs = {}):
     """ Calculate dv for directed forgetting
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    post_error_slowing = get_post_error_slow(df)
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True').reset_index(drop = True)
     
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df, condition = 'probe_type'))
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     # context effects
     rt_contrast = df_correct.groupby('probe_type').rt.median()
     acc_contrast = df.groupby('probe_type').correct.mean()
@@ -1133,7 +1373,26 @@ def calc_directed_forgetting_DV(df, dvs = {}):
     """ 
     return dvs, description
     
-@group_decorate()
+def get_discount_fixed_DVs(group_df):
+    """ Fit the nelder-mead hyperbolic discount rate of the discount fixed task for every
+    worker at once with fit_hyp_discount_rate_nm
+    :return group_dvs: dictionary of dependent variables for each worker. If the fit fails,
+    no DVs are returned and each worker is fit separately
+    """
+    group_df = group_df[numpy.isfinite(group_df['small_amount'])]
+    group_df = group_df.assign(
+        patient1_impatient0 = numpy.where(group_df['choice'] == 'larger_later', 1, numpy.where(group_df['choice'] == 'smaller_sooner', 0, numpy.nan)),
+        sooner_delay = 0)
+    workers = pandas.unique(group_df['worker_id'])
+    try:
+        fits = fit_hyp_discount_rate_nm([group_df[group_df['worker_id'] == worker] for worker in workers],
+                                        'small_amount', 'sooner_delay', 'large_amount', 'later_delay')
+    except:
+        return {}
+    return {worker: {'hyp_discount_rate_nm': {'value': xopt[1], 'valence': 'Neg'}}
+            for worker, (xopt, fopt) in zip(workers, fits)}
+
+@group_decorate(batch_funs = [get_discount_fixed_DVs])
 def calc_discount_fixed_DV(df, dvs={}):
     #initiate warnings array for any errors during estimation
     warnings = []
@@ -1150,7 +1409,6 @@ def calc_discount_fixed_DV(df, dvs={}):
     
     df.insert(0, 'indiff_k', (df['large_amount'].astype(float) - df['small_amount'].astype(float))/(df['small_amount'].astype(float)*df['later_delay'].astype(float) - df['large_amount'].astype(float)*df['sooner_delay'].astype(float)).tolist())    
         
-    dvs = {}
     #Simples dv: percent of patient choices
     dvs['percent_patient'] = {'value': df['patient1_impatient0'].mean(), 'valence': 'NA'}
     #Second dv: hyperbolic discount rates calculated using glm on implied indifference discount rates by each choice
@@ -1169,8 +1427,12 @@ def calc_discount_fixed_DV(df, dvs={}):
             hyp_discount_rate_glm = min(data['indiff_k'])
         else:
             try:
-                rs = smf.glm(formula = 'patient1_impatient0 ~ indiff_k', data = data, family = sm.families.Binomial()).fit()
-                hyp_discount_rate_glm = -rs.params[0]/rs.params[1]
+                fit = logit(data, 'patient1_impatient0', ['indiff_k'])
+                if fit['converged']:
+                    hyp_discount_rate_glm = -fit['Intercept']/fit['indiff_k']
+                else:
+                    rs = smf.glm(formula = 'patient1_impatient0 ~ indiff_k', data = data, family = sm.families.Binomial()).fit()
+                    hyp_discount_rate_glm = -rs.params[0]/rs.params[1]
             except:                                                                         
                 #error behavior if glm fails
                 #first save error message
@@ -1199,50 +1461,10 @@ def calc_discount_fixed_DV(df, dvs={}):
     dvs['hyp_discount_rate_glm'] = {'value': calculate_hyp_discount_rate_glm(df), 'valence': 'Neg'}
     
     #Third dv: hyperbolic discount rates calculated using nelder-mead optimizations
-    def calculate_hyp_discount_rate_nm(x0, data):
-                
-        beta = x0[0]
-        k = x0[1]
-        
-        smaller_amount = list(data['small_amount'])
-        sooner_days = list(data['sooner_delay'])
-        larger_amount = list(data['large_amount'])
-        later_days = list(data['later_delay'])
-        patient1_impatient0 = list(data['patient1_impatient0'])
-
-        u_ss = []
-        for i in range(data.shape[0]):
-          u_ss.append(float(smaller_amount[i])/float(1+k*(float(sooner_days[i]))))
-        u_ll = []
-        for i in range(data.shape[0]):
-          u_ll.append(float(larger_amount[i])/float(1+k*(float(later_days[i]))))
-          
-        u_diff = [a - b for a, b in zip(u_ss, u_ll)]
-    
-        #Calculate choice probs
-        #logt: smaller beta (p[1]) larger error
-        
-        prob = [1/float((1+numpy.exp(beta*x))) for x in u_diff]
-    
-       #replace 1 and 0 to avoid log(1) and log(0)
-        prob = numpy.where(prob == 1, 0.9999, numpy.where(prob == 0, 0.0001, prob)).tolist()                                                            
-    
-        #get log likelihood
-        err = []
-        for i in range(data.shape[0]):
-            err.append((patient1_impatient0[i] * numpy.log(prob[i])) + ((1 - patient1_impatient0[i])*numpy.log(1-prob[i])))
-    
-        #sum of negative log likelihood (to be minimized)
-        sumerr = -1*sum(err)
-    
-        return sumerr
-
     def optim_hyp_discount_rate_nm(data):
-        from scipy import optimize
         hyp_discount_rate_nm = 0.0
         try:
-            x0=[0,0]
-            xopt = optimize.fmin(calculate_hyp_discount_rate_nm,x0,args=(data,),xtol=1e-6,ftol=1e-6, disp=False)
+            xopt, fopt = fit_hyp_discount_rate_nm([data], 'small_amount', 'sooner_delay', 'large_amount', 'later_delay')[0]
             hyp_discount_rate_nm = xopt[1]
         except:
             warnings.append(sys.exc_info()[1])
@@ -1254,7 +1476,9 @@ def calc_discount_fixed_DV(df, dvs={}):
                 hyp_discount_rate_nm = 'NA'
         return hyp_discount_rate_nm
             
-    dvs['hyp_discount_rate_nm'] = {'value': optim_hyp_discount_rate_nm(df), 'valence': 'Neg'}
+    # the discount rate is fit for all workers by get_discount_fixed_DVs
+    if 'hyp_discount_rate_nm' not in dvs:
+        dvs['hyp_discount_rate_nm'] = {'value': optim_hyp_discount_rate_nm(df), 'valence': 'Neg'}
                 
     #Add any warnings
     dvs['warnings'] = {'value': warnings, 'valence': 'NA'}
@@ -1264,7 +1488,33 @@ def calc_discount_fixed_DV(df, dvs={}):
     Used two optimization methods: glm and nelder-mead.
     """
     return dvs, description
-@group_decorate()
+def get_discount_titrate_DVs(group_df):
+    """ Fit the nelder-mead hyperbolic discount rates of the discount titrate task for all
+    trials, now trials and not now trials of every worker at once with fit_hyp_discount_rate_nm
+    :return group_dvs: dictionary of dependent variables for each worker. If the fit fails,
+    no DVs are returned and each worker is fit separately
+    """
+    group_df = group_df.query('exp_stage == "test"')
+    workers = pandas.unique(group_df['worker_id'])
+    datasets = []
+    for worker in workers:
+        df = group_df[group_df['worker_id'] == worker]
+        datasets += [df, df.query('now1_notnow0 == 1'), df.query('now1_notnow0 == 0')]
+    try:
+        fits = fit_hyp_discount_rate_nm(datasets, 'smaller_amount', 'sooner_days', 'larger_amount', 'later_days')
+    except:
+        return {}
+    group_dvs = {}
+    for i, worker in enumerate(workers):
+        dvs = group_dvs.setdefault(worker, {})
+        for suffix, data, (xopt, fopt) in zip(['', '_now', '_notnow'], datasets[3*i:3*i+3], fits[3*i:3*i+3]):
+            dvs['hyp_discount_rate_nm' + suffix] = {'value': xopt[1], 'valence': 'Neg'}
+            dvs['neg_log_ll_nm' + suffix] = {'value': fopt, 'valence': 'Pos' if suffix == '_now' else 'Neg'}
+            # num_trials_nm_notnow has always held the negative log likelihood
+            dvs['num_trials_nm' + suffix] = {'value': fopt if suffix == '_notnow' else data.shape[0], 'valence': 'Pos'}
+    return group_dvs
+
+@group_decorate(batch_funs = [get_discount_titrate_DVs])
 def calc_discount_titrate_DV(df, dvs = {}):
     """ Calculate dv for discount_titrate task
     :return dv: dictionary of dependent variables
@@ -1281,7 +1531,6 @@ def calc_discount_titrate_DV(df, dvs = {}):
     if df.shape[0] != 36:
         warnings.append('Incorrect number of trials for worker_id:'+ set(df['worker_id']))
     
-    dvs = {}
     #Simples dv: percent of patient choices
     dvs['percent_patient'] = {'value': df['patient1_impatient0'].mean(), 'valence': 'NA'}
     #Second dv: hyperbolic discount rates calculated using glm on implied indifference discount rates by each choice
@@ -1295,9 +1544,14 @@ def calc_discount_titrate_DV(df, dvs = {}):
             hyp_discount_rate_glm = min(data['indiff_k'])
         else:
             try:
-                rs = smf.glm(formula = 'patient1_impatient0 ~ indiff_k', data = data, family = sm.families.Binomial()).fit()
-                hyp_discount_rate_glm = -rs.params[0]/rs.params[1]
-                log_ll = rs.llf
+                fit = logit(data, 'patient1_impatient0', ['indiff_k'])
+                if fit['converged']:
+                    hyp_discount_rate_glm = -fit['Intercept']/fit['indiff_k']
+                    log_ll = fit['llf']
+                else:
+                    rs = smf.glm(formula = 'patient1_impatient0 ~ indiff_k', data = data, family = sm.families.Binomial()).fit()
+                    hyp_discount_rate_glm = -rs.params[0]/rs.params[1]
+                    log_ll = rs.llf
                 num_trials = data.shape[0]
             except:                                                                         
                 #error behavior if glm fails
@@ -1334,106 +1588,73 @@ def calc_discount_titrate_DV(df, dvs = {}):
     dvs['log_ll_glm'] = {'value': discount_rates_glm['log_ll'], 'valence': 'Neg'}
     dvs['num_trials_glm'] = {'value': discount_rates_glm['num_trials'], 'valence': 'Pos'}
     
-    #Third dv: hyperbolic discount rates calculated using nelder-mead optimizations
-    def calculate_hyp_discount_rate_nm(x0, data):
-                
-        beta = x0[0]
-        k = x0[1]
-        
-        smaller_amount = list(data['smaller_amount'])
-        sooner_days = list(data['sooner_days'])
-        larger_amount = list(data['larger_amount'])
-        later_days = list(data['later_days'])
-        patient1_impatient0 = list(data['patient1_impatient0'])
-
-        u_ss = []
-        for i in range(data.shape[0]):
-          u_ss.append(float(smaller_amount[i])/float(1+k*(float(sooner_days[i]))))
-        u_ll = []
-        for i in range(data.shape[0]):
-          u_ll.append(float(larger_amount[i])/float(1+k*(float(later_days[i]))))
-          
-        u_diff = [a - b for a, b in zip(u_ss, u_ll)]
-    
-        #Calculate choice probs
-        #logt: smaller beta (p[1]) larger error
-        
-        prob = [1/float((1+numpy.exp(beta*x))) for x in u_diff]
-    
-       #replace 1 and 0 to avoid log(1) and log(0)
-        prob = numpy.where(prob == 1, 0.9999, numpy.where(prob == 0, 0.0001, prob)).tolist()                                                            
-    
-        #get log likelihood
-        err = []
-        for i in range(data.shape[0]):
-            err.append((patient1_impatient0[i] * numpy.log(prob[i])) + ((1 - patient1_impatient0[i])*numpy.log(1-prob[i])))
-    
-        #sum of negative log likelihood (to be minimized)
-        sumerr = -1*sum(err)
+    df_now = df.query('now1_notnow0 == 1')
+    df_notnow = df.query('now1_notnow0 == 0')
     
-        return sumerr
-
-    def optim_hyp_discount_rate_nm(data):
-        hyp_discount_rate_nm = 0.0
-        try:
-            x0=[0,0]
-            xopt = optimize.fmin(calculate_hyp_discount_rate_nm,x0,args=(data,),xtol=1e-6,ftol=1e-6, disp=False)
-            hyp_discount_rate_nm = xopt[1]
-            fopt = calculate_hyp_discount_rate_nm(xopt, data)
-            num_trials = data.shape[0]
-        except:
-            warnings.append(sys.exc_info()[1])
-            if(set(data['patient1_impatient0']) == {0.0}):
-                hyp_discount_rate_nm = max(data['indiff_k'])
-                fopt= 'NA'
-                num_trials = data.shape[0]
-            elif(set(data['patient1_impatient0']) == {1.0}):
-                hyp_discount_rate_nm = min(data['indiff_k'])
-                fopt= 'NA'
-                num_trials = data.shape[0]
-            else:
-                hyp_discount_rate_nm = 'NA'
-                fopt = 'NA'
-                num_trials = 'NA'
-        return {"hyp_discount_rate_nm":hyp_discount_rate_nm, "neg_log_ll":fopt, "num_trials": num_trials}
-            
-    discount_rates_nm =  optim_hyp_discount_rate_nm(df)   
-
-    dvs['hyp_discount_rate_nm'] = {'value': discount_rates_nm['hyp_discount_rate_nm'], 'valence': 'Neg'}
-    dvs['neg_log_ll_nm'] = {'value': discount_rates_nm['neg_log_ll'], 'valence': 'Neg'}
-    dvs['num_trials_nm'] = {'value': discount_rates_nm['num_trials'], 'valence': 'Pos'}
-                
     #Fourth dv: discount rate glm for now trials only
-    df_now = df.query('now1_notnow0 == 1')
     
     discount_rates_glm_now = calculate_hyp_discount_rate_glm(df_now)
     
     dvs['hyp_discount_rate_glm_now'] = {'value': discount_rates_glm_now['hyp_discount_rate_glm'], 'valence': 'Neg'}
     dvs['log_ll_glm_now'] = {'value': discount_rates_glm_now['log_ll'], 'valence': 'Neg'}
     dvs['num_trials_glm_now'] = {'value': discount_rates_glm_now['num_trials'], 'valence': 'Pos'}
-    #Fifth dv: discount rate nm for now trials only
-    
-    discount_rates_nm_now = optim_hyp_discount_rate_nm(df_now)
-    
-    dvs['hyp_discount_rate_nm_now'] = {'value': discount_rates_nm_now['hyp_discount_rate_nm'], 'valence': 'Neg'}
-    dvs['neg_log_ll_nm_now'] = {'value': discount_rates_nm_now['neg_log_ll'], 'valence': 'Pos'}
-    dvs['num_trials_nm_now'] = {'value': discount_rates_nm_now['num_trials'], 'valence': 'Pos'}
 
     #Sixth dv: discount rate glm for not now trials only
-    df_notnow = df.query('now1_notnow0 == 0')
-    
     discount_rates_glm_notnow = calculate_hyp_discount_rate_glm(df_notnow)
     
     dvs['hyp_discount_rate_glm_notnow'] = {'value': discount_rates_glm_notnow['hyp_discount_rate_glm'], 'valence': 'Neg'}
     dvs['log_ll_glm_notnow'] = {'value': discount_rates_glm_notnow['log_ll'], 'valence': 'Neg'}
     dvs['num_trials_glm_notnow'] = {'value': discount_rates_glm_notnow['num_trials'], 'valence': 'Pos'}
-    #Seventh dv: discount rate nm for not now trials only
     
-    discount_rates_nm_notnow = optim_hyp_discount_rate_nm(df_notnow)
+    #Third, fifth and seventh dvs: nelder-mead discount rates of all, now and not now trials
+    #are fit for all workers by get_discount_titrate_DVs. If that fails, this worker is fit alone
+    if 'hyp_discount_rate_nm' not in dvs:
+        try:
+            nm_fits = fit_hyp_discount_rate_nm([df, df_now, df_notnow], 'smaller_amount', 'sooner_days', 'larger_amount', 'later_days')
+        except:
+            nm_fits = [sys.exc_info()[1]]*3
+        
+        def optim_hyp_discount_rate_nm(data, fit):
+            hyp_discount_rate_nm = 0.0
+            try:
+                if isinstance(fit, Exception):
+                    raise fit
+                xopt, fopt = fit
+                hyp_discount_rate_nm = xopt[1]
+                num_trials = data.shape[0]
+            except:
+                warnings.append(sys.exc_info()[1])
+                if(set(data['patient1_impatient0']) == {0.0}):
+                    hyp_discount_rate_nm = max(data['indiff_k'])
+                    fopt= 'NA'
+                    num_trials = data.shape[0]
+                elif(set(data['patient1_impatient0']) == {1.0}):
+                    hyp_discount_rate_nm = min(data['indiff_k'])
+                    fopt= 'NA'
+                    num_trials = data.shape[0]
+                else:
+                    hyp_discount_rate_nm = 'NA'
+                    fopt = 'NA'
+                    num_trials = 'NA'
+            return {"hyp_discount_rate_nm":hyp_discount_rate_nm, "neg_log_ll":fopt, "num_trials": num_trials}
+                
+        discount_rates_nm =  optim_hyp_discount_rate_nm(df, nm_fits[0])   
     
-    dvs['hyp_discount_rate_nm_notnow'] = {'value': discount_rates_nm_notnow['hyp_discount_rate_nm'], 'valence': 'Neg'}
-    dvs['neg_log_ll_nm_notnow'] = {'value': discount_rates_nm_notnow['neg_log_ll'], 'valence': 'Neg'}
-    dvs['num_trials_nm_notnow'] = {'value': discount_rates_nm_notnow['neg_log_ll'], 'valence': 'Pos'}
+        dvs['hyp_discount_rate_nm'] = {'value': discount_rates_nm['hyp_discount_rate_nm'], 'valence': 'Neg'}
+        dvs['neg_log_ll_nm'] = {'value': discount_rates_nm['neg_log_ll'], 'valence': 'Neg'}
+        dvs['num_trials_nm'] = {'value': discount_rates_nm['num_trials'], 'valence': 'Pos'}
+        
+        discount_rates_nm_now = optim_hyp_discount_rate_nm(df_now, nm_fits[1])
+        
+        dvs['hyp_discount_rate_nm_now'] = {'value': discount_rates_nm_now['hyp_discount_rate_nm'], 'valence': 'Neg'}
+        dvs['neg_log_ll_nm_now'] = {'value': discount_rates_nm_now['neg_log_ll'], 'valence': 'Pos'}
+        dvs['num_trials_nm_now'] = {'value': discount_rates_nm_now['num_trials'], 'valence': 'Pos'}
+        
+        discount_rates_nm_notnow = optim_hyp_discount_rate_nm(df_notnow, nm_fits[2])
+        
+        dvs['hyp_discount_rate_nm_notnow'] = {'value': discount_rates_nm_notnow['hyp_discount_rate_nm'], 'valence': 'Neg'}
+        dvs['neg_log_ll_nm_notnow'] = {'value': discount_rates_nm_notnow['neg_log_ll'], 'valence': 'Neg'}
+        dvs['num_trials_nm_notnow'] = {'value': discount_rates_nm_notnow['neg_log_ll'], 'valence': 'Pos'}
     
     #Add any warnings
     dvs['warnings'] = {'value': warnings, 'valence': 'NA'}
@@ -1444,36 +1665,20 @@ def calc_discount_titrate_DV(df, dvs = {}):
     """
     return dvs, description
     
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'dot_pattern_expectancy'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'dot_pattern_expectancy'},
+                batch_funs = [get_standard_DVs,
+                              lambda df: group_EZ_diffusion(df, condition = 'condition'),
+                              group_EZ_diffusion])
 def calc_DPX_DV(df, dvs = {}):
     """ Calculate dv for dot pattern expectancy task
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
     N = df.trial_num.max()+1
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True').reset_index(drop = True)
     
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df, condition = 'condition'))
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     # calculate Dprime, adjusting extreme values using the fourth suggestion from 
     # Stanislaw, H., & Todorov, N. (1999). Calculation of signal detection theory measures.
     hit_rate = min(df.query('condition == "AX"').correct.mean(), 1-(.5/N))
@@ -1554,30 +1759,15 @@ def calc_go_nogo_DV(df, dvs = {}):
     """
     return dvs, description
     
-@group_decorate()
+@group_decorate(batch_funs = [get_standard_DVs])
 def calc_hierarchical_rule_DV(df, dvs = {}):
     """ Calculate dv for hierarchical learning task. 
     DVs
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
-    df_correct = df.query('correct == True').reset_index(drop = True)
-        
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     
     #calculate hierarchical success
     dvs['score'] = {'value':  df['correct'].sum(), 'valence': 'Pos'} 
@@ -1585,7 +1775,84 @@ def calc_hierarchical_rule_DV(df, dvs = {}):
     description = 'average reaction time'  
     return dvs, description
 	
-@group_decorate()
+def calculate_holt_laury_nll(params, safe1_risky0, mask):
+    """ Negative log likelihood of choices in the holt and laury task. The lotteries are the same
+    for every worker, so parameters and choices of many workers (or parameter sets) are broadcast
+    against each other
+    :params: (..., 3) array of risk aversion, prob weighting and beta
+    :safe1_risky0: (..., trials) array of choices, one per lottery
+    :mask: (..., trials) boolean array labeling which choices exist
+    :return neg_log_ll: array of negative log likelihoods
+    """
+    risk_aversion = params[..., 0, None]
+    prob_weighting = params[..., 1, None]
+    beta = params[..., 2, None]
+    #These could either be input or parsed from stimuli
+    amt1_safe = 100 
+    amt2_safe = 80
+    amt1_risky = 190
+    amt2_risky = 5
+    prob = numpy.arange(0.1, 1.1, 0.1)[:safe1_risky0.shape[-1]]
+    weight1 = numpy.exp(-pow(-numpy.log(prob), 1-prob_weighting))
+    weight2 = numpy.exp(-pow(-numpy.log(1-prob), 1-prob_weighting))
+    u_safe = weight1*pow(amt1_safe, 1-risk_aversion) + weight2*pow(amt2_safe, 1-risk_aversion)
+    u_risky = weight1*pow(amt1_risky, 1-risk_aversion) + weight2*pow(amt2_risky, 1-risk_aversion)
+    #Calculate choice probs
+    #logt: smaller beta (p[1]) larger error
+    choice_prob = 1/(1+numpy.exp(beta*(u_risky - u_safe)))
+    err = (safe1_risky0 * numpy.log(choice_prob)) + ((1 - safe1_risky0)*numpy.log(1-choice_prob))
+    err = numpy.where(mask, err, 0)
+    #sum in trial order
+    sumerr = 0
+    for i in range(err.shape[-1]):
+        sumerr = sumerr + err[..., i]
+    return -1*sumerr
+
+def get_holt_laury_DVs(group_df):
+    """ Fit risk aversion, prob weighting and beta for every worker of the holt and laury task.
+    A coarse grid of parameters is evaluated for all workers at once, then nelder-mead is run
+    from the best grid point and from the default starting point [.5, .5, 1], keeping the fit
+    with the lower negative log likelihood
+    :return group_dvs: dictionary of dependent variables for each worker. Workers with more
+    choices than lotteries are left out
+    """
+    grouped = group_df.groupby('worker_id', sort = False)
+    num_trials = grouped.size()
+    workers = num_trials.index[num_trials <= 10]
+    if len(workers) == 0:
+        return {}
+    safe1_risky0 = numpy.zeros((len(workers), 10))
+    mask = numpy.zeros((len(workers), 10), dtype = bool)
+    for i, worker in enumerate(workers):
+        choices = grouped.get_group(worker)['safe1_risky0'].values
+        safe1_risky0[i, :len(choices)] = choices
+        mask[i, :len(choices)] = True
+    
+    with numpy.errstate(all = 'ignore'):
+        # coarse grid search
+        grid = numpy.stack(numpy.meshgrid(numpy.linspace(-1, 1.5, 11), numpy.linspace(-.5, .9, 8), 
+                                          numpy.logspace(-3, 1, 9), indexing = 'ij'), -1).reshape(-1, 3)
+        grid_nll = calculate_holt_laury_nll(grid[None], safe1_risky0[:, None], mask[:, None])
+        grid_nll[numpy.isnan(grid_nll)] = numpy.inf
+        x0 = numpy.vstack([numpy.tile([0.5, 0.5, 1], (len(workers), 1)), grid[grid_nll.argmin(1)]])
+        # local refinement from both starting points
+        xopt, fopt, _ = batch_fmin(lambda params: calculate_holt_laury_nll(params, numpy.vstack([safe1_risky0]*2), numpy.vstack([mask]*2)),
+                                   x0, xtol=1e-6, ftol=1e-6)
+    default_fit = slice(0, len(workers))
+    grid_fit = slice(len(workers), None)
+    use_grid = fopt[grid_fit] < fopt[default_fit]
+    xopt = numpy.where(use_grid[:, None], xopt[grid_fit], xopt[default_fit])
+    fopt = numpy.where(use_grid, fopt[grid_fit], fopt[default_fit])
+    
+    group_dvs = {}
+    for worker, (risk_aversion, prob_weighting, beta), neg_log_ll in zip(workers, xopt, fopt):
+        group_dvs[worker] = {'risk_aversion': {'value': risk_aversion, 'valence': 'Neg'},
+                             'prob_weighting': {'value': prob_weighting, 'valence': 'Neg'},
+                             'beta': {'value': beta, 'valence': 'NA'},
+                             'neg_log_ll': {'value': neg_log_ll, 'valence': 'NA'}}
+    return group_dvs
+
+@group_decorate(batch_funs = [get_holt_laury_DVs])
 def calc_holt_laury_DV(df, dvs = {}):				
 	#total number of safe choices
 	#adding total number of risky choices too in case we are aiming for DVs where higher means more impulsive
@@ -1600,104 +1867,12 @@ def calc_holt_laury_DV(df, dvs = {}):
     dvs['risky_choices'] = {'value': 10 - df['safe1_risky0'].sum(), 'valence': 'NA'} 
 
     warnings = []
-
-    def calculate_risk_aversion_nm(x0, data):
-                
-        risk_aversion = x0[0]
-        prob_weighting = x0[1]
-        beta = x0[2]
-
-        #limit parameter space brute force
-#        if risk_aversion>1:
-#            risk_aversion = 1
-#        elif risk_aversion<0:
-#            risk_aversion = 0
-#            
-#        if prob_weighting>1:
-#            prob_weighting = 1
-#        elif prob_weighting<0:
-#            prob_weighting = 0
-
-        #These could either be input or parsed from stimuli
-        amt1_safe = 100 
-        amt2_safe = 80
-        amt1_risky = 190
-        amt2_risky = 5
-#        pred_choices = []
-        u_safe = []
-        u_risky = []
-        safe1_risky0 = list(data['safe1_risky0'])
-        
-        for prob in numpy.arange(0.1, 1.1, 0.1):
-#            u_safe = numpy.exp(-pow(-numpy.log(prob), 1-prob_weighting))*pow(amt1_safe, 1-risk_aversion)+ numpy.exp(-pow(-numpy.log(1-prob), 1-prob_weighting))*pow(amt2_safe, 1-risk_aversion)
-#            u_risky = numpy.exp(-pow(-numpy.log(prob), 1-prob_weighting))*pow(amt1_risky, 1-risk_aversion)+ numpy.exp(-pow(-numpy.log(1-prob), 1-prob_weighting))*pow(amt2_risky, 1-risk_aversion)
-#            if u_safe>u_risky:
-#                pred_choices.append(1)
-#            elif u_safe<u_risky:
-#                pred_choices.append(0)
-#            else:
-#                pred_choices.append(numpy.random.binomial(1,0.5))
-            u_safe.append(numpy.exp(-pow(-numpy.log(prob), 1-prob_weighting))*pow(amt1_safe, 1-risk_aversion)+ numpy.exp(-pow(-numpy.log(1-prob), 1-prob_weighting))*pow(amt2_safe, 1-risk_aversion))
-            u_risky.append(numpy.exp(-pow(-numpy.log(prob), 1-prob_weighting))*pow(amt1_risky, 1-risk_aversion)+ numpy.exp(-pow(-numpy.log(1-prob), 1-prob_weighting))*pow(amt2_risky, 1-risk_aversion))
-
-               
-        #get error percent (choice is hardmax not stochastic)
-#        real_choices = data['safe1_risky0']
-#        match_vector = real_choices == pred_choices
-#        error_percent = 1-float(sum(match_vector))/data.shape[0]
-#        
-#        return error_percent
-
-        u_diff = [a - b for a, b in zip(u_risky, u_safe)]
-    
-        #Calculate choice probs
-        #logt: smaller beta (p[1]) larger error
-        
-        choice_prob = [1/float((1+numpy.exp(beta*x))) for x in u_diff]
-    
-       #replace 1 and 0 to avoid log(1) and log(0)
-        choice_prob = numpy.where(choice_prob == 1, 0.9999, numpy.where(choice_prob == 0, 0.0001, choice_prob)).tolist()                                                            
     
-        #get log likelihood
-        err = []
-        for i in range(data.shape[0]):
-            err.append((safe1_risky0[i] * numpy.log(choice_prob[i])) + ((1 - safe1_risky0[i])*numpy.log(1-choice_prob[i])))
-    
-        #sum of negative log likelihood (to be minimized)
-        sumerr = -1*sum(err)
-    
-        return sumerr
-        
-    def optim_risk_aversion_nm(data):
-        risk_aversion = 0.0
-        prob_weighting = 0.0
-        try:
-            x0=[0.5,0.5,1]
-            xopt = optimize.fmin(calculate_risk_aversion_nm,x0,args=(data,),xtol=1e-6,ftol=1e-6, disp=False)
-            risk_aversion = xopt[0]
-            prob_weighting = xopt[1]
-            beta = xopt[2]
-            neg_log_ll = calculate_risk_aversion_nm(xopt, data)
-        except:
-            warnings.append(sys.exc_info()[1])
-            if(set(data['safe1_risky0']) == {0.0}):
-                risk_aversion = -0.95
-                beta = 'NA'
-            elif(set(data['safe1_risky0']) == {1.0}):
-                risk_aversion = 1.37
-                beta = 'NA'
-            else:
-                risk_aversion = 'NA'
-                prob_weighting = 'NA'
-                beta = 'NA'
-                neg_log_ll='NA'
-        return [risk_aversion, prob_weighting, beta, neg_log_ll]
-
-
-    dvs['risk_aversion'] = {'value': optim_risk_aversion_nm(df)[0], 'valence': 'Neg'}
-    dvs['prob_weighting'] = {'value': optim_risk_aversion_nm(df)[1], 'valence': 'Neg'}
-    dvs['beta'] = {'value': optim_risk_aversion_nm(df)[2], 'valence': 'NA'}
-    dvs['neg_log_ll'] = {'value': optim_risk_aversion_nm(df)[3], 'valence': 'NA'}
+    # risk aversion, prob weighting and beta are fit for all workers by get_holt_laury_DVs
+    if 'risk_aversion' not in dvs:
+        warnings.append('Incorrect number of trials for worker_id: %s' % df['worker_id'].iloc[0])
+        for dv, valence in [('risk_aversion', 'Neg'), ('prob_weighting', 'Neg'), ('beta', 'NA'), ('neg_log_ll', 'NA')]:
+            dvs[dv] = {'value': 'NA', 'valence': valence}
     #Add any warnings
     dvs['warnings'] = {'value': warnings, 'valence': 'NA'}   
 
@@ -1739,7 +1914,76 @@ def calc_keep_track_DV(df, dvs = {}):
     description = 'percentage of items remembered correctly'  
     return dvs, description
     
-@group_decorate()
+def get_group_kirby_discount_rate(group_df, possible_ks, predict_patient, condition = None):
+    """ Calculate the discount rate that best matches each worker's choices from a grid
+    of possible discount rates. The whole grid is evaluated against every trial at once
+    :possible_ks: list of possible discount rates
+    :predict_patient: function taking (k, large_amount, small_amount, later_delay) arrays 
+    that returns whether the larger later reward is preferred
+    :condition: optional column. If provided, discount rates are calculated for each level
+    :return rates: dataframe indexed by worker (and condition) with the geometric mean of 
+    the discount rates that match the most choices (discount_rate) and the percentage of
+    choices they match (max_match_pct)
+    """
+    keys = ['worker_id']
+    if condition is not None:
+        keys.append(condition)
+    # rows with a missing key belong to no cell
+    group_df = group_df.dropna(subset = keys)
+    grouped = group_df.groupby(keys)
+    cell_codes = grouped.ngroup().values
+    ks = numpy.array(possible_ks)
+    # (possible_ks, trials) array of predicted choices
+    pred_choices = numpy.where(predict_patient(ks[:, None], group_df['large_amount'].values,
+                                               group_df['small_amount'].values, 
+                                               group_df['later_delay'].values), 1, 0)
+    match_matrix = group_df['patient1_impatient0'].values == pred_choices
+    match_counts = pandas.DataFrame(match_matrix.T).groupby(cell_codes).sum().values
+    max_counts = match_counts.max(1)
+    # take the geometric mean of tied discount rates, once for each pattern of ties
+    ties, tie_index = numpy.unique(match_counts == max_counts[:, None], axis = 0, return_inverse = True)
+    tie_rates = numpy.array([mstats.gmean(ks[tied], axis = 0) for tied in ties])
+    return pandas.DataFrame({'discount_rate': tie_rates[tie_index.ravel()],
+                             'max_match_pct': max_counts/grouped.size().values.astype(float)},
+                            index = grouped.size().index)
+
+def get_kirby_DVs(group_df):
+    """ Calculate hyperbolic and exponential discount rates for every worker of the
+    kirby task, overall and for each reward size
+    :return group_dvs: dictionary of dependent variables for each worker
+    """
+    #filter only the test stage choice data
+    group_df = group_df.query('exp_stage == "test"')
+    
+    #Helper function to get geometric means
+    def geo_mean(l):
+        return mstats.gmean(l, axis=0)
+    
+    hyp_ks = [0.00016, geo_mean([0.00016, 0.0004]), geo_mean([0.0004, 0.001]), geo_mean([0.001, 0.0025]), geo_mean([0.0025, 0.006]), geo_mean([0.006, 0.016]), geo_mean([0.016, 0.041]), geo_mean([0.041, 0.10]), geo_mean([0.1, 0.25]), 0.25]
+    #small_amt = (exp_k**later_del) * large_amt
+    #(exp_k**later_del) = small_amt/large_amt
+    #exp_k = (small_amt/large_amt)**(1/later_del)    
+    exp_ks = [0.866, geo_mean([0.866, 0.938]), geo_mean([0.938, 0.970]), geo_mean([0.970, 0.987]), geo_mean([0.987, 0.994]), geo_mean([0.994, 0.997]), geo_mean([0.997, 0.999]), geo_mean([0.999, 0.9996]), geo_mean([0.9996, 0.9998]), 0.9998]
+    models = {'hyp': (hyp_ks, lambda k, large, small, delay: large/(1+k*delay) > small),
+              'exp': (exp_ks, lambda k, large, small, delay: large*(k**delay) > small)}
+    
+    group_dvs = {}
+    for model, (possible_ks, predict_patient) in models.items():
+        rates = get_group_kirby_discount_rate(group_df, possible_ks, predict_patient)
+        size_rates = get_group_kirby_discount_rate(group_df, possible_ks, predict_patient, condition = 'reward_size')
+        for worker, row in rates.iterrows():
+            dvs = group_dvs.setdefault(worker, {})
+            dvs[model + '_discount_rate'] = {'value': row['discount_rate'], 'valence': 'Neg'}
+            dvs[model + '_match_pct'] = {'value': row['max_match_pct'], 'valence': 'Neg'}
+        for (worker, size), row in size_rates.iterrows():
+            if size not in ['small', 'medium', 'large']:
+                continue
+            dvs = group_dvs.setdefault(worker, {})
+            dvs[model + '_discount_rate_' + size] = {'value': row['discount_rate'], 'valence': 'Neg'}
+            dvs[model + '_match_pct_' + size] = {'value': row['max_match_pct'], 'valence': 'Neg'}
+    return group_dvs
+
+@group_decorate(batch_funs = [get_kirby_DVs])
 def calc_kirby_DV(df, dvs = {}):
     """ Calculate dv for kirby task
     :return dv: dictionary of dependent variables
@@ -1778,80 +2022,7 @@ def calc_kirby_DV(df, dvs = {}):
 
    
     
-    #Helper function to get geometric means
-    def geo_mean(l):
-        return mstats.gmean(l, axis=0)
-				
-    #Function to calculate discount rates			
-    def calculate_discount_rate(data):
-					
-        def get_match_percent(k, data):
-            real_choices = data['patient1_impatient0']
-            pred_choices = numpy.where(data['large_amount']/(1+k*data['later_delay']) > data['small_amount'], 1, 0)	
-            match_vector = real_choices == pred_choices
-            match_percent = float(sum(match_vector))/data.shape[0]
-            return match_percent
-    
-        possible_ks = [0.00016, geo_mean([0.00016, 0.0004]), geo_mean([0.0004, 0.001]), geo_mean([0.001, 0.0025]), geo_mean([0.0025, 0.006]), geo_mean([0.006, 0.016]), geo_mean([0.016, 0.041]), geo_mean([0.041, 0.10]), geo_mean([0.1, 0.25]), 0.25]
-        
-        match_percentages = {}
-
-        for current_k in possible_ks:
-            match_percentages[current_k] = get_match_percent(current_k, data)	
-												
-        discount_rate = geo_mean([k for k in match_percentages if match_percentages.get(k) == max(match_percentages.values())])
-					
-        return {"discount_rate": discount_rate, "max_match_pct":max(match_percentages.values())}
-        
-        
-    def calculate_exp_discount_rate(data):
-					
-        def get_match_percent(exp_k, data):
-            real_choices = data['patient1_impatient0']
-            pred_choices = numpy.where(data['large_amount']*(exp_k**data['later_delay']) > data['small_amount'], 1, 0)	
-            match_vector = real_choices == pred_choices
-            match_percent = float(sum(match_vector))/data.shape[0]
-            return match_percent
-    
-        #small_amt = (exp_k**later_del) * large_amt
-        #(exp_k**later_del) = small_amt/large_amt
-        #exp_k = (small_amt/large_amt)**(1/later_del)    
-            
-        possible_ks = [0.866, geo_mean([0.866, 0.938]), geo_mean([0.938, 0.970]), geo_mean([0.970, 0.987]), geo_mean([0.987, 0.994]), geo_mean([0.994, 0.997]), geo_mean([0.997, 0.999]), geo_mean([0.999, 0.9996]), geo_mean([0.9996, 0.9998]), 0.9998]
-        
-        match_percentages = {}
-
-        for current_k in possible_ks:
-            match_percentages[current_k] = get_match_percent(current_k, data)	
-												
-        discount_rate = geo_mean([k for k in match_percentages if match_percentages.get(k) == max(match_percentages.values())])
-					
-        return {"discount_rate": discount_rate, "max_match_pct":max(match_percentages.values())}
-	
-    dvs['hyp_discount_rate'] = {'value': calculate_discount_rate(df)['discount_rate'], 'valence': 'Neg'}
-
-    hyp_discount_rates = df.groupby('reward_size').apply(calculate_discount_rate)
-
-    dvs['hyp_discount_rate_small'] = {'value': hyp_discount_rates['small']['discount_rate'], 'valence': 'Neg'}
-    dvs['hyp_discount_rate_medium'] = {'value': hyp_discount_rates['medium']['discount_rate'], 'valence': 'Neg'}
-    dvs['hyp_discount_rate_large'] = {'value': hyp_discount_rates['large']['discount_rate'], 'valence': 'Neg'}
-
-    dvs['exp_discount_rate'] = {'value': calculate_exp_discount_rate(df)['discount_rate'], 'valence': 'Neg'}
-    
-    exp_discount_rates = df.groupby('reward_size').apply(calculate_exp_discount_rate)
-
-    dvs['exp_discount_rate_small'] = {'value': exp_discount_rates['small']['discount_rate'], 'valence': 'Neg'}
-    dvs['exp_discount_rate_medium'] = {'value': exp_discount_rates['medium']['discount_rate'], 'valence': 'Neg'}
-    dvs['exp_discount_rate_large'] = {'value': exp_discount_rates['large']['discount_rate'], 'valence': 'Neg'}
-
-    dvs['hyp_match_pct'] = {'value': calculate_discount_rate(df)['max_match_pct'], 'valence': 'Neg'}
-    dvs['hyp_match_pct_small'] = {'value': hyp_discount_rates['small']['max_match_pct'], 'valence': 'Neg'}
-    dvs['hyp_match_pct_medium'] = {'value': hyp_discount_rates['medium']['max_match_pct'], 'valence': 'Neg'}
-    dvs['hyp_match_pct_large'] = {'value': hyp_discount_rates['large']['max_match_pct'], 'valence': 'Neg'}
-    dvs['exp_match_pct'] = {'value': calculate_exp_discount_rate(df)['max_match_pct'], 'valence': 'Neg'}
-    dvs['exp_match_pct_small'] = {'value': exp_discount_rates['small']['max_match_pct'], 'valence': 'Neg'}
-    dvs['exp_match_pct_medium'] = {'value': exp_discount_rates['medium']['max_match_pct'], 'valence': 'Neg'}
-    dvs['exp_match_pct_large'] = {'value': exp_discount_rates['large']['max_match_pct'], 'valence': 'Neg'}
+    #discount rates are calculated for all workers by get_kirby_DVs
 	
     #Add any warnings
     dvs['warnings'] = {'value': warnings, 'valence': 'NA'}   
@@ -1861,7 +2032,10 @@ def calc_kirby_DV(df, dvs = {}):
     One for all items, and three depending on the reward size (small, medium, large)"""
     return dvs, description
     
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'local_global_letter'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'local_global_letter'},
+                batch_funs = [lambda df: get_standard_DVs(df, post_error_query = 'exp_stage == "test"'),
+                              lambda df: group_EZ_diffusion(df, condition = 'conflict_condition'),
+                              group_EZ_diffusion])
 def calc_local_global_DV(df, dvs = {}):
     """ Calculate dv for hierarchical learning task. 
     DVs
@@ -1873,27 +2047,10 @@ def calc_local_global_DV(df, dvs = {}):
     if 'correct_shift' not in df.columns:
         df.insert(0, 'correct_shift', df.correct.shift(1))
     
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df.query('exp_stage == "test"'))
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True').reset_index(drop = True)
     
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     # ****** Get congruency effects *******************************************
     rt_contrast = df_correct.groupby('conflict_condition').rt.median()
     acc_contrast = df.groupby('conflict_condition').correct.mean()
@@ -1905,7 +2062,6 @@ def calc_local_global_DV(df, dvs = {}):
     dvs['conflict_rt'] = {'value':  dvs['congruent_facilitation_rt']['value'] + dvs['incongruent_harm_rt']['value'], 'valence': 'Neg'} 
     dvs['conflict_acc'] = {'value':  dvs['congruent_facilitation_acc']['value'] + dvs['incongruent_harm_acc']['value'], 'valence': 'Pos'} 
     # DDM equivalents
-    dvs.update(EZ_diffusion(df, condition = 'conflict_condition'))
     if set(['EZ_drift_congruent', 'EZ_drift_incongruent']) <= set(dvs.keys()):
         dvs['conflict_EZ_drift'] = {'value':  dvs['EZ_drift_incongruent']['value'] - dvs['EZ_drift_congruent']['value'], 'valence': 'Pos'}
         dvs['conflict_EZ_thresh'] = {'value':  dvs['EZ_thresh_incongruent']['value'] - dvs['EZ_thresh_congruent']['value'], 'valence': 'Pos'}
@@ -1994,7 +2150,9 @@ def calc_local_global_DV(df, dvs = {}):
     """
     return dvs, description
 
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'motor_selective_stop_signal'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'motor_selective_stop_signal'},
+                batch_funs = [lambda df: get_SSRT_DVs(df, trial_type_col = 'condition',
+                                                      query = 'exp_stage not in ["practice","NoSS_practice"] and correct_response == stop_response')])
 def calc_motor_selective_stop_signal_DV(df, dvs = {}):
     # subset df to test trials
     df = df.query('exp_stage not in ["practice","NoSS_practice"]').reset_index(drop = True)
@@ -2030,16 +2188,8 @@ def calc_motor_selective_stop_signal_DV(df, dvs = {}):
         if set(['hddm_' + param + '_ignore', 'hddm_' + param + '_go']) <= set(dvs.keys()):
             dvs['reactive_control_hddm_' + param] = {'value':  dvs['hddm_' + param + '_ignore']['value'] - dvs['hddm_' + param + '_go']['value'], 'valence': param_valence[param]}
         
-            
-    # calculate SSRT for critical trials
-    go_trials = df.query('condition == "go" and critical_key=="critical"')
-    stop_trials = df.query('condition == "stop" and critical_key=="critical"')
-    sorted_go = go_trials.query('rt != -1').rt.sort_values(ascending = True)
-    prob_stop_failure = (1-stop_trials.stopped.mean())
-    corrected = prob_stop_failure/numpy.mean(go_trials.rt!=-1)
-    index = corrected*(len(sorted_go)-1)
-    index = [floor(index), ceil(index)]
-    dvs['SSRT'] = {'value': sorted_go.iloc[index].mean() - stop_trials.SS_delay.mean(), 'valence': 'Neg'}
+    
+    # SSRT for critical trials is calculated for all workers by get_SSRT_DVs
     
     # Condition metrics
     reactive_control = df.query('condition == "ignore" and correct == True and critical_key == "non-critical"').rt.median() - \
@@ -2101,11 +2251,20 @@ def calc_probabilistic_selection_DV(df, dvs = {}):
     df.loc[:, 'choice'] = df['key_press'].map(lambda x: ['right','left'][x == 37]).astype('category', categories = ['left','right'])
     df.loc[:,'choice_lag'] = df['choice'].shift(1)
     test = df.query('exp_stage == "test"')
-    rs = smf.glm(formula = 'choice ~ value_diff*value_sum - value_sum + choice_lag', data = test, family = sm.families.Binomial()).fit()
-    
-    dvs['value_sensitivity'] = {'value':  rs.params['value_diff'], 'valence': 'Pos'} 
-    dvs['positive_learning_bias'] = {'value':  rs.params['value_diff:value_sum'], 'valence': 'NA'}
-    dvs['log_ll'] = {'value':  rs.llf, 'valence': 'NA'}
+    # build the design of 'choice ~ value_diff*value_sum - value_sum + choice_lag', where
+    # the binomial glm models the probability of the first category (left)
+    design = test.assign(**{'choice_left': (test.choice == 'left').astype(float).where(test.choice.notnull()),
+                            'value_diff:value_sum': test.value_diff*test.value_sum,
+                            'choice_lag[T.right]': (test.choice_lag == 'right').astype(float).where(test.choice_lag.notnull())})
+    params = logit(design, 'choice_left', ['value_diff', 'value_diff:value_sum', 'choice_lag[T.right]'])
+    log_ll = params['llf']
+    if not params['converged']:
+        rs = smf.glm(formula = 'choice ~ value_diff*value_sum - value_sum + choice_lag', data = test, family = sm.families.Binomial()).fit()
+        params, log_ll = rs.params, rs.llf
+    
+    dvs['value_sensitivity'] = {'value':  params['value_diff'], 'valence': 'Pos'} 
+    dvs['positive_learning_bias'] = {'value':  params['value_diff:value_sum'], 'valence': 'NA'}
+    dvs['log_ll'] = {'value':  log_ll, 'valence': 'NA'}
     dvs['num_trials'] = {'value':  test.shape[0], 'valence': 'Pos'} 
     dvs['overall_test_acc'] = {'value':  test['correct'].mean(), 'valence': 'Pos'} 
     dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'} 
@@ -2182,38 +2341,24 @@ def calc_ravens_DV(df, dvs = {}):
     description = 'Score is the number of correct responses out of 18'
     return dvs,description    
     
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'recent_probes'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'recent_probes'},
+                batch_funs = [get_standard_DVs,
+                              lambda df: group_EZ_diffusion(df, condition = 'probeType'),
+                              group_EZ_diffusion])
 def calc_recent_probes_DV(df, dvs = {}):
     """ Calculate dv for recent_probes
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    post_error_slowing = get_post_error_slow(df)
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True').reset_index(drop = True)
     
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df, condition = 'probeType'))
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
     # get single diffusion parameters over all not-recent probes
     xrec_diffusion = EZ_diffusion(df.query('probeType in ["xrec_pos", "xrec_neg"]'))
     dvs['EZ_drift_xrec'] = xrec_diffusion['EZ_drift']
     dvs['EZ_thresh_xrec'] = xrec_diffusion['EZ_thresh']    
     dvs['EZ_non_decision_xrec'] = xrec_diffusion['EZ_non_decision']
     
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     # calculate contrast dvs
     rt_contrast = df_correct.groupby('probeType').rt.median()
     acc_contrast = df.groupby('probeType').correct.mean()
@@ -2243,36 +2388,19 @@ def calc_recent_probes_DV(df, dvs = {}):
     """ 
     return dvs, description
     
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'shape_matching'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'shape_matching'},
+                batch_funs = [lambda df: get_standard_DVs(df, post_error_query = 'exp_stage == "test"'),
+                              lambda df: group_EZ_diffusion(df, condition = 'condition'),
+                              group_EZ_diffusion])
 def calc_shape_matching_DV(df, dvs = {}):
     """ Calculate dv for shape_matching task
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df.query('exp_stage == "test"'))
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True').reset_index(drop = True)
     
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df, condition = 'condition'))
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-        
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
-    
     rt_contrast = df_correct.groupby('condition').rt.median()
     dvs['stimulus_interference_rt'] = {'value':  rt_contrast['SDD'] - rt_contrast['SNN'], 'valence': 'Neg'} 
     acc_contrast = df.groupby('condition').correct.mean()
@@ -2311,25 +2439,19 @@ def calc_shape_matching_DV(df, dvs = {}):
     return dvs, description
 
 
-@group_decorate()
+@group_decorate(batch_funs = [lambda df: get_standard_DVs(df, correct_query = None, error_rt = False),
+                              lambda df: get_logit_DVs(df, 'correct', ['trials_since_switch', 'trial_num'],
+                                                       {'trials_since_switch': ('learning_rate', 'Pos'),
+                                                        'trial_num': ('learning_to_learn', 'Pos'),
+                                                        'llf': ('log_ll', 'NA')},
+                                                       query = 'rt != -1')])
 def calc_shift_DV(df, dvs = {}):
     """ Calculate dv for shift task. I
     :return dv: dictionary of dependent variables
     :return description: descriptor of DVs
     """
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
-        
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt'] = {'value':  df.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
     
     # fit model
     model = fRL_Model(df, decay_weights=True)
@@ -2341,21 +2463,26 @@ def calc_shift_DV(df, dvs = {}):
     dvs['model_beta'] = {'value':  params['beta']  , 'valence': 'NA'}
     dvs['model_fit'] = {'value':  fit  , 'valence': 'NA'}
     
-    try:
-        rs = smf.glm('correct ~ trials_since_switch+trial_num', data = df, family = sm.families.Binomial()).fit()
-        learning_rate = rs.params['trials_since_switch']
-        learning_to_learn = rs.params['trial_num']
-        log_ll = rs.llf
+    # the logistic regression is fit for all workers by get_logit_DVs. Fall back
+    # on statsmodels for workers whose fit did not converge
+    if 'learning_rate' in dvs:
         num_trials = df.shape[0]
-    except ValueError:
-        learning_rate = 'NA'
-        learning_to_learn = 'NA'
-        log_ll = 'NA'
-        num_trials = 'NA'
-    
-    dvs['learning_to_learn'] = {'value': learning_to_learn, 'valence':'Pos'}
-    dvs['learning_rate'] = {'value':  learning_rate  , 'valence': 'Pos'}
-    dvs['log_ll'] = {'value':  log_ll  , 'valence': 'NA'}
+    else:
+        try:
+            rs = smf.glm('correct ~ trials_since_switch+trial_num', data = df, family = sm.families.Binomial()).fit()
+            learning_rate = rs.params['trials_since_switch']
+            learning_to_learn = rs.params['trial_num']
+            log_ll = rs.llf
+            num_trials = df.shape[0]
+        except ValueError:
+            learning_rate = 'NA'
+            learning_to_learn = 'NA'
+            log_ll = 'NA'
+            num_trials = 'NA'
+        
+        dvs['learning_to_learn'] = {'value': learning_to_learn, 'valence':'Pos'}
+        dvs['learning_rate'] = {'value':  learning_rate  , 'valence': 'Pos'}
+        dvs['log_ll'] = {'value':  log_ll  , 'valence': 'NA'}
     dvs['num_trials'] = {'value':  num_trials  , 'valence': 'Pos'}
 
     #conceptual_responses: The CLR score is the total number of consecutive correct responses in a sequence of 3 or more.
@@ -2406,7 +2533,10 @@ def calc_shift_DV(df, dvs = {}):
         """
     return dvs, description
     
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'simon'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'simon'},
+                batch_funs = [get_standard_DVs,
+                              lambda df: group_EZ_diffusion(df, condition = 'condition'),
+                              group_EZ_diffusion])
 def calc_simon_DV(df, dvs = {}):
     """ Calculate dv for simon task. Incongruent-Congruent, median RT and Percent Correct
     :return dv: dictionary of dependent variables
@@ -2416,29 +2546,10 @@ def calc_simon_DV(df, dvs = {}):
     df.insert(0,'condition_shift', df.condition.shift(1))
     df.insert(0, 'correct_shift', df.correct.shift(1))
     
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True').reset_index(drop = True)
     
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df, condition = 'condition'))
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     # Get congruency effects
     rt_contrast = df_correct.groupby('condition').rt.median()
     acc_contrast = df.groupby('condition').correct.mean()
@@ -2516,7 +2627,9 @@ def calc_spatial_span_DV(df, dvs = {}):
     description = 'Mean span after dropping the first 4 trials'   
     return dvs, description
 
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'stim_selective_stop_signal'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'stim_selective_stop_signal'},
+                batch_funs = [lambda df: get_SSRT_DVs(df, trial_type_col = 'condition',
+                                                      query = 'exp_stage not in ["practice","NoSS_practice"]')])
 def calc_stim_selective_stop_signal_DV(df, dvs = {}):
     """ Calculate dv for stop signal task. Common states like rt, correct and
     DDM parameters are calculated on go trials only
@@ -2559,16 +2672,7 @@ def calc_stim_selective_stop_signal_DV(df, dvs = {}):
     reactive_control = df.query('condition == "ignore" and correct == True').rt.median() - \
                                 df.query('condition == "go" and correct == True').rt.median()
     dvs['reactive_control_rt'] = {'value': reactive_control, 'valence': 'Neg'}
-    # Calculate SSRT ignoring ignore trials
-    #SSRT
-    go_trials = df.query('condition == "go"')
-    stop_trials = df.query('condition == "stop"')
-    sorted_go = go_trials.query('rt != -1').rt.sort_values(ascending = True)
-    prob_stop_failure = (1-stop_trials.stopped.mean())
-    corrected = prob_stop_failure/numpy.mean(go_trials.rt!=-1)
-    index = corrected*(len(sorted_go)-1)
-    index = [floor(index), ceil(index)]
-    dvs['SSRT'] = {'value': sorted_go.iloc[index].mean() - stop_trials.SS_delay.mean(), 'valence': 'Neg'}
+    # SSRT (ignoring ignore trials) is calculated for all workers by get_SSRT_DVs
     
     description = """SSRT is calculated by calculating the percentage of time there are stop failures during
     stop trials. The assumption is that the go process is racing against the stop process and "wins" on the 
@@ -2576,7 +2680,13 @@ def calc_stim_selective_stop_signal_DV(df, dvs = {}):
     """
     return dvs, description
     
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'stop_signal'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'stop_signal'},
+                batch_funs = [lambda df: get_SSRT_DVs(df, condition = 'condition',
+                                                      query = 'exp_stage not in ["practice","NoSS_practice"]'),
+                              lambda df: get_logit_DVs(df, 'correct', ['SS_delay'],
+                                                       {'SS_delay': ('inhibition_slope', 'Pos'),
+                                                        'llf': ('log_ll', 'NA')},
+                                                       query = 'exp_stage not in ["practice","NoSS_practice"] and SS_trial_type == "stop"')])
 def calc_stop_signal_DV(df, dvs = {}):
     """ Calculate dv for stop signal task. Common states like rt, correct and
     DDM parameters are calculated on go trials only
@@ -2611,41 +2721,18 @@ def calc_stop_signal_DV(df, dvs = {}):
         if set(['hddm_' + param + '_high', 'hddm_' + param + '_low']) <= set(dvs.keys()):
             dvs['proactive_slowing_hddm_' + param] = {'value':  dvs['hddm_' + param + '_high']['value'] - dvs['hddm_' + param + '_low']['value'], 'valence': param_valence[param]}
             
+    # SSRT (for each condition, if they exist) is calculated for all workers by get_SSRT_DVs
     if 'condition' in df.columns:
-        # Calculate SSRT for both conditions
-        for c in df.condition.unique():
-            c_df = df[df.condition == c]
-            
-            #SSRT
-            go_trials = c_df.query('SS_trial_type == "go"')
-            stop_trials = c_df.query('SS_trial_type == "stop"')
-            sorted_go = go_trials.query('rt != -1').rt.sort_values(ascending = True)
-            prob_stop_failure = (1-stop_trials.stopped.mean())
-            corrected = prob_stop_failure/numpy.mean(go_trials.rt!=-1)
-            index = corrected*(len(sorted_go)-1)
-            index = [floor(index), ceil(index)]
-            dvs['SSRT_' + c] = {'value': sorted_go.iloc[index].mean() - stop_trials.SS_delay.mean(), 'valence': 'Neg'}
-        #take average of both conditions SSRT
-        dvs['SSRT'] = {'value':  numpy.mean([dvs['SSRT_' + c]['value'] for c in df.condition.unique()]), 'valence': 'Neg'} 
-        
         # Condition metrics
         dvs['proactive_slowing_rt'] = {'value':  -df.query('SS_trial_type == "go" and correct == True').groupby('condition').rt.mean().diff()['low'], 'valence': 'Pos'} 
         dvs['proactive_SSRT_speeding'] = {'value':  dvs['SSRT_low']['value'] - dvs['SSRT_high']['value'], 'valence': 'Pos'} 
-    else:
-        #SSRT
-        go_trials = df.query('SS_trial_type == "go"')
-        stop_trials = df.query('SS_trial_type == "stop"')
-        sorted_go = go_trials.query('rt != -1').rt.sort_values(ascending = True)
-        prob_stop_failure = (1-stop_trials.stopped.mean())
-        corrected = prob_stop_failure/numpy.mean(go_trials.rt!=-1)
-        index = corrected*(len(sorted_go)-1)
-        index = [floor(index), ceil(index)]
-        dvs['SSRT'] = {'value': sorted_go.iloc[index].mean() - stop_trials.SS_delay.mean(), 'valence': 'Neg'}
-
-    #inhibition_slope
-    rs = smf.glm('correct ~ SS_delay', data =  df.query('SS_trial_type == "stop"'), family = sm.families.Binomial()).fit()
-    dvs['inhibition_slope'] = {'value':  rs.params['SS_delay']  , 'valence': 'Pos'}
-    dvs['log_ll'] = {'value':  rs.llf  , 'valence': 'NA'}
+
+    #inhibition_slope is fit for all workers by get_logit_DVs. Fall back on statsmodels
+    #for workers whose fit did not converge
+    if 'inhibition_slope' not in dvs:
+        rs = smf.glm('correct ~ SS_delay', data =  df.query('SS_trial_type == "stop"'), family = sm.families.Binomial()).fit()
+        dvs['inhibition_slope'] = {'value':  rs.params['SS_delay']  , 'valence': 'Pos'}
+        dvs['log_ll'] = {'value':  rs.llf  , 'valence': 'NA'}
     dvs['num_stop_trials'] = {'value':  df.query('SS_trial_type == "stop"').shape[0]  , 'valence': 'NA'}
     dvs['commission_errors'] = {'value': 1-df.query('SS_trial_type == "stop"').correct.mean(), 'valence':'Neg'}
     dvs['omission_errors'] = {'value': 1-df.query('SS_trial_type == "go"').correct.mean(), 'valence':'Neg'}
@@ -2663,7 +2750,10 @@ def calc_stop_signal_DV(df, dvs = {}):
     """
     return dvs, description
 
-@group_decorate(group_fun_getter = get_HDDM_fun, group_fun_args={'task': 'stroop'})
+@group_decorate(group_fun_getter = get_HDDM_fun, group_fun_args={'task': 'stroop'},
+                batch_funs = [get_standard_DVs,
+                              lambda df: group_EZ_diffusion(df, condition = 'condition'),
+                              group_EZ_diffusion])
 def calc_stroop_DV(df, dvs = {}):
     """ Calculate dv for stroop task. Incongruent-Congruent, median RT and Percent Correct
     :return dv: dictionary of dependent variables
@@ -2673,29 +2763,10 @@ def calc_stroop_DV(df, dvs = {}):
     df.insert(0,'condition_shift', df.condition.shift(1))
     df.insert(0, 'correct_shift', df.correct.shift(1))
     
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
     # subset df
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True').reset_index(drop = True)
     
-    # Get DDM parameters
-    dvs.update(EZ_diffusion(df, condition = 'condition'))
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
-    
     # Get congruency effects
     rt_contrast = df_correct.groupby('condition').rt.median()
     acc_contrast = df.groupby('condition').correct.mean()
@@ -2737,7 +2808,9 @@ def calc_stroop_DV(df, dvs = {}):
         """
     return dvs, description
 
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'threebytwo'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'threebytwo'},
+                batch_funs = [lambda df: get_standard_DVs(df, correct_query = 'correct == True and correct_shift == True'),
+                              group_EZ_diffusion])
 def calc_threebytwo_DV(df, dvs = {}):
     """ Calculate dv for 3 by 2 task
     :return dv: dictionary of dependent variables
@@ -2747,10 +2820,6 @@ def calc_threebytwo_DV(df, dvs = {}):
     df.insert(0,'correct_shift', df.correct.shift(1))
     df.insert(0, 'task_switch_shift', df.task_switch.shift(1))
 
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True and correct_shift == True').reset_index(drop = True)
     # make dataframe for EZ_DDM comparisons
@@ -2758,18 +2827,6 @@ def calc_threebytwo_DV(df, dvs = {}):
     # convert reaction time to seconds to match with HDDM
     df_EZ = df_EZ.rename(columns = {'rt':'old_rt'})
     df_EZ['rt'] = df_EZ['old_rt']/1000
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
     
     # calculate task set inhibition (difference between CBC and ABC)
     selection = ['switch' in x.task_switch and 'stay' not in x.task_switch_shift for i,x in df_correct.iterrows()]
@@ -2805,7 +2862,9 @@ def calc_threebytwo_DV(df, dvs = {}):
                     pc = 1-(1.0/(2*len(subset)))
                 vrt = numpy.var(subset.query('correct == True')['rt'])
                 mrt = numpy.mean(subset.query('correct == True')['rt'])
-                drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
+                if pc in [0, .5]:
+                    continue
+                drift, thresh, non_dec = EZ(pc, vrt, mrt)
                 dvs['EZ_drift_cue_' + c + '_%s' % CTI] = {'value': drift, 'valence': 'Pos'}
                 dvs['EZ_thresh_cue_' + c + '_%s' % CTI] = {'value': thresh, 'valence': 'NA'}
                 dvs['EZ_non_decision_cue_' + c + '_%s' % CTI] = {'value': non_dec, 'valence': 'Neg'}
@@ -2822,7 +2881,9 @@ def calc_threebytwo_DV(df, dvs = {}):
                     pc = 1-(1.0/(2*len(subset)))
                 vrt = numpy.var(subset.query('correct == True')['rt'])
                 mrt = numpy.mean(subset.query('correct == True')['rt'])
-                drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
+                if pc in [0, .5]:
+                    continue
+                drift, thresh, non_dec = EZ(pc, vrt, mrt)
                 dvs['EZ_drift_task_' + c[0].split('_')[0] + '_%s' % CTI] = {'value': drift, 'valence': 'Pos'}
                 dvs['EZ_thresh_task_' + c[0].split('_')[0] + '_%s' % CTI] = {'value': thresh, 'valence': 'NA'}
                 dvs['EZ_non_decision_task_' + c[0].split('_')[0] + '_%s' % CTI] = {'value': non_dec, 'valence': 'Neg'}
@@ -2851,7 +2912,9 @@ def calc_threebytwo_DV(df, dvs = {}):
     """
     return dvs, description
 
-@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'twobytwo'})
+@group_decorate(group_fun_getter=get_HDDM_fun, group_fun_args={'task': 'twobytwo'},
+                batch_funs = [lambda df: get_standard_DVs(df, correct_query = 'correct == True and correct_shift == True'),
+                              group_EZ_diffusion])
 def calc_twobytwo_DV(df, dvs = {}):
     """ Calculate dv for 2 by 2 task
     :return dv: dictionary of dependent variables
@@ -2861,10 +2924,6 @@ def calc_twobytwo_DV(df, dvs = {}):
     df.insert(0,'correct_shift', df.correct.shift(1))
     df.insert(0, 'task_switch_shift', df.task_switch.shift(1))
 
-    # post error slowing
-    post_error_slowing = get_post_error_slow(df)
-    
-    missed_percent = (df['rt']==-1).mean()
     df = df.query('rt != -1').reset_index(drop = True)
     df_correct = df.query('correct == True and correct_shift == True').reset_index(drop = True)
     # make dataframe for EZ_DDM comparisons
@@ -2872,18 +2931,6 @@ def calc_twobytwo_DV(df, dvs = {}):
     # convert reaction time to seconds to match with HDDM
     df_EZ = df_EZ.rename(columns = {'rt':'old_rt'})
     df_EZ['rt'] = df_EZ['old_rt']/1000
-    # get DDM across all trials
-    ez_alltrials = EZ_diffusion(df)
-    dvs.update(ez_alltrials)
-    
-    # Calculate basic statistics - accuracy, RT and error RT
-    dvs['acc'] = {'value':  df.correct.mean(), 'valence': 'Pos'}
-    dvs['avg_rt_error'] = {'value':  df.query('correct == False').rt.median(), 'valence': 'NA'}
-    dvs['std_rt_error'] = {'value':  df.query('correct == False').rt.std(), 'valence': 'NA'}
-    dvs['avg_rt'] = {'value':  df_correct.rt.median(), 'valence': 'Neg'}
-    dvs['std_rt'] = {'value':  df_correct.rt.std(), 'valence': 'NA'}
-    dvs['missed_percent'] = {'value':  missed_percent, 'valence': 'Neg'}
-    dvs['post_error_slowing'] = {'value':  post_error_slowing, 'valence': 'Pos'}
     
     #switch costs
     for CTI in df.CTI.unique():
@@ -2915,7 +2962,9 @@ def calc_twobytwo_DV(df, dvs = {}):
                     pc = 1-(1.0/(2*len(subset)))
                 vrt = numpy.var(subset.query('correct == True')['rt'])
                 mrt = numpy.mean(subset.query('correct == True')['rt'])
-                drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
+                if pc in [0, .5]:
+                    continue
+                drift, thresh, non_dec = EZ(pc, vrt, mrt)
                 dvs['EZ_drift_cue_' + c + '_%s' % CTI] = {'value': drift, 'valence': 'Pos'}
                 dvs['EZ_thresh_cue_' + c + '_%s' % CTI] = {'value': thresh, 'valence': 'NA'}
                 dvs['EZ_non_decision_cue_' + c + '_%s' % CTI] = {'value': non_dec, 'valence': 'Neg'}
@@ -2932,7 +2981,9 @@ def calc_twobytwo_DV(df, dvs = {}):
                     pc = 1-(1.0/(2*len(subset)))
                 vrt = numpy.var(subset.query('correct == True')['rt'])
                 mrt = numpy.mean(subset.query('correct == True')['rt'])
-                drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
+                if pc in [0, .5]:
+                    continue
+                drift, thresh, non_dec = EZ(pc, vrt, mrt)
                 dvs['EZ_drift_task_' + c + '_%s' % CTI] = {'value': drift, 'valence': 'Pos'}
                 dvs['EZ_thresh_task_' + c + '_%s' % CTI] = {'value': thresh, 'valence': 'NA'}
                 dvs['EZ_non_decision_task_' + c + '_%s' % CTI] = {'value': non_dec, 'valence': 'Neg'}
@@ -2986,22 +3037,36 @@ def calc_TOL_DV(df, dvs = {}):
     description = 'many dependent variables related to tower of london performance'
     return dvs, description
 
-def get_twostage_glm(**kwargs):
+def get_twostage_glm(kwargs=None):
+    """ Returns a function fitting the mixed effects logistic regression of stay
+    probabilities for all workers. The 'backend' kwarg selects the fitting engine:
+    'python' (default) fits the Laplace approximation in glm_utils, 'R' uses lme4 
+    through rpy2, in the r_to_py_utils.GlmerPool passed as 'glmer_pool' if any
+    """
+    if kwargs is None:
+        kwargs = {}
+    backend = kwargs.get('backend', 'python')
+    if backend == 'R':
+        from expanalysis.experiments.r_to_py_utils import glmer as fit_glmer
+        if kwargs.get('glmer_pool') is not None:
+            fit_glmer = kwargs['glmer_pool'].glmer
+    else:
+        fit_glmer = glmer
     def two_stage_glm(data):
         data = data.copy()
         data = data.query('trial_id == "complete_trial" and feedback_last != -1').reset_index(drop = True)
         data.loc[:,'stay'] = 1-data.switch.astype(int)
-        data.loc[:, 'stage_transition_last'] = pandas.Categorical(data.stage_transition_last, categories = ['infrequent','frequent'])
+        data['stage_transition_last'] = pandas.Categorical(data.stage_transition_last, categories = ['infrequent','frequent'])
         data = data.loc[:,['worker_id','stay','stage_transition_last','feedback_last']].dropna()
         formula = "stay ~ feedback_last*stage_transition_last + (feedback_last*stage_transition_last|worker_id)"
-        fixed,random = glmer(data,formula)
+        fixed,random = fit_glmer(data,formula)
         # create group dv object
         group_dvs = {}
-        for i,worker in enumerate(data.worker_id.unique()):
+        for worker in random.index:
             dvs = {}
-            dvs['perseverance'] = {'value': random.iloc[i,0], 'valence': 'Neg'}
-            dvs['model_free'] = {'value': random.iloc[i,1], 'valence': 'NA'}
-            dvs['model_based'] = {'value': random.iloc[i,3], 'valence': 'Pos'}
+            dvs['perseverance'] = {'value': random.loc[worker, '(Intercept)'], 'valence': 'Neg'}
+            dvs['model_free'] = {'value': random.loc[worker, 'feedback_last'], 'valence': 'NA'}
+            dvs['model_based'] = {'value': random.loc[worker, 'feedback_last:stage_transition_lastfrequent'], 'valence': 'Pos'}
             group_dvs[worker]  = dvs
         return group_dvs
     return two_stage_glm
@@ -0,0 +1,139 @@
+import numpy
+
+def batch_fmin(func, x0, xtol = 1e-4, ftol = 1e-4, maxiter = None, maxfun = None):
+    """ Minimize many independent functions at once with the Nelder-Mead simplex
+    algorithm. Every subject keeps its own simplex and goes through the same
+    reflection, expansion, contraction and shrink steps as scipy.optimize.fmin,
+    but the function is evaluated for all subjects in one vectorized call
+
+    Args:
+        func: function taking a (subjects, params) array and returning a
+            (subjects,) array of values to minimize
+        x0: (subjects, params) array of initial guesses
+        xtol: absolute error in xopt acceptable for convergence
+        ftol: absolute error in func(xopt) acceptable for convergence
+        maxiter: maximum number of iterations. Defaults to 200*params
+        maxfun: maximum number of function evaluations per subject. Defaults
+            to 200*params
+
+    Returns:
+        (xopt, fopt, converged): (subjects, params) array of minimizers, array of
+        function values at the minimizers, and boolean array labeling the
+        subjects that met the tolerances before running out of iterations
+    """
+    x0 = numpy.asarray(x0, dtype = float)
+    n_subjects, N = x0.shape
+    if maxiter is None:
+        maxiter = N*200
+    if maxfun is None:
+        maxfun = N*200
+    rho, chi, psi, sigma = 1, 2, 0.5, 0.5
+    nonzdelt, zdelt = 0.05, 0.00025
+    subjects = numpy.arange(n_subjects)[:, None]
+
+    def sort_simplex(sim, fsim):
+        ind = numpy.argsort(fsim, axis = 1, kind = 'stable')
+        return sim[subjects, ind], fsim[subjects, ind]
+
+    # initial simplex
+    sim = numpy.empty((n_subjects, N + 1, N))
+    sim[:, 0] = x0
+    for k in range(N):
+        y = x0.copy()
+        y[:, k] = numpy.where(y[:, k] != 0, (1 + nonzdelt)*y[:, k], zdelt)
+        sim[:, k + 1] = y
+    fsim = numpy.stack([func(sim[:, k]) for k in range(N + 1)], 1).astype(float)
+    sim, fsim = sort_simplex(sim, fsim)
+    fcalls = numpy.full(n_subjects, N + 1)
+    converged = numpy.zeros(n_subjects, dtype = bool)
+    active = numpy.ones(n_subjects, dtype = bool)
+    iterations = 1
+    with numpy.errstate(invalid = 'ignore'):
+        while iterations < maxiter:
+            converged |= active & (numpy.abs(sim[:, 1:] - sim[:, :1]).max((1, 2)) <= xtol) & \
+                         (numpy.abs(fsim[:, :1] - fsim[:, 1:]).max(1) <= ftol)
+            active &= ~converged & (fcalls < maxfun)
+            if not active.any():
+                break
+            last = sim[:, -1]
+            xbar = numpy.add.reduce(sim[:, :-1], 1)/N
+            xr = (1 + rho)*xbar - rho*last
+            fxr = func(xr)
+            xe = (1 + rho*chi)*xbar - rho*chi*last
+            fxe = func(xe)
+            xc = (1 + psi*rho)*xbar - psi*rho*last
+            fxc = func(xc)
+            xcc = (1 - psi)*xbar + psi*last
+            fxcc = func(xcc)
+            # choose the step each subject would take
+            expand = fxr < fsim[:, 0]
+            reflect = ~expand & (fxr < fsim[:, -2])
+            contract = ~expand & ~reflect
+            outside = contract & (fxr < fsim[:, -1])
+            inside = contract & ~outside
+            new_x = numpy.where((expand & (fxe < fxr))[:, None], xe, xr)
+            new_f = numpy.where(expand & (fxe < fxr), fxe, fxr)
+            new_x = numpy.where(outside[:, None], xc, new_x)
+            new_f = numpy.where(outside, fxc, new_f)
+            new_x = numpy.where(inside[:, None], xcc, new_x)
+            new_f = numpy.where(inside, fxcc, new_f)
+            shrink = (outside & ~(fxc <= fxr)) | (inside & ~(fxcc < fsim[:, -1]))
+            fcalls += active*(1 + expand + contract)
+            update = active & ~shrink
+            sim[update, -1] = new_x[update]
+            fsim[update, -1] = new_f[update]
+            shrink &= active
+            if shrink.any():
+                shrunk = sim[:, :1] + sigma*(sim - sim[:, :1])
+                for j in range(1, N + 1):
+                    fshrunk = func(shrunk[:, j])
+                    sim[shrink, j] = shrunk[shrink, j]
+                    fsim[shrink, j] = fshrunk[shrink]
+                fcalls += shrink*N
+            sim, fsim = sort_simplex(sim, fsim)
+            iterations += 1
+    return sim[:, 0], fsim[:, 0], converged
+
+def batch_newton(func, x0, xtol = 1e-10, maxiter = 100):
+    """ Minimize many independent functions of one parameter at once with Newton's
+    method. Where a function is not locally convex the step falls back on the
+    gradient (scaled by the magnitude of the second derivative), and every step
+    is halved until the function decreases
+
+    Args:
+        func: function taking a (subjects,) array and returning the function value,
+            first and second derivatives as (subjects,) arrays
+        x0: (subjects,) array of initial guesses
+        xtol: relative step size acceptable for convergence
+        maxiter: maximum number of iterations
+
+    Returns:
+        (xopt, fopt, converged): arrays of minimizers, function values at the
+        minimizers, and boolean array labeling the subjects whose steps fell
+        below xtol before running out of iterations
+    """
+    x = numpy.array(x0, dtype = float)
+    with numpy.errstate(all = 'ignore'):
+        f, g, h = func(x)
+        converged = numpy.zeros(len(x), dtype = bool)
+        for iteration in range(maxiter):
+            active = ~converged & numpy.isfinite(f) & numpy.isfinite(g)
+            if not active.any():
+                break
+            step = numpy.where(h > 0, -g/h, -g/numpy.where(h != 0, numpy.abs(h), 1))
+            step = numpy.where(active & numpy.isfinite(step), step, 0)
+            new_f, new_g, new_h = func(x + step)
+            for halving in range(50):
+                worse = active & ~(new_f <= f)
+                if not worse.any():
+                    break
+                step[worse] /= 2
+                f_half, g_half, h_half = func(x + step)
+                new_f = numpy.where(worse, f_half, new_f)
+                new_g = numpy.where(worse, g_half, new_g)
+                new_h = numpy.where(worse, h_half, new_h)
+            accept = active & (new_f <= f)
+            x[accept] += step[accept]
+            f[accept], g[accept], h[accept] = new_f[accept], new_g[accept], new_h[accept]
+            converged |= active & (numpy.abs(step) <= xtol*(1 + numpy.abs(x)))
+    return x, f, converged
@@ -435,14 +435,19 @@ def get_exp_DVs(data, exp_id, use_check = True, use_group_fun = True, group_kwar
     df = extract_experiment(data,exp_id)
     return calc_exp_DVs(df, use_check, use_group_fun, group_kwargs)
 
-def get_battery_DVs(data, use_check = True, use_group_fun = True):
+def get_battery_DVs(data, use_check = True, use_group_fun = True, group_kwargs=None):
     '''Calculate DVs for each subject and each experiment. Returns a subject x DV matrix
+    :param group_kwargs: kwargs passed to every experiment's group function (i.e.
+    cache_dir to reuse HDDM fits)
     '''
+    if group_kwargs is None:
+        group_kwargs = {}
     DVs = pandas.DataFrame()
     valence = pandas.DataFrame()
     for exp in numpy.sort(data.experiment_exp_id.unique()):
         print('Calculating DV for %s' % exp)
-        exp_DVs,exp_valence,description = get_exp_DVs(data, exp, use_check, use_group_fun)
+        exp_DVs,exp_valence,description = get_exp_DVs(data, exp, use_check, use_group_fun,
+                                                      dict(group_kwargs))
         if not exp_DVs is None:
             exp_DVs.columns = [exp + '.' + c for c in exp_DVs.columns]
             exp_valence.columns = [exp + '.' + c for c in exp_valence.columns]
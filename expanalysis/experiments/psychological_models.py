@@ -2,7 +2,12 @@ from math import exp
 import numpy
 import json
 from itertools import product
-from scipy.stats.distributions import beta
+from expanalysis.experiments.optimize_utils import batch_fmin
+
+# transition probabilities of the two stage task, indexed by (first stage action,
+# second stage), when the experienced transitions are consistent or not
+FREQUENT_T = numpy.array([[0, .7, .3], [0, .3, .7]])
+INFREQUENT_T = numpy.array([[0, .3, .7], [0, .7, .3]])
 
 class Two_Stage_Model(object):
     def __init__(self,alpha1,alpha2,lam,B1,B2,W,p):
@@ -15,8 +20,8 @@ class Two_Stage_Model(object):
         self.p = p
         # stage action possibilities
         self.stage_action_list = {0: (0,1), 1: (2,3), 2: (4,5)}
-        # transition counts
-        self.transition_counts = {(0,1):0, (0,2):0, (1,1):0, (1,2):0}
+        # transition counts, indexed by (first stage action, second stage)
+        self.transition_counts = numpy.zeros((2,3), dtype=int)
         # initialize Q values
         self.Q_TD_values = numpy.ones((3,6))*0
         self.Q_MB_values = numpy.ones((3,6))*0
@@ -44,11 +49,11 @@ class Two_Stage_Model(object):
         # update MB values
         self.transition_counts[(a1,s2)] += 1
         # define T:
-        if (self.transition_counts[(0,1)]+self.transition_counts[(1,2)]) > \
-            (self.transition_counts[(0,2)]+self.transition_counts[(1,1)]):
-            T = {(0,1):.7, (0,2):.3, (1,1):.3, (1,2):.7}
+        if (self.transition_counts[0,1]+self.transition_counts[1,2]) > \
+            (self.transition_counts[0,2]+self.transition_counts[1,1]):
+            T = FREQUENT_T
         else: 
-            T = {(0,1):.3, (0,2):.7, (1,1):.7, (1,2):.3}
+            T = INFREQUENT_T
         self.updateQMB(T)
     
     def get_softmax_probs(self,stages,last_choice):
@@ -80,19 +85,80 @@ class Two_Stage_Model(object):
         self.trialUpdate(s1,s2,a1,a2,r,self.alpha1,self.alpha2,self.lam)
         return Pa1,Pa2
         
-    def run_trials(self, df):
-        # run trials
-        last_choice = -1
-        action_probs = []
-        Q_vals = []
-        MB_vals = []
-        for i,trial in df.iterrows():
-            Q_vals.append(self.Q_TD_values.copy())
-            MB_vals.append(self.Q_MB_values.copy())
-            Pa1, Pa2 = self.run_trial(trial,last_choice)
-            action_probs.append((Pa1,Pa2))
-            last_choice = trial['stim_selected_first']
-        self.sum_neg_ll = numpy.sum(-numpy.log(list(zip(*action_probs))[0])) + numpy.sum(-numpy.log(list(zip(*action_probs))[1]))   
+    @staticmethod
+    def get_trial_arrays(df):
+        """ Extract the integer arrays used by run_trials and two_stage_neg_ll
+        
+        Args:
+            df: dataframe of complete trials with columns stage, stage_second,
+                stim_selected_first, stim_selected_second and feedback
+        
+        Returns:
+            trials: dictionary of (trials,) arrays s1, s2, a1, a2, r and 
+                last_choice (the previous first stage action, -1 on the first trial)
+        """
+        a1 = df['stim_selected_first'].values.astype(int)
+        return {'s1': df['stage'].values.astype(int),
+                's2': df['stage_second'].values.astype(int),
+                'a1': a1,
+                'a2': df['stim_selected_second'].values.astype(int),
+                'r': df['feedback'].values.astype(int),
+                'last_choice': numpy.append(-1, a1[:-1])}
+        
+    def run_trials(self, df, record_history=False):
+        """ Run the model over trials and store the negative log likelihood of the
+        choices in sum_neg_ll
+        
+        Args:
+            df: dataframe of trials or the output of get_trial_arrays
+            record_history: if True, store the TD and MB Q values seen before
+                each trial in Q_TD_history and Q_MB_history
+        """
+        trials = df if isinstance(df, dict) else self.get_trial_arrays(df)
+        # the trial loop runs on python floats, with operations in the same order
+        # as run_trial and trialUpdate
+        alpha1, alpha2, lam = self.alpha1, self.alpha2, self.lam
+        B1, W, p = self.B1, self.W, self.p
+        Q_TD = self.Q_TD_values.tolist()
+        Q_MB = self.Q_MB_values.tolist()
+        counts = self.transition_counts.tolist()
+        Q_TD_history = []
+        Q_MB_history = []
+        Pa1s = []
+        Pa2s = []
+        for s1, s2, a1, a2, r, last_choice in zip(*[trials[key].tolist() for key in
+                                                    ['s1', 's2', 'a1', 'a2', 'r', 'last_choice']]):
+            if record_history:
+                Q_TD_history.append([row[:] for row in Q_TD])
+                Q_MB_history.append([row[:] for row in Q_MB])
+            # choice probabilities of selected actions
+            for stage, action, probs in ((s1, a1, Pa1s), (s2, a2, Pa2s)):
+                P_action = [exp(B1*((W)*Q_MB[stage][a] + (1-W)*Q_TD[stage][a] + (p*(a==last_choice))))
+                            for a in self.stage_action_list[stage]]
+                probs.append(P_action[action - 2*stage]/(P_action[0] + P_action[1]))
+            # update TD values
+            delta1 = 0 + Q_TD[s2][a2] - Q_TD[s1][a1]
+            Q_TD[s1][a1] += alpha1*delta1
+            delta2 = r - Q_TD[s2][a2]
+            Q_TD[s2][a2] += alpha2*delta2
+            Q_TD[s1][a1] += alpha1*lam*delta2
+            # update MB values
+            counts[a1][s2] += 1
+            T = FREQUENT_T if (counts[0][1]+counts[1][2]) > (counts[0][2]+counts[1][1]) \
+                else INFREQUENT_T
+            Q_MB[1] = Q_TD[1][:]
+            Q_MB[2] = Q_TD[2][:]
+            max1 = max(Q_TD[1][2:4])
+            max2 = max(Q_TD[2][4:6])
+            for a in self.stage_action_list[0]:
+                Q_MB[0][a] = T[a,1] * max1 + T[a,2] * max2
+        self.Q_TD_values = numpy.array(Q_TD)
+        self.Q_MB_values = numpy.array(Q_MB)
+        self.transition_counts = numpy.array(counts)
+        if record_history:
+            self.Q_TD_history = numpy.array(Q_TD_history)
+            self.Q_MB_history = numpy.array(Q_MB_history)
+        self.sum_neg_ll = numpy.sum(-numpy.log(Pa1s)) + numpy.sum(-numpy.log(Pa2s))
     
     def simulate(self, ntrials=10):
         trials = []
@@ -126,7 +192,124 @@ class Two_Stage_Model(object):
         return self.sum_neg_ll
 
 
+def stack_trial_arrays(trial_list):
+    """ Stack the trial arrays of several subjects into padded (subjects, trials)
+    arrays, which two_stage_neg_ll evaluates in one pass
+    
+    Args:
+        trial_list: list of outputs of Two_Stage_Model.get_trial_arrays
+    
+    Returns:
+        trials: dictionary of (subjects, max trials) arrays, including a boolean
+            'mask' labeling which trials exist for each subject
+    """
+    n_trials = max([len(trials['s1']) for trials in trial_list])
+    # padded trials are valid first stage choices, so they can be evaluated safely
+    pad = {'s1': 0, 's2': 1, 'a1': 0, 'a2': 2, 'r': 0, 'last_choice': -1}
+    stacked = {key: numpy.full((len(trial_list), n_trials), value, dtype=int) 
+               for key, value in pad.items()}
+    stacked['mask'] = numpy.zeros((len(trial_list), n_trials), dtype=bool)
+    for i, trials in enumerate(trial_list):
+        for key in pad.keys():
+            stacked[key][i, :len(trials[key])] = trials[key]
+        stacked['mask'][i, :len(trials['s1'])] = True
+    return stacked
+
+def two_stage_neg_ll(trials, params):
+    """ Evaluate the negative log likelihood of the two stage model for many
+    parameter vectors at once. All Q values are updated as (vectors, stages,
+    actions) arrays, so the trials are looped over only once
+    
+    Args:
+        trials: output of Two_Stage_Model.get_trial_arrays, shared by all
+            parameter vectors, or of stack_trial_arrays with one row for each
+            parameter vector
+        params: (vectors, 7) array of alpha1, alpha2, lam, B1, B2, W and p as
+            passed to Two_Stage_Model
+    
+    Returns:
+        neg_ll: (vectors,) array equal to Two_Stage_Model.run_trials's sum_neg_ll
+            up to floating point rounding
+    """
+    params = numpy.atleast_2d(numpy.asarray(params, dtype=float))
+    n = len(params)
+    alpha1, alpha2, lam, B1, B2, W, p = params.T
+    keys = ['s1', 's2', 'a1', 'a2', 'r', 'last_choice']
+    data = [numpy.broadcast_to(numpy.atleast_2d(trials[key]), (n, numpy.shape(trials[key])[-1])) 
+            for key in keys]
+    mask = numpy.broadcast_to(trials.get('mask', True), data[0].shape)
+    rows = numpy.arange(n)
+    stage_actions = numpy.array([(0,1), (2,3), (4,5)])
+    Q_TD = numpy.zeros((n,3,6))
+    Q_MB = numpy.zeros((n,3,6))
+    counts = numpy.zeros((n,2,3))
+    neg_ll = numpy.zeros(n)
+    for t in range(data[0].shape[1]):
+        s1, s2, a1, a2, r, last_choice = [x[:, t] for x in data]
+        # choice probabilities of selected actions
+        for stage, action in ((s1, a1), (s2, a2)):
+            actions = stage_actions[stage]
+            Qnet = W[:,None]*Q_MB[rows[:,None], stage[:,None], actions] + \
+                   (1-W[:,None])*Q_TD[rows[:,None], stage[:,None], actions]
+            repeat = p[:,None]*(actions == last_choice[:,None])
+            P_action = numpy.exp(B1[:,None]*(Qnet + repeat))
+            prob = P_action[rows, action - 2*stage]/P_action.sum(1)
+            neg_ll -= numpy.where(mask[:, t], numpy.log(prob), 0)
+        # update TD values
+        delta1 = Q_TD[rows, s2, a2] - Q_TD[rows, s1, a1]
+        Q_TD[rows, s1, a1] += alpha1*delta1
+        delta2 = r - Q_TD[rows, s2, a2]
+        Q_TD[rows, s2, a2] += alpha2*delta2
+        Q_TD[rows, s1, a1] += alpha1*lam*delta2
+        # update MB values
+        counts[rows, a1, s2] += 1
+        frequent = (counts[:,0,1]+counts[:,1,2]) > (counts[:,0,2]+counts[:,1,1])
+        T = numpy.where(frequent[:,None,None], FREQUENT_T, INFREQUENT_T)
+        Q_MB[:,1:3] = Q_TD[:,1:3]
+        max1 = Q_TD[:,1,2:4].max(1)
+        max2 = Q_TD[:,2,4:6].max(1)
+        Q_MB[:,0,:2] = T[:,:,1]*max1[:,None] + T[:,:,2]*max2[:,None]
+    return neg_ll
+
+def fit_two_stage_models(trial_list, x0=None):
+    """ Fit the two stage model to many subjects at once by maximum likelihood,
+    with one Nelder-Mead simplex per subject. Learning rates, lambda and W are
+    bounded to [0,1] with a logistic transform and B1 to positive values with an
+    exponential transform. B2 does not enter the likelihood and is set to B1
+    
+    Args:
+        trial_list: list of outputs of Two_Stage_Model.get_trial_arrays
+        x0: optional initial alpha1, alpha2, lam, B1, W and p shared by all
+            subjects. Defaults to (.5, .5, .5, 1, .5, 0)
+    
+    Returns:
+        (params, neg_ll, converged): (subjects, 7) array of fitted parameters in
+            the order taken by Two_Stage_Model, array of negative log likelihoods
+            and boolean array labeling the subjects whose fit converged
+    """
+    if x0 is None:
+        x0 = (.5, .5, .5, 1, .5, 0)
+    alpha1, alpha2, lam, B1, W, p = x0
+    logit = lambda x: numpy.log(x/(1-x))
+    z0 = numpy.array([logit(alpha1), logit(alpha2), logit(lam), numpy.log(B1), logit(W), p])
+    trials = stack_trial_arrays(trial_list)
+    
+    def transform(z):
+        bounded = 1/(1+numpy.exp(-z[:, [0,1,2,4]]))
+        B1 = numpy.exp(z[:,3])
+        return numpy.column_stack([bounded[:,:3], B1, B1, bounded[:,3], z[:,5]])
+    
+    z, neg_ll, converged = batch_fmin(lambda z: two_stage_neg_ll(trials, transform(z)),
+                                      numpy.tile(z0, (len(trial_list), 1)),
+                                      maxiter=2000, maxfun=2000)
+    return transform(z), neg_ll, converged
+
+
 # Functions to define Hierarchical Rule MoE Model (Frank & Badre, 2011)
+def beta_mean(p):
+    """ Mean of a beta distribution with parameters p['a'] and p['b'] """
+    return p['a']/(p['a']+p['b'])
+
 class Flat_SubExpert():
     def __init__(self, features, data, kappa):
         self.kappa = kappa # kappaerature for softmax
@@ -153,7 +336,7 @@ class Flat_SubExpert():
         key_subset = [k for k in self.reward_probabilities.keys() if subset(features,k)]
         action_probs = {}
         for key in key_subset:
-            raw_prob = beta(**self.reward_probabilities[key]).mean()
+            raw_prob = beta_mean(self.reward_probabilities[key])
             # take softmax
             prob = numpy.e**(raw_prob/self.kappa)
             action_probs[key[-1]] = prob
@@ -201,7 +384,7 @@ class Hierarchical_SubExpert():
         key_subset = [k for k in self.reward_probabilities[context].keys() if subset(features,k)]
         action_probs = {}
         for key in key_subset:
-            raw_prob = beta(**self.reward_probabilities[context][key]).mean()
+            raw_prob = beta_mean(self.reward_probabilities[context][key])
             # take softmax
             prob = numpy.e**(raw_prob/self.kappa)
             action_probs[key[-1]] = prob
@@ -316,7 +499,7 @@ class Flat_Expert(Expert):
     
     def get_expert_confidences(self, trial):
         # get attention weights (softmax of confidences)
-        e_confidences = [numpy.e**(beta(**p).mean()/self.zeta) for p in self.confidences]
+        e_confidences = [numpy.e**(beta_mean(p)/self.zeta) for p in self.confidences]
         e_confidences = [i/sum(e_confidences) for i in e_confidences]
         return e_confidences
     
@@ -368,7 +551,7 @@ class Hierarchical_Expert(Expert):
     def get_expert_confidences(self, trial):
         # get attention weights (softmax of confidences)
         c = trial[self.context]
-        e_confidences = [numpy.e**(beta(**p).mean()/self.zeta) for p in self.confidences[c]]
+        e_confidences = [numpy.e**(beta_mean(p)/self.zeta) for p in self.confidences[c]]
         e_confidences = [i/sum(e_confidences) for i in e_confidences]
         return e_confidences
     
@@ -394,8 +577,8 @@ class Hierarchical_SuperExpert(Expert):
 
     def get_expert_confidences(self, trial):
         # get attention weights - unclear if softmax
-        e_confidences = [beta(**p).mean() for p in self.confidences]
-        #e_confidences = [numpy.e**(beta(**p).mean()/self.zeta) for p in self.confidences
+        e_confidences = [beta_mean(p) for p in self.confidences]
+        #e_confidences = [numpy.e**(beta_mean(p)/self.zeta) for p in self.confidences
         e_confidences = [i/sum(e_confidences) for i in e_confidences]
         return e_confidences
             
@@ -427,7 +610,7 @@ class MoE_Model(Expert):
             
     def get_expert_confidences(self, trial):
         # get attention weights - unclear if softmax
-        e_confidences = [numpy.e**(beta(**p).mean()/self.xi) for p in self.confidences]
+        e_confidences = [numpy.e**(beta_mean(p)/self.xi) for p in self.confidences]
         e_confidences = [i/sum(e_confidences) for i in e_confidences]
         return e_confidences
     
@@ -454,6 +637,175 @@ class MoE_Model(Expert):
         return confidences
     
     
+class Array_MoE_Model():
+    """ Array-backed implementation of MoE_Model
+    
+    The beta parameters of every subordinate expert are kept in (keys, actions)
+    arrays indexed by the codes of the expert's features, and the action
+    probabilities of all experts are evaluated together on each trial. Trials
+    are run as with MoE_Model: action probabilities are computed, then the
+    confidences in the hierarchical and flat experts, and all experts below
+    them, are updated. Features are matched to keys by position, which agrees
+    with MoE_Model whenever feature values differ from the action codes.
+    """
+    # context and features of the subordinate experts of each hierarchical expert
+    hierarchical_features = [('border', ['stim','orientation']),
+                             ('orientation', ['stim','border']),
+                             ('stim', ['border','orientation'])]
+    # features of the flat subordinate experts
+    flat_features = [['orientation'], ['border'], ['stim'],
+                     ['orientation', 'border'], ['orientation', 'stim'], 
+                     ['stim', 'border'], ['orientation','border','stim']]
+    
+    def __init__(self, data, kappa, zeta, xi, alphaC, alphaO, alphaS,
+                 beta2, beta3, beta_hierarchy):
+        """ Initialize the model, taking the same arguments as MoE_Model. Only
+        trials with a response (key_press > 0) are run
+        """
+        self.kappa = kappa
+        self.zeta = zeta
+        self.xi = xi
+        self.actions = sorted(numpy.unique([a for a in data.key_press if a > 0]))
+        # integer codes of features, contexts and actions
+        codes = {}
+        n_types = {}
+        for f in ['orientation', 'border', 'stim']:
+            feature_types = numpy.unique(data.loc[:, f])
+            codes[f] = numpy.searchsorted(feature_types, data.loc[:, f])
+            n_types[f] = len(feature_types)
+        responded = data.key_press.isin(self.actions).values
+        self.choices = numpy.searchsorted(self.actions, data.key_press.values[responded])
+        self.rewards = data.correct.values[responded].astype(bool)
+        # row of each subordinate expert's beta parameters used on each trial. The
+        # six hierarchical subordinate experts come first, then the seven flat ones
+        expert_columns = [[context, feature] for context, features in self.hierarchical_features
+                          for feature in features] + self.flat_features
+        rows = []
+        offset = 0
+        for columns in expert_columns:
+            dims = [n_types[c] for c in columns]
+            rows.append(offset + numpy.ravel_multi_index([codes[c] for c in columns], dims))
+            offset += numpy.prod(dims)
+        self.rows = numpy.column_stack(rows)[responded]
+        self.contexts = numpy.column_stack([codes[context] for context, _ in 
+                                            self.hierarchical_features])[responded]
+        # beta parameters of subordinate experts
+        self.sub_a = numpy.ones((offset, len(self.actions)))
+        self.sub_b = numpy.ones((offset, len(self.actions)))
+        # beta parameters of confidences, as (..., 2) arrays of a and b
+        self.hierarchical_confidences = numpy.ones((len(self.hierarchical_features), 
+                                                    max(n_types.values()), 2, 2))
+        self.super_confidences = numpy.ones((len(self.hierarchical_features), 2))
+        self.flat_confidences = numpy.array([[1+alphaO, 2],
+                                             [1+alphaC, 2],
+                                             [1+alphaS, 2],
+                                             [1+(alphaO+alphaC)/2, 2+beta2],
+                                             [1+(alphaO+alphaS)/2, 2+beta2],
+                                             [1+(alphaS+alphaC)/2, 2+beta2],
+                                             [1+(alphaO+alphaS+alphaC)/3, 3+beta3]])
+        self.confidences = numpy.array([[1, beta_hierarchy], [1, 1]], dtype=float)
+        self.sum_neg_ll = None
+        
+    @staticmethod
+    def get_weights(confidences, temperature=None):
+        """ Attention weights over the last axis of confidences: the softmax
+        of the beta means, or the normalized means if temperature is None
+        """
+        weights = confidences[..., 0]/confidences.sum(-1)
+        if temperature is not None:
+            weights = numpy.e**(weights/temperature)
+        return weights/weights.sum(-1, keepdims=True)
+    
+    @staticmethod
+    def get_credit_updates(action_probs, choice, reward):
+        """ Whether each expert's confidence increases ('a') rather than
+        decreases ('b'). An expert is credited with the choice if it gave the
+        choice a higher probability than all other actions
+        """
+        others = numpy.arange(action_probs.shape[-1]) != choice
+        credited = numpy.all(action_probs[:, others] < action_probs[:, [choice]], 1)
+        return credited == reward
+    
+    def get_action_probs(self, t):
+        """ Action probabilities of all experts on compiled trial t
+        
+        Returns:
+            dictionary of arrays of action probabilities: 'subordinate' (13, actions),
+            'hierarchical' (3, actions), 'super' and 'flat' (actions,) and 'model' 
+            (actions,), the final MoE probabilities
+        """
+        rows = self.rows[t]
+        a = self.sub_a[rows]
+        raw_probs = a/(a+self.sub_b[rows])
+        sub_probs = numpy.e**(raw_probs/self.kappa)
+        sub_probs /= sub_probs.sum(1, keepdims=True)
+        n_hierarchical = len(self.hierarchical_features)
+        # hierarchical experts weigh their two subordinate experts within context
+        context_confidences = self.hierarchical_confidences[numpy.arange(n_hierarchical), 
+                                                            self.contexts[t]]
+        hierarchical_weights = self.get_weights(context_confidences, self.zeta)
+        hierarchical_probs = numpy.einsum('hs,hsa->ha', hierarchical_weights, 
+                                          sub_probs[:2*n_hierarchical].reshape(n_hierarchical, 2, -1))
+        super_probs = self.get_weights(self.super_confidences).dot(hierarchical_probs)
+        flat_probs = self.get_weights(self.flat_confidences, self.zeta).dot(sub_probs[2*n_hierarchical:])
+        model_probs = self.get_weights(self.confidences, self.xi).dot(numpy.vstack([super_probs, flat_probs]))
+        return {'subordinate': sub_probs,
+                'hierarchical': hierarchical_probs,
+                'super': super_probs,
+                'flat': flat_probs,
+                'model': model_probs}
+    
+    def update(self, t, probs=None):
+        """ Update all confidences and subordinate experts after compiled trial t
+        
+        Args:
+            t: index of the trial
+            probs: optional output of get_action_probs for trial t
+        """
+        if probs is None:
+            probs = self.get_action_probs(t)
+        choice = self.choices[t]
+        reward = self.rewards[t]
+        n_hierarchical = len(self.hierarchical_features)
+        for confidences, action_probs in \
+            [(self.confidences, numpy.vstack([probs['super'], probs['flat']])),
+             (self.super_confidences, probs['hierarchical']),
+             (self.flat_confidences, probs['subordinate'][2*n_hierarchical:])]:
+            updates = self.get_credit_updates(action_probs, choice, reward)
+            confidences[updates, 0] += 1
+            confidences[~updates, 1] += 1
+        sub_updates = self.get_credit_updates(probs['subordinate'][:2*n_hierarchical], 
+                                              choice, reward).reshape(n_hierarchical, 2)
+        for h, context in enumerate(self.contexts[t]):
+            self.hierarchical_confidences[h, context, sub_updates[h], 0] += 1
+            self.hierarchical_confidences[h, context, ~sub_updates[h], 1] += 1
+        rows = self.rows[t]
+        if reward:
+            self.sub_a[rows, choice] += 1
+        else:
+            self.sub_b[rows, choice] += 1
+            
+    def run_data(self):
+        """ Run the model over all trials with a response, storing the negative
+        log likelihood of the choices in sum_neg_ll
+        
+        Returns:
+            action_probs: (trials, actions) array of the model's action
+                probabilities before each trial
+        """
+        action_probs = numpy.zeros((len(self.choices), len(self.actions)))
+        for t in range(len(self.choices)):
+            probs = self.get_action_probs(t)
+            action_probs[t] = probs['model']
+            self.update(t, probs)
+        choice_probs = action_probs[numpy.arange(len(self.choices)), self.choices]
+        self.sum_neg_ll = -numpy.sum(numpy.log(choice_probs))
+        return action_probs
+    
+    def get_neg_ll(self):
+        return self.sum_neg_ll
+    
+    
 from lmfit import Minimizer, Parameters
 # Functions to define Shift Task model (Wilson & Niv, 2012)
 class fRL_Model():
@@ -469,16 +821,48 @@ class fRL_Model():
         shapes =  [i['shape'] for i in stim_features]
         all_features = colors+patterns+shapes
         # set up class vars
-        self.weights = {f: 0 for f in all_features}
+        self.features = list(dict.fromkeys(all_features))
+        self.feature_index = {f: i for i, f in enumerate(self.features)}
+        self.weight_vector = numpy.zeros(len(self.features))
         self.decay = 0
         self.beta=1
         self.eps=0
         self.lr = .01
         self.decay_weights=decay_weights
         self.verbose=verbose
+        self.compile_data()
+    
+    @property
+    def weights(self):
+        return dict(zip(self.features, self.weight_vector.tolist()))
+    
+    def get_feature_indices(self, stim):
+        return [self.feature_index[v] for v in stim.values()]
+    
+    def compile_data(self):
+        """ Parse stims and choices once into arrays of feature indices, so
+        run_data does not need to parse json for every trial
+        """
+        stims = [[self.get_feature_indices(stim) for stim in json.loads(trial_stims)]
+                 for trial_stims in self.data.stims]
+        choices = [self.get_feature_indices(eval(c) if type(c) == str else c)
+                   for c in self.data.choice_stim]
+        self.stim_features = numpy.array(stims, dtype=int)
+        self.choice_features = numpy.array(choices, dtype=int)
+        self.choice_positions = self.data.choice_position.astype(int).values
+        self.rewards = self.data.feedback.astype(float).values
+        # features that decay on each trial (those not chosen)
+        self.nonchoice_features = numpy.array([[f for f in range(len(self.features)) if f not in c] 
+                                               for c in choices], dtype=int)
+        # python lists of the trial arrays for the sequential loop in run_data
+        self.trials = list(zip(self.stim_features.tolist(), 
+                               self.choice_positions.tolist(),
+                               self.choice_features.tolist(),
+                               self.nonchoice_features.tolist(),
+                               self.rewards.tolist()))
         
     def get_stim_value(self, stim):
-        return numpy.sum([self.weights[v] for v in stim.values()]) 
+        return numpy.sum(self.weight_vector[self.get_feature_indices(stim)])
     
     def get_choice_prob(self, trial):
         stims = json.loads(trial.stims)
@@ -507,19 +891,58 @@ class fRL_Model():
         reward = trial.feedback
         value = self.get_stim_value(choice)
         delta = self.lr*(reward-value)
-        for key in choice.values():
-            self.weights[key] += delta
+        chosen = self.get_feature_indices(choice)
+        self.weight_vector[chosen] += delta
         # decay non choice features
-        for key in set(self.weights.keys()) - set(choice.values()):
-            self.weights[key] *= (1-self.decay)
+        nonchosen = [f for f in range(len(self.features)) if f not in chosen]
+        self.weight_vector[nonchosen] *= (1-self.decay)
             
-    def run_data(self):
+    def run_data(self, record_weights=True):
+        """ Run the model over the compiled trials
+        
+        Args:
+            record_weights: if True, return the feature weights after each trial
+        
+        Returns:
+            (probs, attention_weights): list of choice probabilities and list of
+            feature weight dictionaries (empty if record_weights is False)
+        """
         probs = []
         attention_weights = []
-        for i, trial in self.data.iterrows():
-            probs.append(self.get_choice_prob(trial))
-            self.update(trial)
-            attention_weights.append(self.weights.copy())
+        # the trial loop runs on python floats, with operations in the same order as
+        # get_choice_prob and update so that results are identical. Each stim has
+        # one feature for each of the three dimensions (color, pattern, shape)
+        weights = self.weight_vector.tolist()
+        e = numpy.e
+        beta = self.beta
+        eps = self.eps
+        lr = self.lr
+        decay = 1-self.decay
+        for stims, position, choice, nonchoice, reward in self.trials:
+            # compute softmax decision probs
+            try:
+                softmax_values = [e**(beta*(weights[f1]+weights[f2]+weights[f3])) for f1, f2, f3 in stims]
+                choice_prob = softmax_values[position]/sum(softmax_values)
+            except (OverflowError, ZeroDivisionError):
+                # extreme values, fall back on numpy's handling of inf and nan
+                with numpy.errstate(all='ignore'):
+                    stim_values = numpy.array([[weights[f] for f in stim] for stim in stims]).sum(1)
+                    softmax_values = e**(beta*stim_values)
+                    choice_prob = (softmax_values/numpy.sum(softmax_values))[position]
+            # incorporate eps
+            probs.append((1-eps)*choice_prob + (eps)*(1/3))
+            # update weights
+            f1, f2, f3 = choice
+            delta = lr*(reward-(weights[f1]+weights[f2]+weights[f3]))
+            weights[f1] += delta
+            weights[f2] += delta
+            weights[f3] += delta
+            # decay non choice features
+            for f in nonchoice:
+                weights[f] *= decay
+            if record_weights:
+                attention_weights.append(dict(zip(self.features, weights)))
+        self.weight_vector = numpy.array(weights)
         return probs, attention_weights
     
     def optimize(self):
@@ -530,7 +953,7 @@ class fRL_Model():
             self.decay = parvals['decay']
             self.lr = parvals['lr']
             self.eps = parvals['eps']
-            probs, attention_weights = self.run_data()
+            probs, attention_weights = self.run_data(record_weights=False)
             neg_log_likelihood = -numpy.sum(numpy.log(probs))
             return neg_log_likelihood
         
@@ -1,22 +1,149 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import numpy as np
 import pandas as pd
 import readline
 import rpy2.robjects
-from rpy2.robjects import pandas2ri, Formula
+from rpy2.robjects import Formula, numpy2ri
 from rpy2.robjects.packages import importr
-pandas2ri.activate()
 
-def glmer(data, formula, verbose = False):
-    base = importr('base')
-    lme4 = importr('lme4')
-    rs = lme4.glmer(Formula(formula), data, family = 'binomial', REML=True)
-    
+# R packages, imported once per process
+packages = {}
+
+def get_packages():
+    """ Import the R packages used here, once per process """
+    if not packages:
+        packages['base'] = importr('base')
+        packages['lme4'] = importr('lme4')
+    return packages
+
+def to_columns(data):
+    """ Convert a dataframe to a dictionary of numpy columns, which is cheap to
+    send to other processes and converts directly to R vectors
+
+    Args:
+        data: dataframe
+
+    Returns:
+        columns: ordered dictionary of (kind, values, levels) tuples. Kind is
+            'factor' or 'str' (values are codes into levels, -1 is missing),
+            'int' or 'float' (levels are None)
+    """
+    columns = OrderedDict()
+    for name, col in data.items():
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            columns[name] = ('factor', np.asarray(col.cat.codes), [str(l) for l in col.cat.categories])
+        elif pd.api.types.is_bool_dtype(col) or pd.api.types.is_integer_dtype(col):
+            columns[name] = ('int', col.values.astype(np.int32), None)
+        elif pd.api.types.is_float_dtype(col):
+            columns[name] = ('float', col.values.astype(float), None)
+        else:
+            # strings are sent as codes into levels like factors
+            codes, levels = pd.factorize(col)
+            columns[name] = ('str', codes, [str(l) for l in levels])
+    return columns
+
+def to_r_dataframe(columns):
+    """ Build an R data.frame from the output of to_columns. Every column is copied
+    from its numpy buffer into an R vector in one step: numbers as integer or double
+    vectors, factors as integer vectors of 1-based codes with levels and class set,
+    and strings as such factors converted with R's as.character
+    """
+    vectors = OrderedDict()
+    for name, (kind, values, levels) in columns.items():
+        if kind in ['factor', 'str']:
+            # R stores NA integers as INT_MIN
+            codes = np.where(values >= 0, values + 1, np.iinfo(np.int32).min).astype(np.int32)
+            vector = numpy2ri.numpy2rpy(codes)
+            vector.do_slot_assign('levels', rpy2.robjects.StrVector(levels))
+            vector.do_slot_assign('class', rpy2.robjects.StrVector(['factor']))
+            if kind == 'factor':
+                vectors[name] = rpy2.robjects.FactorVector(vector)
+            else:
+                vectors[name] = rpy2.robjects.baseenv['as.character'](vector)
+        else:
+            vectors[name] = numpy2ri.numpy2rpy(values)
+    return rpy2.robjects.DataFrame(vectors)
+
+def fit_glmer(columns, formula, verbose = False):
+    """ Fit a binomial glmer in this process's R session
+
+    Args:
+        columns: output of to_columns
+        formula: lme4 formula
+        verbose: if True, also return the summary of the fit
+
+    Returns:
+        (fixed_effects, random_effects, summary): dictionary of fixed effects,
+        dataframe of random effects indexed by group and the summary printed by R
+        (None if verbose is False)
+    """
+    base = get_packages()['base']
+    lme4 = get_packages()['lme4']
+    rs = lme4.glmer(Formula(formula), to_r_dataframe(columns), family = 'binomial', REML=True)
+
     fixed_effects = lme4.fixed_effects(rs)
     fixed_effects = {k:v for k,v in zip(fixed_effects.names, list(fixed_effects))}
-                                  
+
     random_effects = lme4.random_effects(rs)[0]
-    random_effects = pd.DataFrame([list(lst) for lst in random_effects], index = list(random_effects.colnames)).T
+    random_effects = pd.DataFrame([list(lst) for lst in random_effects],
+                                  index = list(random_effects.colnames),
+                                  columns = list(random_effects.rownames)).T
+    summary = str(base.summary(rs)) if verbose else None
+    return fixed_effects, random_effects, summary
+
+def glmer(data, formula, verbose = False):
+    fixed_effects, random_effects, summary = fit_glmer(to_columns(data), formula, verbose)
     if verbose:
-        print(base.summary(rs))
+        print(summary)
     return fixed_effects, random_effects
 
+class GlmerPool():
+    """ Pool of long-lived R processes with lme4 loaded
+
+    R starts, and lme4 is imported, once per worker process when the pool is
+    created. Data is sent to the workers as numpy columns, so several glmer fits
+    (i.e. one per battery or bootstrap sample) run concurrently. Use as a context
+    manager, or call close when done:
+
+        with GlmerPool(4) as pool:
+            fits = pool.map(datasets, formula)
+    """
+    def __init__(self, processes = None):
+        # embedded R sessions cannot be forked safely, so workers are spawned
+        self.executor = ProcessPoolExecutor(processes,
+                                            mp_context = multiprocessing.get_context('spawn'),
+                                            initializer = get_packages)
+
+    def submit(self, data, formula, verbose = False):
+        """ Start a glmer fit in the pool, returning a future of fit_glmer's output """
+        return self.executor.submit(fit_glmer, to_columns(data), formula, verbose)
+
+    def glmer(self, data, formula, verbose = False):
+        """ Fit a glmer in the pool. Takes and returns the same arguments as glmer """
+        return self.map([data], formula, verbose)[0]
+
+    def map(self, datasets, formula, verbose = False):
+        """ Fit the same formula to several datasets concurrently
+
+        Returns:
+            fits: list of (fixed_effects, random_effects) tuples, one per dataset
+        """
+        futures = [self.submit(data, formula, verbose) for data in datasets]
+        fits = []
+        for future in futures:
+            fixed_effects, random_effects, summary = future.result()
+            if verbose:
+                print(summary)
+            fits.append((fixed_effects, random_effects))
+        return fits
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,123 @@
+from glob import glob
+import json
+import numpy
+from numpy.lib.format import open_memmap
+import os
+import pandas
+
+class TraceStore():
+    """ Memory-mapped storage of MCMC traces
+
+    A store is a directory holding one .npy file per chain, with a
+    (nodes, samples) float array, so the trace of each node is contiguous,
+    and an index.json with the node names and chain lengths. Chains are
+    appended as they are sampled, and reads memory-map the chain files, so
+    only the requested nodes are read from disk:
+
+        store = TraceStore('stroop_traces')
+        store.append_chain(m.get_traces())
+        traces = store.load(['a', 'v_Intercept'])
+    """
+    def __init__(self, path, overwrite = False):
+        """ Open the store at path, creating it if it does not exist. If
+        overwrite is True, chains already stored there are removed """
+        self.path = path
+        index_path = os.path.join(path, 'index.json')
+        if overwrite and os.path.exists(index_path):
+            os.remove(index_path)
+            for chain_path in glob(os.path.join(path, 'chain_*.npy')):
+                os.remove(chain_path)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                index = json.load(f)
+            self.nodes = index['nodes']
+            self.chains = index['chains']
+        else:
+            os.makedirs(path, exist_ok = True)
+            self.nodes = None
+            self.chains = []
+        self.node_index = {node: i for i, node in enumerate(self.nodes or [])}
+
+    def get_chain_path(self, chain):
+        return os.path.join(self.path, 'chain_%s.npy' % chain)
+
+    def write_index(self):
+        tmp_path = os.path.join(self.path, 'index.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'nodes': self.nodes, 'chains': self.chains}, f)
+        os.replace(tmp_path, os.path.join(self.path, 'index.json'))
+
+    def append_chain(self, traces):
+        """ Add a chain to the store
+
+        Args:
+            traces: dataframe of traces, with a column per node (i.e. the output
+                of get_traces). Every chain must have the same nodes
+        """
+        nodes = [str(node) for node in traces.columns]
+        if self.nodes is None:
+            self.nodes = nodes
+            self.node_index = {node: i for i, node in enumerate(nodes)}
+        elif set(nodes) != set(self.nodes):
+            raise ValueError('Chain nodes do not match the nodes of the store')
+        values = traces.loc[:, self.nodes].values if nodes != self.nodes else traces.values
+        chain = len(self.chains)
+        array = open_memmap(self.get_chain_path(chain), mode = 'w+', dtype = float,
+                            shape = (len(self.nodes), len(traces)))
+        array[:] = values.T
+        array.flush()
+        del array
+        # the chain is only part of the store once the index lists it
+        self.chains.append(len(traces))
+        self.write_index()
+
+    def truncate(self, num_chains):
+        """ Remove the chains after the first num_chains (i.e. chains appended
+        after a checkpoint was written) """
+        for chain in range(num_chains, len(self.chains)):
+            os.remove(self.get_chain_path(chain))
+        self.chains = self.chains[:num_chains]
+        self.write_index()
+
+    def get_chain(self, chain):
+        """ Memory-mapped (nodes, samples) array of a chain """
+        return numpy.load(self.get_chain_path(chain), mmap_mode = 'r')
+
+    def load_node(self, node, chains = None):
+        """ Trace of one node, concatenated across chains
+
+        Args:
+            node: node name
+            chains: optional list of chain numbers, defaults to all chains
+
+        Returns:
+            trace: array of samples. With a single chain this is a read-only
+                memory-mapped view, so nothing is read until it is used
+        """
+        i = self.node_index[node]
+        if chains is None:
+            chains = range(len(self.chains))
+        traces = [self.get_chain(chain)[i] for chain in chains]
+        return traces[0] if len(traces) == 1 else numpy.concatenate(traces)
+
+    def load(self, nodes = None, chains = None):
+        """ Traces of several nodes, concatenated across chains
+
+        Args:
+            nodes: optional list of node names, defaults to all nodes
+            chains: optional list of chain numbers, defaults to all chains
+
+        Returns:
+            traces: dataframe with a column per node, like get_traces
+        """
+        if nodes is None:
+            nodes = self.nodes
+        if chains is None:
+            chains = range(len(self.chains))
+        rows = [self.node_index[node] for node in nodes]
+        values = numpy.concatenate([self.get_chain(chain)[rows] for chain in chains], 1)
+        return pandas.DataFrame(values.T, columns = nodes)
+
+    def __len__(self):
+        """ Total number of samples across chains """
+        return sum(self.chains)
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+"""
+Test HDDM sampling helpers on a small simulated data set
+"""
+
+from expanalysis.experiments.ddm_utils import fit_ML_DDM, initialize_model, PreparedDDMData, \
+    sample_until_converged, sample_with_checkpoints
+import hddm
+import numpy
+import os
+import pandas
+import shutil
+import tempfile
+import unittest
+
+class TestHDDM(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(0)
+        self.data, _ = hddm.generate.gen_rand_data({'a': 2, 'v': .5, 't': .3},
+                                                   size = 40, subjs = 4)
+        self.start_values = {'a': 2, 'v': .5, 't': .3}
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_prepared_data_missing_category(self):
+        print("TESTING: prepared data with a missing categorical value")
+        df = pandas.DataFrame({'worker_id': numpy.repeat(['s0', 's1'], 80),
+                               'rt': numpy.random.uniform(300, 900, 160),
+                               'correct': numpy.random.rand(160) < .8,
+                               'condition': numpy.random.choice(['congruent', 'incongruent'], 160)})
+        df['condition'] = df.condition.astype(object)
+        df.loc[5, 'condition'] = numpy.nan
+        prepared = PreparedDDMData(df, 'correct', ['condition'])
+        data = prepared.to_frame()
+        self.assertTrue(pandas.isnull(data.condition[5]))
+        self.assertEqual(data.condition.isnull().sum(), 1)
+        shared = prepared.share()
+        try:
+            self.assertTrue(shared.to_frame().equals(data))
+        finally:
+            shared.unlink()
+        estimates = fit_ML_DDM(prepared, 'v ~ C(condition, Sum)')
+        self.assertTrue(estimates['mean'].notnull().all())
+
+    def test_fix_group(self):
+        print("TESTING: sampling with fixed group nodes")
+        m = hddm.HDDM(self.data)
+        initialize_model(m, self.start_values, fix_group = True)
+        m.sample(60, burn = 10, db = 'ram')
+        traces = m.get_traces()
+        self.assertEqual(len(traces), 50)
+        self.assertIn('a_subj.0', traces.columns)
+        for name, value in self.start_values.items():
+            self.assertNotIn(name, traces.columns)
+            self.assertEqual(m.nodes_db.node[name].value, value)
+
+    def test_checkpoints(self):
+        print("TESTING: sampling with checkpoints")
+        checkpoint_path = os.path.join(self.tmpdir, 'fit.checkpoint')
+        # an interrupted fit, which resumes in a new model
+        sample_with_checkpoints(hddm.HDDM(self.data), 50, 10, 1, checkpoint_path, 
+                                checkpoint_interval = 20, start_values = self.start_values)
+        m = sample_with_checkpoints(hddm.HDDM(self.data), 90, 10, 1, checkpoint_path,
+                                    checkpoint_interval = 20, start_values = self.start_values)
+        self.assertEqual(m.mc.db.chains, 1)
+        traces = m.get_traces()
+        self.assertEqual(len(traces), 80)
+        numpy.testing.assert_allclose(m.nodes_db.loc[traces.columns, 'mean'].astype(float), 
+                                      traces.mean())
+
+    def test_parallel_chains(self):
+        print("TESTING: sampling chains in parallel")
+        m, chain_traces, report = sample_until_converged(hddm.HDDM, {'data': self.data}, 2, 10,
+                                                         max_samples = 60, check_interval = 25)
+        self.assertEqual(report['samples_per_chain'], 60)
+        self.assertEqual([len(traces) for traces in chain_traces], [50, 50])
+        self.assertFalse(numpy.allclose(chain_traces[0].values, chain_traces[1].values))
+        self.assertEqual(m.mc.db.chains, 1)
+        pooled = pandas.concat(chain_traces, ignore_index = True)
+        numpy.testing.assert_allclose(m.nodes_db.loc[pooled.columns, 'mean'].astype(float),
+                                      pooled.mean())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+"""
+Test vectorized DV kernels against the per-worker implementations they replaced
+"""
+
+from expanalysis.experiments.ddm_utils import EZ, EZ_diffusion, group_EZ_diffusion
+from expanalysis.experiments.glm_utils import group_logit, group_ols
+from expanalysis.experiments.jspsych_processing import get_group_post_error_slow, \
+    get_post_error_slow, get_standard_DVs
+from expanalysis.experiments.optimize_utils import batch_fmin
+import hddm
+import numpy
+import pandas
+from scipy.optimize import fmin
+import statsmodels.api as sm
+import statsmodels.formula.api as smf
+import unittest
+
+def make_battery(num_workers = 12, seed = 0):
+    """ Simulate a small choice RT battery. Workers differ in accuracy, speed and
+    number of trials, some trials are missed (rt == -1), and the last two workers
+    make no errors or are at chance on one condition
+    """
+    rng = numpy.random.RandomState(seed)
+    trials = []
+    for i in range(num_workers):
+        n = rng.randint(20, 150)
+        acc = rng.uniform(.6, .95)
+        if i == num_workers-2:
+            acc = 1
+        df = pandas.DataFrame({'worker_id': 's%s' % i,
+                               'exp_stage': 'test',
+                               'condition': rng.choice(['congruent', 'incongruent'], n),
+                               'load': rng.randint(1, 4, n),
+                               'correct': rng.rand(n) < acc,
+                               'rt': numpy.round(rng.gamma(4, 80*(1 + i/10.), n)) + 200})
+        df.loc[rng.rand(n) < .05, 'rt'] = -1
+        if i == num_workers-1:
+            df.loc[df.condition == 'congruent', 'correct'] = numpy.arange((df.condition == 'congruent').sum()) % 2 == 0
+        trials.append(df)
+    return pandas.concat(trials, ignore_index = True)
+
+def standard_DVs_reference(df):
+    """ The per-worker block get_standard_DVs replaced """
+    dvs = {}
+    post_error_slowing = get_post_error_slow(df)
+    missed_percent = (df['rt']==-1).mean()
+    df = df.query('rt != -1').reset_index(drop = True)
+    df_correct = df.query('correct == True').reset_index(drop = True)
+    dvs['acc'] = df.correct.mean()
+    dvs['avg_rt_error'] = df.query('correct == False').rt.median()
+    dvs['std_rt_error'] = df.query('correct == False').rt.std()
+    dvs['avg_rt'] = df_correct.rt.median()
+    dvs['std_rt'] = df_correct.rt.std()
+    dvs['missed_percent'] = missed_percent
+    dvs['post_error_slowing'] = post_error_slowing
+    return dvs
+
+def EZ_diffusion_reference(df, condition = None):
+    """ The per-worker EZ_diffusion group_EZ_diffusion replaced """
+    df = df.copy()
+    df['rt'] = df['rt']/1000
+    df = df.query('rt > .05')
+    EZ_dvs = {}
+    if condition:
+        conditions = df[condition].unique()
+        conditions = conditions[~pandas.isnull(conditions)]
+        for c in conditions:
+            subset = df[df[condition] == c]
+            pc = subset['correct'].mean()
+            if pc == 1:
+                pc = 1-(.5/len(subset))
+            vrt = numpy.var(subset.query('correct == True')['rt'])
+            mrt = numpy.mean(subset.query('correct == True')['rt'])
+            try:
+                drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
+            except ValueError:
+                continue
+            EZ_dvs['EZ_drift_' + c] = drift
+            EZ_dvs['EZ_thresh_' + c] = thresh
+            EZ_dvs['EZ_non_decision_' + c] = non_dec
+    else:
+        pc = df['correct'].mean()
+        if pc == 1:
+            pc = 1-(1.0/(2*len(df)))
+        vrt = numpy.var(df.query('correct == True')['rt'])
+        mrt = numpy.mean(df.query('correct == True')['rt'])
+        try:
+            drift, thresh, non_dec = hddm.utils.EZ(pc, vrt, mrt)
+        except ValueError:
+            return {}
+        EZ_dvs['EZ_drift'] = drift
+        EZ_dvs['EZ_thresh'] = thresh
+        EZ_dvs['EZ_non_decision'] = non_dec
+    return EZ_dvs
+
+class TestKernels(unittest.TestCase):
+
+    def setUp(self):
+        self.battery = make_battery()
+        self.workers = pandas.unique(self.battery.worker_id)
+
+    def assertDVsEqual(self, group_dvs, reference_dvs):
+        self.assertEqual(set(group_dvs.keys()), set(reference_dvs.keys()))
+        for worker, reference in reference_dvs.items():
+            self.assertEqual(set(group_dvs[worker].keys()), set(reference.keys()))
+            for dv, value in reference.items():
+                numpy.testing.assert_allclose(group_dvs[worker][dv]['value'], value,
+                                              rtol = 1e-10, err_msg = '%s %s' % (worker, dv))
+
+    def test_standard_DVs(self):
+        print("TESTING: standard DVs")
+        group_dvs = get_standard_DVs(self.battery)
+        reference_dvs = {worker: standard_DVs_reference(df)
+                         for worker, df in self.battery.groupby('worker_id')}
+        self.assertDVsEqual(group_dvs, reference_dvs)
+
+    def test_post_error_slow(self):
+        print("TESTING: post error slowing")
+        post_error_slowing = get_group_post_error_slow(self.battery)
+        self.assertEqual(list(post_error_slowing.index), list(self.workers))
+        for worker, df in self.battery.groupby('worker_id'):
+            numpy.testing.assert_allclose(post_error_slowing[worker], get_post_error_slow(df))
+        # workers with fewer than 4 correct-error-correct triplets
+        self.assertTrue(post_error_slowing.isnull().any())
+
+    def test_EZ(self):
+        print("TESTING: EZ diffusion")
+        rng = numpy.random.RandomState(1)
+        pc = rng.uniform(.55, .99, 20)
+        vrt = rng.uniform(.01, .1, 20)
+        mrt = rng.uniform(.4, .9, 20)
+        drift, thresh, non_dec = EZ(pc, vrt, mrt)
+        for i in range(len(pc)):
+            numpy.testing.assert_allclose((drift[i], thresh[i], non_dec[i]),
+                                          hddm.utils.EZ(pc[i], vrt[i], mrt[i]), rtol = 1e-12)
+        # undefined cells
+        self.assertTrue(numpy.isnan(EZ([.5, 1], [.1, .1], [.5, .5])).all())
+
+    def test_group_EZ_diffusion(self):
+        print("TESTING: group EZ diffusion")
+        for condition in [None, 'condition']:
+            group_dvs = group_EZ_diffusion(self.battery, condition)
+            reference_dvs = {worker: EZ_diffusion_reference(df, condition)
+                             for worker, df in self.battery.groupby('worker_id')}
+            reference_dvs = {worker: dvs for worker, dvs in reference_dvs.items() if dvs}
+            self.assertDVsEqual(group_dvs, reference_dvs)
+        df = self.battery.query('worker_id == "s0"')
+        self.assertDVsEqual({'s0': EZ_diffusion(df, 'condition')},
+                            {'s0': EZ_diffusion_reference(df, 'condition')})
+
+    def test_group_logit(self):
+        print("TESTING: batched logistic regression")
+        battery = self.battery.query('rt != -1').assign(incongruent = lambda x: x.condition == 'incongruent')
+        fits = group_logit(battery, 'correct', ['load', 'incongruent'])
+        for worker, df in battery.groupby('worker_id'):
+            if not df.correct.all():
+                rs = smf.glm('correct ~ load + incongruent', 
+                             data = df.assign(correct = df.correct.astype(float),
+                                              incongruent = df.incongruent.astype(float)),
+                             family = sm.families.Binomial()).fit()
+                self.assertTrue(fits.loc[worker, 'converged'])
+                numpy.testing.assert_allclose(fits.loc[worker, ['Intercept', 'load', 'incongruent']].astype(float),
+                                              rs.params.values, rtol = 1e-6)
+                numpy.testing.assert_allclose(fits.loc[worker, 'llf'], rs.llf, rtol = 1e-8)
+                self.assertEqual(fits.loc[worker, 'nobs'], rs.nobs)
+            else:
+                # perfect separation
+                self.assertFalse(fits.loc[worker, 'converged'])
+
+    def test_group_ols(self):
+        print("TESTING: batched linear regression")
+        battery = self.battery.query('rt != -1').assign(incongruent = lambda x: (x.condition == 'incongruent').astype(float))
+        fits = group_ols(battery, 'rt', ['load', 'incongruent'])
+        for worker, df in battery.groupby('worker_id'):
+            rs = smf.ols('rt ~ load + incongruent', data = df).fit()
+            for stat in ['params', 'bse', 'pvalues']:
+                numpy.testing.assert_allclose(fits[stat].loc[worker], getattr(rs, stat).values,
+                                              rtol = 1e-6, err_msg = '%s %s' % (worker, stat))
+            numpy.testing.assert_allclose(fits['llf'][worker], rs.llf, rtol = 1e-8)
+            self.assertEqual(fits['nobs'][worker], rs.nobs)
+
+    def test_batch_fmin(self):
+        print("TESTING: batched Nelder-Mead")
+        rng = numpy.random.RandomState(2)
+        a = rng.uniform(-2, 2, 10)
+        b = rng.uniform(1, 100, 10)
+        def rosen(x, a, b):
+            return (a - x[..., 0])**2 + b*(x[..., 1] - x[..., 0]**2)**2
+        x0 = rng.uniform(-1, 1, (10, 2))
+        xopt, fopt, converged = batch_fmin(lambda x: rosen(x, a, b), x0)
+        self.assertTrue(converged.all())
+        for i in range(len(a)):
+            reference = fmin(rosen, x0[i], args = (a[i], b[i]), full_output = True, disp = False)
+            numpy.testing.assert_allclose(xopt[i], reference[0], rtol = 1e-12, atol = 1e-12)
+            numpy.testing.assert_allclose(fopt[i], reference[1], rtol = 1e-12, atol = 1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()